@@ -14,6 +14,51 @@ balance_variation = 6
 gain_max = 0
 # Min allowed digital gain (dB).
 gain_min = -100
+# Max sane peak in FIR filter files (dB).
+fir_peak_max = 24
+
+
+# State persistence
+
+# Seconds to wait for further changes before journaling state.
+state_debounce = 0.5
+# Journal entries that trigger compaction into state file.
+state_compact_entries = 100
+# Max seconds between compactions, if there are journal entries.
+state_compact_interval = 60
+
+
+# Profiler
+
+# Seconds between stack samples.
+profile_interval = 0.001
+# Functions shown in profile summaries.
+profile_top = 20
+
+
+# Command trace
+
+# Bytes per trace file before rotation.
+trace_max_bytes = 10_000_000
+# Rotated trace files kept.
+trace_backups = 3
+# Reply characters kept per traced command.
+trace_reply_max = 200
+
+
+# Fades
+
+# Min seconds between fade steps.
+fade_interval = 0.1
+# Sleep timer fade out time (s) and depth (dB) before muting.
+sleep_fade_time = 30
+sleep_attenuation = 40
+
+
+# Config cache
+
+# Raise to discard caches written by previous code.
+init_cache_version = 1
 
 
 # Folder names
@@ -22,16 +67,22 @@ gain_min = -100
 config_folder = 'config'
 clients_folder = 'clients'
 loudspeakers_folder = 'loudspeakers'
+profiles_folder = 'profiles'
+traces_folder = 'traces'
 
 # Filenames
 
 config_filename = 'config.yml'
 state_filename = 'state.yml'
+state_journal_filename = 'state.journal'
 state_init_filename = 'state_init.yml'
 sources_filename = 'sources.yml'
 clients_filename = 'clients.yml'
 camilladsp_filename = 'camilladsp.yml'
 eq_filename = 'eq.yml'
+init_cache_filename = '.init_cache.pickle'
+fir_cache_filename = '.filters_cache.json'
+trace_filename = 'trace.jsonl'
 
 loudspeaker_filename = 'loudspeaker.yml'
 drc_filename = 'drc.yml'
@@ -0,0 +1,487 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Offline renderer of camilladsp configs used by pre.di.c.
+
+Usage:
+cdsprender.py [options] input.wav [input.wav ...]
+
+-c, --config <file>     camilladsp config (default actual_config.yaml in
+                        loudspeaker folder, as saved by 'camillaconfig')
+-l, --live              ask server to save its actual config first
+-v, --volume <dB>       main volume, also used by loudness (default 0)
+-b, --bits <16|24|32>   output sample size (default 24)
+-o, --outdir <folder>   output folder (default next to input files,
+                        with '.rendered' suffix)
+-j, --jobs <n>          files rendered in parallel (default CPU count)
+
+Renders audio through the same pipeline stages camilladsp would use with
+that config: mixers, Gain, Loudness, Biquad, Conv and Dither filters.
+Any config can be used from code, as the one built by startaudio or the
+live control.cdsp_config. Filter file names are relative to 'folder',
+as camilladsp runs in the loudspeaker folder.
+
+Main volume is applied at the pipeline input. Linear filters in a filter
+step are combined into a single FIR, biquads included as their impulse
+response truncated well below audibility, and run by FFT overlap-save in
+blocks, so files are streamed through with bounded memory.
+"""
+
+import argparse
+import concurrent.futures
+import math as m
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+import yaml
+
+import firassets
+
+
+# Frames per processing block.
+block_size = 2**16
+# Relative level where biquad impulse responses are truncated.
+iir_tolerance = 1e-12
+# Max biquad impulse response length.
+iir_max_length = 2**20
+
+
+def db2gain(db):
+    """Calculate gain multiplier from gain in dB."""
+    return 10 ** (db / 20)
+
+
+def next_pow2(n):
+    """Return smallest power of 2 not less than n."""
+    return 1 << max(n - 1, 0).bit_length()
+
+
+def fft_convolve(a, b):
+    """Return full linear convolution of two impulses."""
+    length = len(a) + len(b) - 1
+    n = next_pow2(length)
+    return np.fft.irfft(np.fft.rfft(a, n) * np.fft.rfft(b, n), n)[:length]
+
+
+# Filter impulses.
+
+def biquad_coefficients(parameters, fs):
+    """Return (b, a) coefficients of a camilladsp Biquad filter."""
+    kind = parameters['type']
+    if kind == 'Free':
+        return ([parameters['b0'], parameters['b1'], parameters['b2']],
+                [1, parameters['a1'], parameters['a2']])
+
+    w0 = 2 * m.pi * parameters['freq'] / fs
+    cos = m.cos(w0)
+    sin = m.sin(w0)
+    A = 10 ** (parameters.get('gain', 0) / 40)
+    if 'slope' in parameters:
+        # Shelf slope in dB/octave, 12 is the steepest.
+        S = parameters['slope'] / 12
+        alpha = sin / 2 * m.sqrt((A + 1 / A) * (1 / S - 1) + 2)
+    elif 'bandwidth' in parameters:
+        alpha = sin * m.sinh(m.log(2) / 2 * parameters['bandwidth']
+                             * w0 / sin)
+    else:
+        alpha = sin / (2 * parameters['q'])
+
+    match kind:
+        case 'Lowpass':
+            b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        case 'Highpass':
+            b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        case 'Bandpass':
+            b = [alpha, 0, -alpha]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        case 'Notch':
+            b = [1, -2 * cos, 1]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        case 'Allpass':
+            b = [1 - alpha, -2 * cos, 1 + alpha]
+            a = [1 + alpha, -2 * cos, 1 - alpha]
+        case 'Peaking':
+            b = [1 + alpha * A, -2 * cos, 1 - alpha * A]
+            a = [1 + alpha / A, -2 * cos, 1 - alpha / A]
+        case 'Lowshelf':
+            sq = 2 * m.sqrt(A) * alpha
+            b = [A * ((A + 1) - (A - 1) * cos + sq),
+                 2 * A * ((A - 1) - (A + 1) * cos),
+                 A * ((A + 1) - (A - 1) * cos - sq)]
+            a = [(A + 1) + (A - 1) * cos + sq,
+                 -2 * ((A - 1) + (A + 1) * cos),
+                 (A + 1) + (A - 1) * cos - sq]
+        case 'Highshelf':
+            sq = 2 * m.sqrt(A) * alpha
+            b = [A * ((A + 1) + (A - 1) * cos + sq),
+                 -2 * A * ((A - 1) + (A + 1) * cos),
+                 A * ((A + 1) + (A - 1) * cos - sq)]
+            a = [(A + 1) - (A - 1) * cos + sq,
+                 2 * ((A - 1) - (A + 1) * cos),
+                 (A + 1) - (A - 1) * cos - sq]
+        case _:
+            raise Exception(f'unsupported biquad type {kind}')
+    return b, a
+
+
+def iir_impulse(b, a):
+    """Return impulse response of an IIR filter, truncated."""
+    b = np.asarray(b, dtype=float) / a[0]
+    a = np.asarray(a, dtype=float) / a[0]
+    radius = max(abs(np.roots(a)), default=0)
+    if radius >= 1:
+        raise Exception('unstable biquad')
+    length = len(b)
+    if radius > 0:
+        # Decay of the slowest pole down to tolerance.
+        length = max(length, m.ceil(m.log(iir_tolerance) / m.log(radius)))
+    length = min(length, iir_max_length)
+    # Sampled frequency response, long enough for negligible time aliasing.
+    n = next_pow2(length)
+    response = np.fft.rfft(b, n) / np.fft.rfft(a, n)
+    return np.fft.irfft(response, n)[:length]
+
+
+def loudness_impulse(parameters, volume, fs):
+    """
+    Return impulse of a camilladsp Loudness filter at a main volume.
+
+    Boost grows from none at reference level to full 20 dB below it,
+    with 12 dB/octave shelves at 70 Hz and 3500 Hz.
+    """
+    boost = min(max((parameters['reference_level'] - volume) / 20, 0), 1)
+    low = biquad_coefficients({'type': 'Lowshelf', 'freq': 70, 'slope': 12,
+                               'gain': boost * parameters['low_boost']}, fs)
+    high = biquad_coefficients({'type': 'Highshelf', 'freq': 3500,
+                                'slope': 12,
+                                'gain': boost * parameters['high_boost']}, fs)
+    return fft_convolve(iir_impulse(*low), iir_impulse(*high))
+
+
+def conv_impulse(parameters, folder):
+    """Return impulse of a camilladsp Conv filter."""
+    match parameters.get('type'):
+        case 'Dummy':
+            impulse = np.zeros(parameters.get('length', 1))
+            impulse[0] = 1
+            return impulse
+        case 'Values':
+            return np.asarray(parameters['values'], dtype=float)
+        case 'Raw':
+            raw_format = parameters.get('format', 'FLOAT32LE')
+            dtype, full_scale = firassets.raw_formats[raw_format]
+            path = os.path.join(folder, parameters['filename'])
+            return np.fromfile(path, dtype=dtype).astype(float) / full_scale
+    raise Exception(f'unsupported Conv type {parameters.get("type")}')
+
+
+def gain_impulse(parameters):
+    """Return impulse of a camilladsp Gain filter."""
+    if parameters.get('mute'):
+        return np.zeros(1)
+    gain = parameters.get('gain', 0)
+    if parameters.get('scale') != 'linear':
+        gain = db2gain(gain)
+    return np.array([-gain if parameters.get('inverted') else gain])
+
+
+def mixer_matrix(mixer):
+    """Return [source, dest] gain matrix of a camilladsp mixer."""
+    matrix = np.zeros((mixer['channels']['in'], mixer['channels']['out']))
+    for mapping in mixer['mapping']:
+        if mapping.get('mute'):
+            continue
+        for source in mapping['sources']:
+            if source.get('mute'):
+                continue
+            gain = source.get('gain', 0)
+            if source.get('scale') != 'linear':
+                gain = db2gain(gain)
+            if source.get('inverted'):
+                gain = -gain
+            matrix[source['channel'], mapping['dest']] += gain
+    return matrix
+
+
+# Processing stages. They keep state between blocks.
+
+class Convolver:
+    """FIR filter by FFT overlap-save."""
+
+    def __init__(self, impulse):
+        self.impulse = impulse
+        self.history = np.zeros(len(impulse) - 1)
+        # Impulse spectra by FFT size.
+        self.spectra = {}
+
+    def process(self, x):
+        """Filter a block of samples."""
+        overlap = len(self.impulse) - 1
+        if not overlap:
+            return x * self.impulse[0]
+        data = np.concatenate((self.history, x))
+        n = next_pow2(len(data))
+        if n not in self.spectra:
+            self.spectra[n] = np.fft.rfft(self.impulse, n)
+        y = np.fft.irfft(np.fft.rfft(data, n) * self.spectra[n], n)
+        self.history = data[len(data) - overlap:]
+        return y[overlap:len(data)]
+
+
+class Ditherer:
+    """Quantizer with triangular dither noise, in LSB."""
+
+    def __init__(self, parameters, seed):
+        self.scale = 2 ** (parameters['bits'] - 1)
+        self.amplitude = parameters.get('amplitude', 0)
+        # Repeatable renders, uncorrelated channels.
+        self.rng = np.random.default_rng(seed)
+
+    def process(self, x):
+        """Dither and quantize a block of samples."""
+        x = x * self.scale
+        if self.amplitude:
+            x += self.rng.triangular(
+                -self.amplitude, 0, self.amplitude, len(x))
+        return np.round(x) / self.scale
+
+
+class MixerStage:
+    """Channels mixer."""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def process(self, block):
+        """Mix a (frames, channels) block."""
+        return block @ self.matrix
+
+
+class FilterStage:
+    """Chain of filters on one channel."""
+
+    def __init__(self, channel, processors):
+        self.channel = channel
+        self.processors = processors
+
+    def process(self, block):
+        """Filter a channel of a (frames, channels) block in place."""
+        x = block[:, self.channel]
+        for processor in self.processors:
+            x = processor.process(x)
+        block[:, self.channel] = x
+        return block
+
+
+class Renderer:
+    """Render audio through a camilladsp config pipeline."""
+
+    def __init__(self, config, folder, volume=0.0):
+        self.fs = config['devices']['samplerate']
+        self.channels = config['devices']['capture']['channels']
+        self.volume = volume
+        self.stages = [
+            stage for step in config['pipeline']
+            if not step.get('bypassed')
+            for stage in self.compile_step(step, config, folder)
+            ]
+
+    def compile_step(self, step, config, folder):
+        """Return processing stages for a pipeline step."""
+        if step['type'] == 'Mixer':
+            return [MixerStage(mixer_matrix(config['mixers'][step['name']]))]
+        if step['type'] != 'Filter':
+            raise Exception(f'unsupported pipeline step {step["type"]}')
+
+        processors = []
+        # Linear filters in a row are combined into one impulse.
+        impulse = np.ones(1)
+        for name in step['names']:
+            kind = config['filters'][name]['type']
+            parameters = config['filters'][name].get('parameters') or {}
+            if kind == 'Dither':
+                if len(impulse) > 1 or impulse[0] != 1:
+                    processors.append(Convolver(impulse))
+                processors.append(Ditherer(parameters, step['channel']))
+                impulse = np.ones(1)
+                continue
+            if kind == 'Gain':
+                new = gain_impulse(parameters)
+            elif kind == 'Biquad':
+                new = iir_impulse(*biquad_coefficients(parameters, self.fs))
+            elif kind == 'Loudness':
+                new = loudness_impulse(parameters, self.volume, self.fs)
+            elif kind == 'Conv':
+                new = conv_impulse(parameters, folder)
+            else:
+                raise Exception(f'unsupported filter type {kind}')
+            impulse = fft_convolve(impulse, new)
+        if len(impulse) > 1 or impulse[0] != 1:
+            processors.append(Convolver(impulse))
+        return [FilterStage(step['channel'], processors)]
+
+    def process(self, block):
+        """Render a (frames, channels) block."""
+        if block.shape[1] < self.channels:
+            # Missing input channels are silent.
+            block = np.pad(block, ((0, 0), (0, self.channels
+                                            - block.shape[1])))
+        block = block[:, :self.channels] * db2gain(self.volume)
+        for stage in self.stages:
+            block = stage.process(block)
+        return block
+
+    def render_file(self, in_path, out_path, bits=24):
+        """
+        Render a WAV file into another, block by block.
+
+        Return a tuple (seconds of audio, clipped samples, seconds taken).
+        """
+        time_start = time.perf_counter()
+        frames = 0
+        clipped = 0
+        with (wave.open(in_path, 'rb') as w_in,
+              wave.open(out_path, 'wb') as w_out):
+            if w_in.getframerate() != self.fs:
+                raise Exception(f'sample rate {w_in.getframerate()} '
+                                f'differs from config {self.fs}')
+            # Void block to know output channels.
+            channels = self.process(np.zeros((0, self.channels))).shape[1]
+            w_out.setnchannels(channels)
+            w_out.setsampwidth(bits // 8)
+            w_out.setframerate(self.fs)
+            while len(block := read_block(w_in, block_size)):
+                block = self.process(block)
+                clipped += write_block(w_out, block, bits)
+                frames += len(block)
+        return frames / self.fs, clipped, time.perf_counter() - time_start
+
+
+# WAV files input and output.
+
+def read_block(w, frames):
+    """Read frames from a WAV file as (frames, channels) float array."""
+    data = w.readframes(frames)
+    width = w.getsampwidth()
+    match width:
+        case 1:
+            x = np.frombuffer(data, dtype=np.uint8) / 128 - 1
+        case 2:
+            x = np.frombuffer(data, dtype='<i2') / 2**15
+        case 3:
+            b = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+            b = b.astype('<i4')
+            # Into the upper bytes, then shift down extending sign.
+            x = (b[:, 0] << 8) | (b[:, 1] << 16) | (b[:, 2] << 24)
+            x = (x >> 8) / 2**23
+        case 4:
+            x = np.frombuffer(data, dtype='<i4') / 2**31
+    return x.reshape(-1, w.getnchannels())
+
+
+def write_block(w, block, bits):
+    """Write a (frames, channels) block to a WAV file. Return clips."""
+    scale = 2 ** (bits - 1)
+    x = np.round(block * scale)
+    clipped = np.count_nonzero((x < -scale) | (x > scale - 1))
+    x = np.clip(x, -scale, scale - 1).astype('<i4')
+    if bits == 16:
+        data = x.astype('<i2').tobytes()
+    elif bits == 24:
+        data = x.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    else:
+        data = x.tobytes()
+    w.writeframes(data)
+    return clipped
+
+
+# Batch rendering in worker processes.
+
+# Renderer of each worker process.
+worker_renderer = None
+
+
+def init_worker(config, folder, volume):
+    """Build the renderer once per worker process."""
+    global worker_renderer
+    worker_renderer = Renderer(config, folder, volume)
+
+
+def render_job(paths, bits):
+    """Render a file in a worker process."""
+    return worker_renderer.render_file(*paths, bits)
+
+
+def main(argv):
+    """Parse arguments and render files."""
+    parser = argparse.ArgumentParser(
+        prog='cdsprender.py', usage=__doc__.split('\n\n')[1].strip(),
+        add_help=False)
+    parser.add_argument('inputs', nargs='*')
+    parser.add_argument('-c', '--config')
+    parser.add_argument('-l', '--live', action='store_true')
+    parser.add_argument('-v', '--volume', type=float, default=0.0)
+    parser.add_argument('-b', '--bits', type=int, default=24,
+                        choices=(16, 24, 32))
+    parser.add_argument('-o', '--outdir')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('-h', '--help', action='store_true')
+    args = parser.parse_args(argv)
+    if args.help or not args.inputs:
+        print(__doc__)
+        return
+
+    if args.config is None:
+        # pre.di.c configs needed only here.
+        import init
+        args.config = f'{init.loudspeaker_path}/actual_config.yaml'
+        if args.live:
+            import pdclient
+            connection = pdclient.ServerConnection(
+                init.config['control_port'])
+            connection.send('camillaconfig')
+            connection.close()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    folder = os.path.dirname(os.path.realpath(args.config))
+
+    jobs = []
+    for path in args.inputs:
+        root, ext = os.path.splitext(path)
+        if args.outdir:
+            out_path = os.path.join(args.outdir, os.path.basename(path))
+        else:
+            out_path = f'{root}.rendered{ext}'
+        if os.path.realpath(out_path) == os.path.realpath(path):
+            print(f'\n(cdsprender) {path}: output would overwrite input')
+            continue
+        jobs.append((path, out_path))
+    if not jobs:
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+            min(args.jobs, len(jobs)), initializer=init_worker,
+            initargs=(config, folder, args.volume)) as pool:
+        futures = {pool.submit(render_job, paths, args.bits): paths
+                   for paths in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            in_path, out_path = futures[future]
+            try:
+                duration, clipped, elapsed = future.result()
+            except Exception as e:
+                print(f'\n(cdsprender) {in_path}: {e}')
+                continue
+            print(f'\n(cdsprender) {out_path}: {duration:.1f}s rendered in '
+                  f'{elapsed:.2f}s ({duration / elapsed:.0f}x real time)'
+                  + (f', {clipped} samples clipped' if clipped else ''))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
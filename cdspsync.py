@@ -0,0 +1,119 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""Dispatch to camilladsp only what actually changed."""
+
+import copy
+
+import metrics
+
+
+def config_diff(old, new, path=()):
+    """
+    Compare two camilladsp configs.
+
+    Return a tuple (patch, removed). 'patch' is a nested dictionary with
+    the parts of 'new' that differ from 'old'. Mappings are compared key
+    by key, anything else (lists included) is compared and patched as a
+    whole. 'removed' is a list of key paths present in 'old' but missing
+    in 'new'.
+    """
+    patch = {}
+    removed = [path + (key,) for key in old if key not in new]
+
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = copy.deepcopy(value)
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            sub_patch, sub_removed = config_diff(
+                old[key], value, path + (key,))
+            if sub_patch:
+                patch[key] = sub_patch
+            removed.extend(sub_removed)
+        elif value != old[key]:
+            patch[key] = copy.deepcopy(value)
+
+    return patch, removed
+
+
+class ConfigSync:
+    """
+    Keep the last config, volume and mute acknowledged by camilladsp.
+
+    Only changes are dispatched. Config changes go as a patch when
+    camilladsp supports it, and as a full config upload otherwise.
+    Counters of dispatched and avoided calls are kept in 'stats'.
+    """
+
+    def __init__(self, cdsp, config):
+        self.cdsp = cdsp
+        # Last config acknowledged by camilladsp.
+        self.config = copy.deepcopy(config)
+        # Unknown until first set.
+        self.volume = None
+        self.mute = None
+        self.stats = dict.fromkeys((
+            'config_pushes',
+            'config_patches',
+            'config_avoided',
+            'volume_sets',
+            'volume_avoided',
+            'mute_sets',
+            'mute_avoided'
+            ), 0)
+
+    def set_active(self, config):
+        """Dispatch config changes, if any."""
+        patch, removed = config_diff(self.config, config)
+
+        if not patch and not removed:
+            self.stats['config_avoided'] += 1
+            return
+
+        # Key removal can't be expressed as a patch.
+        patch_config = getattr(self.cdsp.config, 'patch', None)
+        if patch_config is not None and not removed:
+            try:
+                with metrics.timer('cdsp patch'):
+                    patch_config(patch)
+            except Exception:
+                # Camilladsp refused the patch, try the full config.
+                with metrics.timer('cdsp set_active'):
+                    self.cdsp.config.set_active(config)
+                self.stats['config_pushes'] += 1
+            else:
+                self.stats['config_patches'] += 1
+        else:
+            with metrics.timer('cdsp set_active'):
+                self.cdsp.config.set_active(config)
+            self.stats['config_pushes'] += 1
+
+        self.config = copy.deepcopy(config)
+
+    def set_main_volume(self, volume):
+        """Dispatch main volume if changed."""
+        if volume == self.volume:
+            self.stats['volume_avoided'] += 1
+            return
+        with metrics.timer('cdsp volume'):
+            self.cdsp.volume.set_main_volume(volume)
+        self.volume = volume
+        self.stats['volume_sets'] += 1
+
+    def set_main_mute(self, mute):
+        """Dispatch main mute if changed."""
+        if mute == self.mute:
+            self.stats['mute_avoided'] += 1
+            return
+        with metrics.timer('cdsp mute'):
+            self.cdsp.volume.set_main_mute(mute)
+        self.mute = mute
+        self.stats['mute_sets'] += 1
+
+    def report(self):
+        """Compose a counters report string."""
+        return '\n'.join(
+            f'{key.replace("_", " "):20s}{value:10d}'
+            for key, value in self.stats.items()
+            )
@@ -24,6 +24,7 @@ import sys
 import os
 import time
 import asyncio
+import threading
 
 import yaml
 
@@ -47,6 +48,18 @@ presets = pd.read_yaml(presets_path)
 
 port = config['control_port']
 
+# pre.di.c state settings of interest, kept up to date by subscription.
+predic_state = {}
+
+
+def watch_predic_state():
+    """Mirror pre.di.c source selection."""
+    for event in pd.subscribe(['source'], init.config['control_port']):
+        predic_state[event['key']] = event['new']
+
+
+threading.Thread(target=watch_predic_state, daemon=True).start()
+
 
 async def handle_commands(reader, writer):
     """Read command data."""
@@ -126,7 +139,11 @@ async def handle_commands(reader, writer):
             # if starting predic 'startaudio.py'  makes actual switching
             if not startflag:
                 # check selected source and reconnect to DVB if selected
-                selected_source = pd.get_state()['source']
+                if 'source' in predic_state:
+                    selected_source = predic_state['source']
+                else:
+                    # Subscription not established yet.
+                    selected_source = pd.get_state()['source']
                 if selected_source == config['DVB_source_name']:
                     tmax = init.config['command_delay'] * 10
                     interval = init.config['command_delay'] * 0.1
@@ -136,9 +153,9 @@ async def handle_commands(reader, writer):
                     if pd.wait4source(selected_source, tmax, interval):
                         # source ports up and ready :-)
                         # switch on source
-                        pd.client_socket('sources on',
-                                         init.config['control_port'],
-                                         quiet=True)
+                        pd.client_command('sources on',
+                                          init.config['control_port'],
+                                          quiet=True)
 
         else:
             state['actual'] = state_old['actual']
@@ -7,7 +7,7 @@
 
 import os
 import sys
-import time
+import functools
 import subprocess as sp
 
 import init
@@ -35,7 +35,10 @@ sp.Popen(command.split())
 print('\n(DVB_load) starting DVB server')
 sp.Popen(f'{init.config["python_command"]} {folder}/DVB_server.py'.split())
 
-time.sleep(delay)
+# Wait for DVB server.
+pd.wait4probe(
+    functools.partial(pd.probe_tcp, 'localhost', config['control_port']),
+    delay, name='DVB server')
 if config["play_on_start"]:
     print('\n(DVB_load) starting DVB play')
     pd.client_socket(f'{config["preset"]} startaudio',
@@ -6,12 +6,10 @@
 
 import os
 import time
+import functools
 import subprocess as sp
 import multiprocessing as mp
 
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-
 import mpd
 
 import init
@@ -25,22 +23,6 @@ config_filename = 'config.yml'
 port = init.config['control_port']
 
 
-class Predic_vol_watch(FileSystemEventHandler):
-    """Watch predic volume level."""
-
-    # Initial level for comparison.
-    predic_level = pd.get_state()['level']
-
-    def on_modified(self, event):
-        """Process volume changes."""
-        # Check level changes in pre.di.c.
-        predic_level_old = Predic_vol_watch.predic_level
-        Predic_vol_watch.predic_level = pd.get_state()['level']
-        predic_level = Predic_vol_watch.predic_level
-        if predic_level != predic_level_old:
-            update_mpd_vol(predic_level)
-
-
 def update_mpd_vol(predic_level):
     """Update mpd "fake volume"."""
     mpd_vol = round(predic_level / mpd_conf['level_precision'] 
@@ -74,27 +56,16 @@ def mpd_vol_loop():
         # Update pre.di.c level.
         predic_level = ((mpd_vol - mpd_conf['zerolevel_map']) 
                         * mpd_conf['level_precision'])
-        pd.client_socket("level " + str(predic_level), port, quiet=True)
+        pd.client_command("level " + str(predic_level), port, quiet=True)
     mpd_client.close()
     mpd_client.disconnect()
 
 
 def predic_vol_loop():
     """Read predic volume, sets mpd volume, on loop."""
-    interval = init.config['command_delay'] / 2
-
-    event_handler = Predic_vol_watch()
-    observer = Observer()
-    observer.schedule(event_handler, init.config_folder, recursive=False)
-    observer.start()
-
-    try:
-        while True:
-            time.sleep(interval)
-
-    finally:
-        observer.stop()
-        observer.join()
+    # First event is actual level, that initializes mpd volume.
+    for event in pd.subscribe(['level'], port):
+        update_mpd_vol(event['new'])
 
 
 dir = os.path.dirname(os.path.realpath(__file__))
@@ -104,9 +75,10 @@ print('\n(mpd_load) starting mpd')
 sp.Popen(mpd_conf["mpd_start_command"].split())
 
 delay = init.config['command_delay']*10
-if pd.wait4result(
-        f'echo close|nc localhost {mpd_conf["port"]} 2>/dev/null',
-        'OK MPD', delay):
+if pd.wait4probe(
+        functools.partial(pd.probe_tcp, 'localhost', mpd_conf['port'],
+                          b'close\n', b'OK MPD'),
+        delay, name='mpd'):
     print('\n(mpd_load) mpd started :-)')
 else:
     print('\n(mpd_load) mpd loading failed')
@@ -157,5 +129,3 @@ if mpd_conf['volume_linked']:
     except Exception as e:
         print('\n(mpd_load) predic socket loop broke' +
               f' with exception {e}')
-    # Initialize mpd volume:
-    update_mpd_vol(pd.get_state()['level'])
@@ -0,0 +1,84 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Trace of server commands, for replay.
+
+Trace files are JSON lines. Every file starts with a header holding the
+state at that point, so it can be replayed on its own:
+
+    {"start": <epoch time>, "t": <monotonic time>, "state": {...}}
+
+followed by one line per command:
+
+    {"t": <monotonic time>, "conn": <connection number>,
+     "peer": "<address>:<port>", "cmd": "<command>", "ok": true|false,
+     "lat": <seconds>, "reply": "<reply, truncated>",
+     "set": {<changed setting>: <new value>, ...}}
+
+Files rotate by size: 'trace.jsonl' becomes 'trace.jsonl.1', and so on.
+"""
+
+import json
+import os
+import time
+
+
+class CommandTrace:
+    """Rotating trace file of commands."""
+
+    def __init__(self, path, max_bytes, backups, reply_max, state):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.reply_max = reply_max
+        self.state = state
+        self.file = None
+
+    def open(self):
+        """Start tracing, appending to trace file."""
+        if self.file is not None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a')
+        self.write({'start': time.time(), 't': time.monotonic(),
+                    'state': self.state})
+
+    def close(self):
+        """Stop tracing."""
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+    def write(self, entry):
+        """Write an entry line, rotating files if too big."""
+        self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.file.flush()
+        if self.file.tell() > self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """Shift trace files and start a new one."""
+        self.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{n}'):
+                os.replace(f'{self.path}.{n}', f'{self.path}.{n + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def record(self, t, conn, peer, command, ok, latency, reply, changes):
+        """Write a command entry."""
+        self.write({
+            't': t,
+            'conn': conn,
+            'peer': peer,
+            'cmd': command,
+            'ok': ok,
+            'lat': round(latency, 6),
+            'reply': reply.decode(errors='replace').strip()[:self.reply_max],
+            'set': changes
+            })
@@ -0,0 +1,142 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Folding of bursts of numeric commands, latest wins.
+
+Rotary encoders, remotes and mixer loops send a command per step. When
+a numeric command arrives, it waits a short window, and commands for the
+same setting arriving meanwhile fold into it: an absolute value replaces
+the pending change, 'add' increments are summed up. Values are clamped
+to the setting range after every folded command, as if run one by one.
+A single command with the resulting value is then executed, with
+camilladsp dispatch done once, and every folded client gets its answer,
+with a clamp warning if its own command was clamped.
+
+Only single numeric commands fold. Commands for other settings, batches
+and the rest run as they come, so they can overtake a waiting one.
+"""
+
+import asyncio
+import math
+import time
+
+import baseconfig as base
+import init
+import metrics
+
+
+# Numeric commands that accept 'add', and their range around 0. Level is
+# clamped downstream, by headroom.
+limits = {
+    'level': math.inf,
+    'balance': base.balance_variation,
+    'bass': base.tone_variation,
+    'treble': base.tone_variation,
+    'loudness_ref': base.loudness_ref_variation
+    }
+
+
+def parse(command):
+    """Return (setting, value, add) of a foldable command, or None."""
+    words = command.split()
+    if not 2 <= len(words) <= 3 or words[0] not in limits:
+        return None
+    if words[2:] not in ([], ['add']):
+        return None
+    try:
+        value = float(words[1])
+    except ValueError:
+        return None
+    if not math.isfinite(value):
+        return None
+    return words[0], value, len(words) == 3
+
+
+class Group:
+    """Commands folded into one, with their requests."""
+
+    def __init__(self):
+        # Folded commands as (request, value, add).
+        self.commands = []
+        self.done = asyncio.get_running_loop().create_future()
+        self.task = None
+
+    def fold(self, request, value, add):
+        """Fold a command into the group."""
+        self.commands.append((request, value, add))
+
+    def resolve(self, setting, value):
+        """
+        Apply folded commands to a setting value one by one, clamping.
+        Return resulting value, and clamped values by the requests whose
+        command was clamped.
+        """
+        limit = limits[setting]
+        clamped = {}
+        for request, command_value, add in self.commands:
+            value = command_value + value * add
+            if abs(value) > limit:
+                value = clamped[request] = math.copysign(limit, value)
+        return value, clamped
+
+
+class Coalescer:
+    """Fold numeric commands arriving within a window, by setting."""
+
+    def __init__(self, process, execute, lock, window):
+        # Coroutine functions running a command: (command, request)
+        # returning success and setting request.message. 'process' takes
+        # the lock, 'execute' needs it held.
+        self.process = process
+        self.execute = execute
+        self.lock = lock
+        self.window = window
+        # Groups waiting their window, by setting.
+        self.groups = {}
+
+    async def submit(self, command, request):
+        """Execute a command, folded with others if numeric."""
+        parsed = parse(command) if self.window > 0 else None
+        if parsed is None:
+            return await self.process(command, request)
+        setting, value, add = parsed
+        group = self.groups.get(setting)
+        if group is None:
+            group = self.groups[setting] = Group()
+            group.task = asyncio.create_task(self.run(setting, group))
+        group.fold(request, value, add)
+        # Clients leaving don't cancel others' command.
+        return (await asyncio.shield(group.done))[request]
+
+    async def run(self, setting, group):
+        """Execute a group after its window."""
+        await asyncio.sleep(self.window)
+        # Commands arriving from now on start a new group.
+        del self.groups[setting]
+        metrics.count('coalesced_commands', len(group.commands) - 1)
+        first = group.commands[0][0]
+        try:
+            time_start = time.perf_counter()
+            async with self.lock:
+                metrics.observe('lock wait', time.perf_counter() - time_start)
+                # Folded from the actual value, with no command in between.
+                value, clamped = group.resolve(setting, init.state[setting])
+                success = await self.execute(f'{setting} {value!r}', first)
+        except Exception as e:
+            group.done.set_exception(e)
+            # Retrieved by waiters, if any are left.
+            group.done.exception()
+            return
+        # Every client gets its own outcome, clamped commands fail as
+        # when run alone.
+        outcomes = {}
+        for request, _, _ in group.commands:
+            request.message = first.message
+            outcomes[request] = success
+            if success and request in clamped:
+                request.message = (
+                    f"'{setting}' value clamped: {clamped[request]}")
+                outcomes[request] = False
+        group.done.set_result(outcomes)
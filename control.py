@@ -2,16 +2,27 @@
 # pre.di.c, a preamp and digital crossover
 # Copyright (C) Roberto Ripio
 
-"""Process commands."""
+"""
+Process commands.
 
-import time
-import jack
-import math as m
+Commands changing state or camilladsp config are serialized by 'lock'.
+Command functions run in a worker thread, so blocking jack and camilladsp
+calls don't stall the server, while mute waits are awaited in the event
+loop.
+"""
 
-import numpy as np
+import asyncio
+import copy
+import math as m
+import time
 
 import baseconfig as base
+import cdspsync
+import firassets
 import init
+import jacksession
+import metrics
+import mixertable
 import pdlib as pd
 
 from camilladsp import CamillaClient
@@ -21,18 +32,56 @@ from camilladsp import CamillaClient
 cdsp = CamillaClient("localhost", init.config['websocket_port'])
 cdsp.connect()
 cdsp_config = cdsp.config.active()
+# Dispatch only actual changes to camilladsp.
+sync = cdspsync.ConfigSync(cdsp, cdsp_config)
+metrics.counter_sources.append(sync.stats)
 
+# Preamp mixer matrices for every combination of mixer settings.
+mixer_table = mixertable.MixerTable(
+    cdsp_config['mixers']['m.mixer']['channels']['in'],
+    cdsp_config['mixers']['m.mixer']['channels']['out'])
 
-# Flags
+# Filter files checks, relative to loudspeaker folder as in camilladsp.
+filter_assets = firassets.FilterAssets(init.loudspeaker_path)
 
+# Jack client for the whole server life, with a live registry of ports.
+jack_session = jacksession.JackSession('predic_control')
 
-add = False             # Switch to relative commands.
-do_mute = False         # Mute during command.
+
+# Serialize commands changing state or camilladsp config.
+lock = asyncio.Lock()
 
 # Gets camilladsp setting for volume ramp, and use it for mute waiting.
 ramp_time = cdsp_config['devices']['volume_ramp_time']/1000
 
-message = ''
+
+# Commands allowed in a batch: those changing state but source ones, as
+# jack connections can't be rolled back.
+batch_commands = {
+    'clamp', 'mute', 'level', 'gain', 'loudness_ref', 'bass', 'treble',
+    'balance', 'drc_set', 'eq_filter', 'stereo', 'channels', 'solo', 'drc',
+    'phase_eq', 'loudness', 'tones', 'eq', 'channels_flip', 'polarity',
+    'polarity_flip'
+    }
+
+
+class Request:
+    """Per request state, passed along to command functions."""
+
+    def __init__(self):
+        # Flags
+        self.add = False            # Switch to relative commands.
+        self.do_mute = False        # Mute during command.
+        self.batch = False          # Defer camilladsp dispatch to commit.
+        # Additional waiting while muted, before and after command.
+        self.mute_wait = 0
+        # Last gain requested while in a batch, dispatched on commit.
+        self.pending_gain = None
+        # Jack graph operations performed.
+        self.jack_report = []
+        # Answer for the client.
+        self.message = ''
+
 
 # Exception definitions
 
@@ -54,12 +103,37 @@ class ClampWarning(Warning):
 # Auxiliary functions
 
 
-def disconnect_sources(jack_client):
+@metrics.timed('jack connect')
+def connect_source(source, request):
+    """
+    Connect a source (or none) to predic audio ports.
+
+    Only connections that differ from the actual ones are changed.
+    """
+    audio_ports = set(sum(init.config['audio_ports'], []))
+    current = {connection
+               for connection in jack_session.get_connections()
+               if connection[1] in audio_ports}
+    plan = jacksession.plan_connections(
+        current, pd.source_connections(source))
+    report = []
+    try:
+        report = jack_session.apply(plan)
+    except Exception as e:
+        report = e.report
+        raise
+    finally:
+        request.jack_report.extend(report)
+        if init.config['verbose'] in {1, 2} and report:
+            request.message = '\n'.join(
+                f'{operation} {out_port} {in_port}'
+                for operation, out_port, in_port in report)
+    return report
+
+
+def disconnect_sources(request):
     """Disconnect sources from predic audio ports."""
-    for ports_group in init.config['audio_ports']:
-        for in_port in ports_group:
-            for out_port in jack_client.get_all_connections(in_port):
-                jack_client.disconnect(out_port, in_port)
+    return connect_source(None, request)
 
 
 def toggle(command):
@@ -67,11 +141,8 @@ def toggle(command):
     return {'off': 'on', 'on': 'off'}[init.state[command]]
 
 
-def do_source(source_arg):
+async def do_source(source_arg, request):
     """Process source commands, avoiding muting already selected sources."""
-    global message
-    global do_mute
-
     success = False
 
     sources = init.sources
@@ -79,58 +150,73 @@ def do_source(source_arg):
     if source_arg in sources:
         # Check for already selected source.
         if init.state['source'] == source_arg:
-            message = 'source already selected'
+            request.message = 'source already selected'
         else:
-            do_mute = True
-            success = do_command(source, source_arg)
+            request.do_mute = True
+            # Additional waiting after muting and before unmuting.
+            request.mute_wait = init.config['command_delay'] * 0.5
+            success = await do_command(source, source_arg, request)
     else:
-        message = f"source has to be in : {str(list(sources))}"
+        request.message = f"source has to be in : {str(list(sources))}"
 
     return success
 
 
-def do_command(command, arg):
-    """General command wrapper."""
-    global message
+async def do_command(command, arg, request):
+    """
+    General command wrapper.
 
+    Command functions are called with their argument and the request,
+    in a worker thread.
+    """
     success = False
 
     # Backup state to restore values in case of not enough headroom
     # or error of any kind.
     state_old = init.state.copy()
 
+    muting = request.do_mute and init.config['do_mute'] and not request.batch
+
     if arg:
         try:
-            if do_mute and init.config['do_mute']:
-                cdsp.volume.set_main_mute(True)
-                # 2x volume ramp_time for security (estimated).
-                time.sleep(ramp_time*2)
+            if muting:
+                with metrics.timer('mute'):
+                    await asyncio.to_thread(sync.set_main_mute, True)
+                    # 2x volume ramp_time for security (estimated).
+                    await asyncio.sleep(ramp_time*2 + request.mute_wait)
 
-            command(arg)
+            with metrics.timer(f'control {command.__name__}'):
+                await asyncio.to_thread(command, arg, request)
 
         except ClampWarning as w:
-            message = (f"'{command.__name__}' value clamped: {w.clamp_value}")
+            request.message = (
+                f"'{command.__name__}' value clamped: {w.clamp_value}")
         except OptionsError as e:
             options = str(list(e.options))
-            message = (
+            request.message = (
                 f"'{command.__name__}' options have to be in: {options}")
         except ValueError as e:
-            message = (f"command '{command.__name__}' needs a number: {e}")
+            request.message = (
+                f"command '{command.__name__}' needs a number: {e}")
         except Exception as e:
             # Restore state as it was before command.
             init.state[command.__name__] = state_old[command.__name__]
-            message = (f"exception in command '{command.__name__}': {str(e)}")
+            request.message = (
+                f"exception in command '{command.__name__}': {str(e)}")
         else:
             success = True
         finally:
-            if do_mute and init.config['do_mute']:
-                # 0.8x command_delay to give time for command to finish
-                # (estimated).
-                time.sleep(init.config['command_delay'] * 0.8)
-                mute(init.state['mute'])
+            if muting:
+                with metrics.timer('unmute'):
+                    # 0.8x command_delay to give time for command to
+                    # finish (estimated).
+                    await asyncio.sleep(init.config['command_delay'] * 0.8
+                                        + request.mute_wait)
+                    await asyncio.to_thread(
+                        mute, init.state['mute'], request)
 
     else:
-        message = f"command '{command.__name__}' needs an option"
+        request.message = f"command '{command.__name__}' needs an option"
 
     return success
 
@@ -141,17 +227,17 @@ def do_command(command, arg):
 
 # Numerical commands that accept 'add'.
 
-def level(level):
+def level(level, request):
     """Change level (gain relative to reference_level)."""
     # level clamp is comissioned to set_gain()
-    init.state['level'] = (float(level) + init.state['level'] * add)
+    init.state['level'] = (float(level) + init.state['level'] * request.add)
     gain = pd.calc_gain(init.state['level'])
-    set_gain(gain)
+    set_gain(gain, request)
 
 
 # on/off commands.
 
-def clamp(clamp):
+def clamp(clamp, request):
     """Free gain setting from clamping, useful for playing low level files."""
     options = {'off', 'on', 'toggle'}
     if clamp in options:
@@ -159,19 +245,21 @@ def clamp(clamp):
             clamp = toggle('clamp')
         init.state['clamp'] = clamp
         if init.state['clamp'] == 'on':
-            level(init.state['level'])
+            level(init.state['level'], request)
     else:
         raise OptionsError(options)
 
 
-def mute(mute):
+def mute(mute, request):
     """Mute output."""
     options = {'off', 'on', 'toggle'}
     if mute in options:
         if mute == 'toggle':
             mute = toggle('mute')
         init.state['mute'] = mute
-        cdsp.volume.set_main_mute({'off': False, 'on': True}[mute])
+        # Batches dispatch mute state on commit.
+        if not request.batch:
+            sync.set_main_mute({'off': False, 'on': True}[mute])
     else:
         raise OptionsError(options)
 
@@ -180,10 +268,10 @@ def mute(mute):
 
 # Numerical commands that accept 'add'.
 
-def loudness_ref(loudness_ref):
+def loudness_ref(loudness_ref, request):
     """Select loudness reference level (correction threshold level)."""
     init.state['loudness_ref'] = (float(loudness_ref)
-                                  + init.state['loudness_ref'] * add)
+                                  + init.state['loudness_ref'] * request.add)
 
     # Clamp loudness_ref value.
     if abs(init.state['loudness_ref']) > base.loudness_ref_variation:
@@ -197,9 +285,9 @@ def loudness_ref(loudness_ref):
         pd.calc_gain(init.state['loudness_ref']))
 
 
-def bass(bass):
+def bass(bass, request):
     """Select bass level correction."""
-    init.state['bass'] = float(bass) + init.state['bass'] * add
+    init.state['bass'] = float(bass) + init.state['bass'] * request.add
     # Clamp bass value.
     if m.fabs(init.state['bass']) > base.tone_variation:
         init.state['bass'] = m.copysign(
@@ -209,13 +297,13 @@ def bass(bass):
     cdsp_config['filters']['f.bass']['parameters']['gain'] = (
         init.state['bass']
         )
-    set_gain(pd.calc_gain(init.state['level']))
+    set_gain(pd.calc_gain(init.state['level']), request)
 
 
-def treble(treble):
+def treble(treble, request):
     """Select treble level correction."""
     init.state['treble'] = (float(treble)
-                            + init.state['treble'] * add)
+                            + init.state['treble'] * request.add)
     # Clamp treble value.
     if m.fabs(init.state['treble']) > base.tone_variation:
         init.state['treble'] = m.copysign(
@@ -225,10 +313,10 @@ def treble(treble):
     cdsp_config['filters']['f.treble']['parameters']['gain'] = (
         init.state['treble']
         )
-    set_gain(pd.calc_gain(init.state['level']))
+    set_gain(pd.calc_gain(init.state['level']), request)
 
 
-def balance(balance):
+def balance(balance, request):
     """
     Select balance level.
 
@@ -236,7 +324,7 @@ def balance(balance):
     Deviation of the L channel then goes symmetrical.
     """
     init.state['balance'] = (float(balance)
-                             + init.state['balance'] * add)
+                             + init.state['balance'] * request.add)
     # Clamp balance value.
     if m.fabs(init.state['balance']) > base.balance_variation:
         init.state['balance'] = m.copysign(
@@ -253,116 +341,105 @@ def balance(balance):
     cdsp_config['filters']['f.balance.R']['parameters']['gain'] = (
         atten_dB_r
         )
-    set_gain(pd.calc_gain(init.state['level']))
+    set_gain(pd.calc_gain(init.state['level']), request)
 
 
 # Non numerical commands.
 
-def source(source):
+@metrics.timed('source')
+def source(source, request):
     """Change source."""
-    global message
-
     # Reset clamp to 'on' when changing sources.
     init.state['clamp'] = 'on'
 
-    # Additional waiting after muting.
-    if do_mute and init.config['do_mute']:
-        time.sleep(init.config['command_delay'] * 0.5)
-
-    source_ports = init.sources[source]['source_ports']
-    source_ports_len = len(source_ports)
-    tmp = jack.Client('source_client')
-
-    disconnect_sources(tmp)
     try:
-        for ports_group in init.config['audio_ports']:
-            # Make no more than possible connections,
-            # i.e., minimum of input or output ports.
-            num_ports = min(len(ports_group), source_ports_len)
-            for i in range(num_ports):
-                # Audio sources.
-                tmp.connect(source_ports[i], ports_group[i])
+        connect_source(source, request)
     except Exception as e:
-        message = f'error connecting ports: {e}'
-        sources(init.state['sources'])
+        request.message = f'error connecting ports: {e}'
+        sources(init.state['sources'], request)
         return
     else:
         init.state['source'] = source
-    finally:
-        tmp.close()
 
     # Source change went OK.
-    set_gain(pd.calc_gain(init.state['level']))
+    set_gain(pd.calc_gain(init.state['level']), request)
     # Change phase_eq if configured so.
     if init.config['use_source_phase_eq']:
         # reveal error if 'on'/'off' options lacks quotes in config
         try:
-            phase_eq(init.sources[source]['phase_eq'])
+            phase_eq(init.sources[source]['phase_eq'], request)
         except OptionsError as e:
             options = str(list(e.options))
-            message = (f"'phase_eq' options have to be in : {options}")
+            request.message = (
+                f"'phase_eq' options have to be in : {options}")
+
 
-    # Additional waiting before unmuting.
-    if do_mute and init.config['do_mute']:
-        time.sleep(init.config['command_delay'] * 0.5)
+def drc_set_loaded(drc_set):
+    """Tell if a drc set is the selected one, with its filters loaded."""
+    filters = cdsp_config['filters']
+    return (drc_set in init.drc
+            and drc_set == init.state['drc_set']
+            and filters.get('f.drc.L') == init.drc[drc_set]['f.drc.L']
+            and filters.get('f.drc.R') == init.drc[drc_set]['f.drc.R'])
 
 
-def drc_set(drc_set):
+def drc_set(drc_set, request):
     """Change drc filters."""
     options = init.drc
     if drc_set in options:
+        filters = cdsp_config['filters']
+        # Don't hand broken filter files to camilladsp.
+        filter_assets.validate(init.drc[drc_set])
         init.state['drc_set'] = drc_set
-        cdsp_config['filters']['f.drc.L'] = init.drc[drc_set]['f.drc.L']
-        cdsp_config['filters']['f.drc.R'] = init.drc[drc_set]['f.drc.R']
-        cdsp.config.set_active(cdsp_config)
+        filters['f.drc.L'] = init.drc[drc_set]['f.drc.L']
+        filters['f.drc.R'] = init.drc[drc_set]['f.drc.R']
     else:
         raise OptionsError(options)
 
 
-def eq_filter(eq_filter):
+def eq_filter(eq_filter, request):
     """Select general equalizer filter."""
     options = init.eq
     if eq_filter in options:
         init.state['eq_filter'] = eq_filter
-        cdsp_config['filters']['f.eq'] = init.drc[drc_set]['f.eq']
-        cdsp.config.set_active(cdsp_config)
+        cdsp_config['filters']['f.eq'] = init.eq[eq_filter]['f.eq']
     else:
         raise OptionsError(options)
 
 
-def stereo(stereo):
+def stereo(stereo, request):
     """Change mix to normal stereo, mono, or midside side."""
     options = {'normal', 'mid', 'side'}
     if stereo in options:
         init.state['stereo'] = stereo
-        set_mixer()
+        set_mixer(request)
     else:
         raise OptionsError(options)
 
 
-def channels(channels):
+def channels(channels, request):
     """Select input channels (mixed to both output channels)."""
     options = {'lr', 'l', 'r'}
     if channels in options:
         init.state['channels'] = channels
-        set_mixer()
+        set_mixer(request)
     else:
         raise OptionsError(options)
 
 
-def solo(solo):
+def solo(solo, request):
     """Isolate output channels."""
     options = {'lr', 'l', 'r'}
     if solo in options:
         init.state['solo'] = solo
-        set_mixer()
+        set_mixer(request)
     else:
         raise OptionsError(options)
 
 
 # on/off commands.
 
-def drc(drc):
+def drc(drc, request):
     """Toggle drc."""
     options = {'off', 'on', 'toggle'}
     if drc in options:
@@ -376,7 +453,7 @@ def drc(drc):
         raise OptionsError(options)
 
 
-def phase_eq(phase_eq):
+def phase_eq(phase_eq, request):
     """Toggle phase equalizer."""
     options = {'off', 'on', 'toggle'}
     if phase_eq in options:
@@ -390,7 +467,7 @@ def phase_eq(phase_eq):
         raise OptionsError(options)
 
 
-def loudness(loudness):
+def loudness(loudness, request):
     """Toggle loudness."""
     options = {'off', 'on', 'toggle'}
     if loudness in options:
@@ -404,7 +481,7 @@ def loudness(loudness):
         raise OptionsError(options)
 
 
-def tones(tones):
+def tones(tones, request):
     """Toggle tone controls."""
     options = {'off', 'on', 'toggle'}
     if tones in options:
@@ -418,7 +495,7 @@ def tones(tones):
         raise OptionsError(options)
 
 
-def eq(eq):
+def eq(eq, request):
     """Toggle general equalizer (not linked to a particular speaker)."""
     options = {'off', 'on', 'toggle'}
     if eq in options:
@@ -432,66 +509,61 @@ def eq(eq):
         raise OptionsError(options)
 
 
-def sources(sources):
+def sources(sources, request):
     """Toggle connection of sources."""
-    global message
-
     options = {'off', 'on', 'toggle'}
     if sources in options:
         if sources == 'toggle':
             sources = toggle('sources')
         init.state['sources'] = sources
-        tmp = jack.Client('sources_client')
         match sources:
             case 'off':
-                disconnect_sources(tmp)
-                tmp.close()
+                disconnect_sources(request)
             case 'on':
                 # First check for source ports existence.
                 source_selected = init.state['source']
                 source_ports = init.sources[source_selected]['source_ports']
                 delay = init.config['command_delay'] * 0.1
-                if pd.wait4ports(source_ports, delay):
-                    source(source_selected)
+                if jack_session.wait4ports(source_ports, delay):
+                    source(source_selected, request)
                 else:
-                    message = 'error: source ports are down'
-                tmp.close()
+                    request.message = 'error: source ports are down'
     else:
         raise OptionsError(options)
 
 
-def channels_flip(channels_flip):
+def channels_flip(channels_flip, request):
     """Toggle channels flip."""
     options = {'off', 'on', 'toggle'}
     if channels_flip in options:
         if channels_flip == 'toggle':
             channels_flip = toggle('channels_flip')
         init.state['channels_flip'] = channels_flip
-        set_mixer()
+        set_mixer(request)
     else:
         raise OptionsError(options)
 
 
-def polarity(polarity):
+def polarity(polarity, request):
     """Toggle polarity inversion."""
     options = {'off', 'on', 'toggle'}
     if polarity in options:
         if polarity == 'toggle':
             polarity = toggle('polarity')
         init.state['polarity'] = polarity
-        set_mixer()
+        set_mixer(request)
     else:
         raise OptionsError(options)
 
 
-def polarity_flip(polarity_flip):
+def polarity_flip(polarity_flip, request):
     """Toggle polarity flip (change polarity in one channel only)."""
     options = {'off', 'on', 'toggle'}
     if polarity_flip in options:
         if polarity_flip == 'toggle':
             polarity_flip = toggle('polarity_flip')
         init.state['polarity_flip'] = polarity_flip
-        set_mixer()
+        set_mixer(request)
     else:
         raise OptionsError(options)
 
@@ -501,91 +573,50 @@ def set_bypass(step, arg):
     state = {'off': True, 'on': False}[arg]
 
     for index, element in enumerate(cdsp_config['pipeline']):
-        if element['description'] == step:
+        if element.get('description') == step:
             cdsp_config['pipeline'][index]['bypassed'] = state
 
 
-def set_mixer():
+def set_mixer(request):
     """Set general mixer in camilladsp from state settings."""
-    global message
-
-    mixer = np.identity(2)
-
-    if init.state['channels_flip'] == 'on':
-        mixer = np.array([[0, 1], [1, 0]])
-
-    match init.state['channels']:
-        case 'l':       mixer = mixer @ np.array([[1, 1], [0, 0]])
-        case 'r':       mixer = mixer @ np.array([[0, 0], [1, 1]])
-
-    match init.state['stereo']:
-        case 'mid':     mixer = mixer @ np.array([[0.5, 0.5], [0.5, 0.5]])
-        case 'side':    mixer = mixer @ np.array([[0.5, 0.5], [-0.5, -0.5]])
-
-    if init.state['polarity'] == 'on':
-        mixer = mixer @ np.array([[-1, 0], [0, -1]])
-
-    if init.state['polarity_flip'] == 'on':
-        mixer = mixer @ np.array([[1, 0], [0, -1]])
-
-    match init.state['solo']:
-        case 'l':       mixer = mixer * np.array([[1, 0], [1, 0]])
-        case 'r':       mixer = mixer * np.array([[0, 1], [0, 1]])
-
-    # Gain
-    for sources in range(2):
-        for dest in range(2):
-            if mixer[sources, dest]:
-                (cdsp_config['mixers']['m.mixer']['mapping'][dest]
-                    ['sources'][sources]['gain']) = (
-                        pd.gain_dB(abs(mixer[sources, dest]))
-                        )
-            else:
-                (cdsp_config['mixers']['m.mixer']['mapping'][dest]
-                    ['sources'][sources]['gain']) = (
-                        0
-                        )
-
-    # Inverted
-    for sources in range(2):
-        for dest in range(2):
-            (cdsp_config['mixers']['m.mixer']['mapping'][dest]
-                ['sources'][sources]['inverted']) = (
-                    bool(mixer[sources, dest] < 0)
-                    )
-
-    # Mute
-    for sources in range(2):
-        for dest in range(2):
-            (cdsp_config['mixers']['m.mixer']['mapping'][dest]
-                ['sources'][sources]['mute']) = (
-                    not bool(mixer[sources, dest])
-                    )
+    mixer = mixer_table.apply(cdsp_config['mixers']['m.mixer'], init.state)
 
     # For debug
     if init.config['verbose'] in {1, 2}:
-        message = f'mixer matrix : \n{mixer}'
+        request.message = f'mixer matrix : \n{mixer}'
+
+
+def filters_report():
+    """Compose a report of drc sets and loudspeaker filter files."""
+    filter_sets = {f'drc_set {name}': filters
+                   for name, filters in init.drc.items()}
+    filter_sets['loudspeaker'] = init.speaker['filters']
+    return filter_assets.report(
+        filter_sets, init.speaker['devices']['samplerate'])
 
 
-def set_gain(gain):
+@metrics.timed('set_gain')
+def set_gain(gain, request):
     """
     Set_gain, aka 'the volume machine'.
 
     Gain is clamped to avoid positive gain,
     considering balance, tones and source gain shift.
     """
-    global message
-
     # Gain command send its str argument directly.
     gain = float(gain)
+    # Batches check headroom and dispatch volume once, on commit.
+    if request.batch:
+        request.pending_gain = gain
+        return
     # Clamp gain value.
     # Just for information, numerical bounds before math range or
     # math domain error are +6165 dB and -6472 dB.
     # Max gain is clamped downstream when calculating headroom.
     if gain < base.gain_min:
         gain = base.gain_min
-        message = (f'min. gain must be more than {base.gain_min} ' +
-                   + 'dB\ngain clamped')
+        request.message = (f'min. gain must be more than {base.gain_min} '
+                           + 'dB\ngain clamped')
     # Calculate headroom and clamp gain if clamp_gain allows to do so.
     if init.state['clamp'] == 'on':
         headroom = pd.calc_headroom(gain)
@@ -595,26 +626,31 @@ def set_gain(gain):
         # If enough headroom commit changes.
         # Since there is no init.state['gain'] we set init.state['level'].
         if headroom >= 0:
-            cdsp.volume.set_main_volume(real_gain)
+            sync.set_main_volume(real_gain)
             init.state['level'] = pd.calc_level(gain)
         # If not enough headroom tries lowering gain.
         else:
-            set_gain(gain + headroom)
-            message = 'headroom hit, lowering gain...'
+            set_gain(gain + headroom, request)
+            request.message = 'headroom hit, lowering gain...'
     else:
-        cdsp.volume.set_main_volume(gain)
+        sync.set_main_volume(gain)
+
 
+# Main command proccessing functions.
 
-# Main command proccessing function.
-def proccess_commands(full_command):
+async def proccess_commands(full_command, request):
     """Procces commands for predic control."""
-    global cdsp             # let camilladsp connection be accesible
-    global add
-    global do_mute
-    global message
+    time_start = time.perf_counter()
+    async with lock:
+        metrics.observe('lock wait', time.perf_counter() - time_start)
+        return await execute_command(full_command, request)
 
-    add = False
-    do_mute = False
+
+async def execute_command(full_command, request):
+    """Execute a command. Caller must hold 'lock'."""
+    request.add = False
+    request.do_mute = False
+    request.mute_wait = 0
     success = False
 
     # Strips command final characters and split command from arguments.
@@ -629,14 +665,14 @@ def proccess_commands(full_command):
         arg = None
     if len(full_command) > 2:
         if full_command[2] == 'add':
-            add = True
+            request.add = True
 
     # Parse  commands and select corresponding actions.
     try:
         # Commands that do not depend on camilladsp config.
 
         if command in {'clamp', 'mute', 'level', 'gain'}:
-            success = do_command(
+            success = await do_command(
              {
                 # Numerical commands that accept 'add'.
                 'level':            level,          # [level] add
@@ -645,31 +681,40 @@ def proccess_commands(full_command):
                 'mute':             mute,           # ['off','on','toggle']
                 # Special utility command.
                 'gain':             set_gain        # [gain]
-                }[command], arg)
+                }[command], arg, request)
 
         # Commands that depend on camilladsp config.
 
         elif command == 'source':
-            success = do_source(arg)                # [source]
+            success = await do_source(arg, request)     # [source]
             # Dispatch config.
-            cdsp.config.set_active(cdsp_config)
+            if not request.batch:
+                await asyncio.to_thread(sync.set_active, cdsp_config)
 
         elif command in {'loudness_ref', 'bass', 'treble', 'balance'}:
-            success = do_command(
+            success = await do_command(
              {
                 # Numerical commands that accept 'add'.
                 'loudness_ref':     loudness_ref,   # [loudness_ref] add
                 'bass':             bass,           # [bass] add
                 'treble':           treble,         # [treble] add
                 'balance':          balance,        # [balance] add
-                }[command], arg)
+                }[command], arg, request)
             # Dispatch config.
-            cdsp.config.set_active(cdsp_config)
+            if not request.batch:
+                await asyncio.to_thread(sync.set_active, cdsp_config)
+
+        elif command == 'drc_set' and drc_set_loaded(arg):
+            # Already loaded, nothing to reload nor mute for.
+            success = True
 
         else:
             # These commands benefit for silencing switching noise.
-            do_mute = True
-            success = do_command(
+            request.do_mute = True
+            if command == 'sources':
+                # Additional waiting for source switching.
+                request.mute_wait = init.config['command_delay'] * 0.5
+            success = await do_command(
              {
                 # Non numerical commands.
                 'drc_set':          drc_set,        # [drc_set]
@@ -688,13 +733,132 @@ def proccess_commands(full_command):
                 'channels_flip':    channels_flip,  # ['off','on','toggle']
                 'polarity':         polarity,       # ['off','on','toggle']
                 'polarity_flip':    polarity_flip   # ['off','on','toggle']
-                }[command], arg)
+                }[command], arg, request)
             # Dispatch config.
-            cdsp.config.set_active(cdsp_config)
+            if not request.batch:
+                await asyncio.to_thread(sync.set_active, cdsp_config)
 
     except KeyError:
-        message = f"unknown command '{command}'"
+        request.message = f"unknown command '{command}'"
 
     return success
 
-# End of proccess_commands().
+# End of execute_command().
+
+
+def dispatch_batch(request):
+    """Dispatch config and volume changed by a batch."""
+    sync.set_active(cdsp_config)
+    if request.pending_gain is not None:
+        request.batch = False
+        set_gain(request.pending_gain, request)
+
+
+async def proccess_batch(full_commands, request):
+    """
+    Procces a list of commands as a single transaction.
+
+    Changes are applied to state and camilladsp config, then headroom is
+    checked and config and volume are dispatched once. If any command
+    fails the whole batch is rolled back.
+    """
+    time_start = time.perf_counter()
+    async with lock:
+        metrics.observe('lock wait', time.perf_counter() - time_start)
+        # Backup state and config for rollback.
+        state_old = copy.deepcopy(init.state)
+        cdsp_config_old = copy.deepcopy(cdsp_config)
+
+        messages = []
+        # Mute while dispatching if any command benefits from it.
+        batch_mute = False
+        success = True
+
+        request.batch = True
+        request.pending_gain = None
+        for full_command in full_commands:
+            if not full_command.strip():
+                continue
+            command = full_command.split()[0]
+            if command not in batch_commands:
+                request.message = (
+                    f"command '{command}' not allowed in a batch")
+                success = False
+            else:
+                success = await execute_command(full_command, request)
+                batch_mute = batch_mute or request.do_mute
+            if request.message:
+                messages.append(request.message)
+            request.message = ''
+            if not success:
+                break
+
+        dispatched = False
+        muting = batch_mute and init.config['do_mute']
+        if success:
+            try:
+                if muting:
+                    with metrics.timer('mute'):
+                        await asyncio.to_thread(sync.set_main_mute, True)
+                        # 2x volume ramp_time for security (estimated).
+                        await asyncio.sleep(ramp_time*2)
+                dispatched = True
+                await asyncio.to_thread(dispatch_batch, request)
+                if request.message:
+                    messages.append(request.message)
+            except Exception as e:
+                messages.append(f'exception dispatching batch: {str(e)}')
+                success = False
+            finally:
+                request.batch = False
+                if muting or init.state['mute'] != state_old['mute']:
+                    await asyncio.to_thread(
+                        mute, init.state['mute'], request)
+        request.batch = False
+
+        if not success:
+            # Restore in place, since state and config are shared.
+            init.state.clear()
+            init.state.update(state_old)
+            cdsp_config.clear()
+            cdsp_config.update(cdsp_config_old)
+            mixer_table.forget()
+            if dispatched:
+                try:
+                    await asyncio.to_thread(sync.set_active, cdsp_config)
+                    await asyncio.to_thread(
+                        set_gain, pd.calc_gain(init.state['level']), request)
+                    await asyncio.to_thread(
+                        mute, init.state['mute'], request)
+                except Exception as e:
+                    messages.append(f'exception restoring config: {str(e)}')
+            messages.append('batch rolled back')
+
+        request.message = '\n'.join(messages)
+        return success
+
+
+async def proccess_restore(settings, request):
+    """
+    Apply a dictionary of settings as a single batch.
+
+    Only settings in pdlib.restore_settings are accepted.
+    """
+    if not isinstance(settings, dict):
+        request.message = 'settings have to be a mapping'
+        return False
+    unknown = set(settings) - set(pd.restore_settings)
+    if unknown:
+        request.message = f'settings not restorable: {sorted(unknown)}'
+        return False
+
+    commands = []
+    for setting in pd.restore_settings:
+        if setting in settings:
+            value = settings[setting]
+            # Bare YAML on/off load as booleans.
+            if isinstance(value, bool):
+                value = {False: 'off', True: 'on'}[value]
+            commands.append(f'{setting} {value}')
+
+    return await proccess_batch(commands, request)
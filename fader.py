@@ -0,0 +1,150 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Timed level trajectories: fades and sleep timer.
+
+A trajectory runs as a task on the event loop, setting level in steps
+through the regular 'level' command, so headroom clamping applies and
+other commands run in between. Steps are at most one per interval.
+
+Only one trajectory runs at a time, a new one replaces it. It stops if
+level is changed by someone else meanwhile.
+"""
+
+import asyncio
+import math
+import time
+
+import baseconfig as base
+import control
+import init
+
+
+# Level along a trajectory from 'start' to 'target' level (dB), at
+# fraction 'x' of its duration.
+curves = {
+    # Linear in dB.
+    'linear': lambda start, target, x: start + (target - start) * x,
+    # Linear in dB, easing in and out.
+    'smooth': lambda start, target, x: (
+        start + (target - start) * (1 - math.cos(math.pi * x)) / 2),
+    # Linear in amplitude, slow at the low end.
+    'power': lambda start, target, x: 20 * math.log10(
+        10**(start / 20) + (10**(target / 20) - 10**(start / 20)) * x)
+    }
+
+
+class LevelTaken(Exception):
+    """Level changed by another command during a trajectory."""
+
+
+class Fader:
+    """Runs a level trajectory at a time."""
+
+    def __init__(self, changed, interval=0.1):
+        # Called after every step, to publish state changes.
+        self.changed = changed
+        self.interval = interval
+        self.task = None
+        self.description = ''
+        # Level set by last step.
+        self.level = None
+
+    def running(self):
+        """Tell if a trajectory is running."""
+        return self.task is not None and not self.task.done()
+
+    def status(self):
+        """Describe the running trajectory."""
+        return self.description if self.running() else 'no fade running'
+
+    def start(self, coroutine, description):
+        """Run a trajectory, replacing the running one."""
+        self.stop()
+        self.description = description
+        self.task = asyncio.create_task(self.guard(coroutine))
+
+    def stop(self):
+        """Cancel the running trajectory. Tell if there was one."""
+        if not self.running():
+            return False
+        self.task.cancel()
+        self.task = None
+        return True
+
+    def fade(self, target, seconds, curve='linear'):
+        """Start a fade to a level."""
+        if curve not in curves:
+            raise Exception(f'curve has to be in: {list(curves)}')
+        if not math.isfinite(target):
+            raise Exception('fade target has to be a level')
+        if not 0 <= seconds < math.inf:
+            raise Exception('fade time has to be a positive number')
+        self.start(self.run_fade(target, seconds, curve),
+                   f'fading to {target:g} in {seconds:g} s, {curve}')
+
+    def sleep(self, minutes):
+        """Start a sleep timer."""
+        if not 0 <= minutes < math.inf:
+            raise Exception('sleep time has to be a positive number')
+        fade_start = time.time() + minutes * 60
+        self.start(self.run_sleep(minutes * 60),
+                   'sleeping at ' + time.strftime(
+                       '%H:%M:%S', time.localtime(fade_start)))
+
+    async def guard(self, coroutine):
+        """Run a trajectory, reporting why it ended."""
+        try:
+            await coroutine
+        except LevelTaken:
+            print('(fader) level changed, fade stopped')
+        except Exception as e:
+            print(f'(fader) fade failed: {e}')
+
+    async def command(self, command):
+        """Run a command, publishing state changes."""
+        request = control.Request()
+        running = asyncio.ensure_future(
+            control.proccess_commands(command, request))
+        try:
+            # Stopping a trajectory doesn't break a command halfway.
+            success = await asyncio.shield(running)
+        except asyncio.CancelledError:
+            await running
+            self.changed()
+            raise
+        self.changed()
+        if not success:
+            raise Exception(request.message)
+
+    async def set_level(self, level):
+        """Set a trajectory step."""
+        if self.level is not None and init.state['level'] != self.level:
+            raise LevelTaken
+        await self.command(f'level {round(level, 2)}')
+        # Level clamped by headroom, if so.
+        self.level = init.state['level']
+
+    async def run_fade(self, target, seconds, curve):
+        """Move level to a target along a curve."""
+        start = init.state['level']
+        self.level = start
+        steps = max(1, math.ceil(seconds / self.interval))
+        loop = asyncio.get_running_loop()
+        time_start = loop.time()
+        for step in range(1, steps + 1):
+            await asyncio.sleep(
+                time_start + seconds * step / steps - loop.time())
+            await self.set_level(curves[curve](start, target, step / steps))
+
+    async def run_sleep(self, seconds):
+        """Wait, fade out and mute, then restore level, muted."""
+        await asyncio.sleep(seconds)
+        start = init.state['level']
+        await self.run_fade(start - base.sleep_attenuation,
+                            base.sleep_fade_time, 'linear')
+        await self.command('mute on')
+        await self.command(f'level {start}')
+        print('(fader) sleeping')
@@ -0,0 +1,173 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Validation of FIR filter files used by camilladsp Conv filters.
+
+Raw filter files are memory mapped and checked for size alignment,
+finite samples, and sensible peak and energy. Results are cached by file
+checksum, so unchanged files are not scanned again, even across runs.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+import baseconfig as base
+
+
+# Raw sample formats and their numpy types, with full scale value.
+raw_formats = {
+    'FLOAT32LE': ('<f4', 1),
+    'FLOAT64LE': ('<f8', 1),
+    'S16LE': ('<i2', 2**15),
+    'S32LE': ('<i4', 2**31)
+    }
+
+
+# Filter file check results. Latency is the peak position in samples.
+FilterInfo = collections.namedtuple(
+    'FilterInfo', 'length latency peak energy error')
+
+
+def scan(path, raw_format):
+    """Map a raw filter file and check its samples. Return FilterInfo."""
+    dtype, full_scale = raw_formats[raw_format]
+    itemsize = np.dtype(dtype).itemsize
+    size = os.path.getsize(path)
+    if size == 0:
+        return FilterInfo(0, 0, 0, 0, 'empty file')
+    if size % itemsize:
+        return FilterInfo(size // itemsize, 0, 0, 0,
+                          f'size not multiple of {itemsize} bytes')
+
+    samples = np.memmap(path, dtype=dtype, mode='r')
+    length = len(samples)
+    if not np.isfinite(samples).all():
+        return FilterInfo(length, 0, 0, 0, 'non finite samples')
+    magnitude = np.abs(samples)
+    latency = int(np.argmax(magnitude))
+    peak = float(magnitude[latency]) / full_scale
+    energy = (float(np.square(samples, dtype=np.float64).sum())
+              / full_scale**2)
+
+    error = None
+    if peak == 0:
+        error = 'silent filter'
+    elif 20 * np.log10(peak) > base.fir_peak_max:
+        error = f'peak over {base.fir_peak_max} dB'
+    return FilterInfo(length, latency, peak, energy, error)
+
+
+def checksum(path):
+    """Return checksum of file contents."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(2**20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FilterAssets:
+    """
+    Check filter files, relative to a folder, caching results.
+
+    Cache is a JSON file in the folder, with file checksums by path and
+    stamp, and check results by checksum.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.cache_path = f'{folder}/{base.fir_cache_filename}'
+        self.lock = threading.Lock()
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            self.checksums = cache['checksums']
+            self.results = {key: FilterInfo(*value)
+                            for key, value in cache['results'].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            self.checksums = {}
+            self.results = {}
+
+    def save(self):
+        """Write cache, ignoring failures."""
+        cache = {'checksums': self.checksums,
+                 'results': {key: list(value)
+                             for key, value in self.results.items()}}
+        try:
+            tmp_path = f'{self.cache_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+    def check_file(self, filename, raw_format):
+        """Return FilterInfo for a filter file, from cache if unchanged."""
+        path = os.path.join(self.folder, filename)
+        with self.lock:
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                return FilterInfo(0, 0, 0, 0, e.strerror.lower())
+            stamp = [stat.st_mtime_ns, stat.st_size]
+            cached = self.checksums.get(path)
+            if cached is not None and cached[0] == stamp:
+                digest = cached[1]
+            else:
+                digest = checksum(path)
+                self.checksums[path] = [stamp, digest]
+            key = f'{digest}:{raw_format}'
+            if key not in self.results:
+                self.results[key] = scan(path, raw_format)
+                self.save()
+            elif cached is None or cached[0] != stamp:
+                self.save()
+            return self.results[key]
+
+    def check_filter(self, filter_config):
+        """
+        Return FilterInfo for a camilladsp filter, or None if it is not
+        a Conv filter with a raw file in a known format.
+        """
+        parameters = filter_config.get('parameters') or {}
+        if (filter_config.get('type') != 'Conv'
+                or parameters.get('type') != 'Raw'
+                or parameters.get('format', 'FLOAT32LE') not in raw_formats):
+            return None
+        return self.check_file(parameters['filename'],
+                               parameters.get('format', 'FLOAT32LE'))
+
+    def validate(self, filters):
+        """Raise an exception if any filter in a filters dict is wrong."""
+        for name, filter_config in filters.items():
+            info = self.check_filter(filter_config)
+            if info is not None and info.error:
+                raise Exception(f'filter {name}: {info.error}')
+
+    def report(self, filter_sets, fs):
+        """
+        Compose a report string of filters by set.
+
+        'filter_sets' is a dictionary of filters dicts by set name.
+        """
+        lines = []
+        for set_name, filters in filter_sets.items():
+            lines.append(f'{set_name}:')
+            for name, filter_config in filters.items():
+                info = self.check_filter(filter_config)
+                if info is None:
+                    continue
+                peak = 20 * np.log10(info.peak) if info.peak else -np.inf
+                lines.append(
+                    f'    {name:20s}{info.length:8d} taps'
+                    f'{info.latency / fs * 1000:10.2f} ms'
+                    f'{peak:8.1f} dB peak'
+                    f'    {info.error or "ok"}')
+        return '\n'.join(lines)
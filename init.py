@@ -4,18 +4,26 @@
 
 """Initial code."""
 
+import hashlib
 import os
+import pickle
 import sys
 
 import yaml
 
 import baseconfig as base
+import statestore
+
+
+# Use libyaml bindings when available, they are much faster.
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+yaml_dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
 
 
 def get_configs(filepath):
     """Return dictionary from yaml config file."""
     with open(filepath) as configfile:
-        config_dict = yaml.safe_load(configfile)
+        config_dict = yaml.load(configfile, Loader=yaml_loader)
 
     return config_dict
 
@@ -28,14 +36,18 @@ main_folder = os.path.dirname(__file__)
 config_folder = f'{main_folder}/{base.config_folder}'
 clients_folder = f'{main_folder}/{base.clients_folder}'
 loudspeakers_folder = f'{main_folder}/{base.loudspeakers_folder}'
+profiles_folder = f'{main_folder}/{base.profiles_folder}'
+traces_folder = f'{main_folder}/{base.traces_folder}'
 
 config_path = f'{config_folder}/{base.config_filename}'
 state_path = f'{config_folder}/{base.state_filename}'
+state_journal_path = f'{config_folder}/{base.state_journal_filename}'
 state_init_path = f'{config_folder}/{base.state_init_filename}'
 sources_path = f'{config_folder}/{base.sources_filename}'
 clients_path = f'{config_folder}/{base.clients_filename}'
 eq_path = f'{config_folder}/{base.eq_filename}'
 camilladsp_path = f'{config_folder}/{base.camilladsp_filename}'
+cache_path = f'{config_folder}/{base.init_cache_filename}'
 
 # We still don't know the loudspeaker name, so speaker_path
 # is built downstream.
@@ -43,33 +55,122 @@ camilladsp_path = f'{config_folder}/{base.camilladsp_filename}'
 
 # dictionaries
 
-try:
+def cache_stamp(path):
+    """Return (mtime, size) of a file, for cache validation."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
 
-    config = get_configs(config_path)
-    sources = get_configs(sources_path)
-    state = get_configs(state_path)
-    state_init = get_configs(state_init_path)
-    eq = get_configs(eq_path)
-    camilladsp = get_configs(camilladsp_path)
+
+def cache_digest(path):
+    """Return hash of a file contents, for cache validation."""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_configs():
+    """
+    Read config files and post-process them.
+
+    Return a tuple (configs, paths) with a dictionary of configs by name,
+    and the list of files read.
+    """
+    configs = {}
+    paths = [config_path, sources_path, state_init_path, eq_path,
+             camilladsp_path]
+    configs['config'] = get_configs(config_path)
+    configs['sources'] = get_configs(sources_path)
+    configs['state_init'] = get_configs(state_init_path)
+    configs['eq'] = get_configs(eq_path)
+    configs['camilladsp'] = get_configs(camilladsp_path)
 
     # After knowing which speaker config to load, load it.
-    loudspeaker_path = f'{loudspeakers_folder}/{config["loudspeaker"]}'
-    speaker = get_configs(loudspeaker_path + '/' + base.loudspeaker_filename)
-    drc = get_configs(loudspeaker_path + '/' + base.drc_filename)
+    speaker_folder = (f'{loudspeakers_folder}/'
+                      f'{configs["config"]["loudspeaker"]}')
+    speaker_path = f'{speaker_folder}/{base.loudspeaker_filename}'
+    drc_path = f'{speaker_folder}/{base.drc_filename}'
+    paths += [speaker_path, drc_path]
+    configs['speaker'] = get_configs(speaker_path)
+    configs['drc'] = get_configs(drc_path)
+
+    # Some processing of data for downstream easyer use
+    # while retaining upstream ease of writing in config files.
+
+    # Audio ports
+    # Turn string space separated enumerations into lists.
+    configs['config']['audio_ports'] = [
+        port.split() for port in configs['config']['audio_ports']]
+
+    # source ports
+    # turn string space separated enumerations into lists
+    sources = configs['sources']
+    for source in sources:
+        sources[source]['source_ports'] = (
+            sources[source]['source_ports'].split())
+
+    return configs, paths
+
+
+def load_cache():
+    """Return cached configs, or None if missing or outdated."""
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['version'] != base.init_cache_version:
+            return None
+        touched = False
+        for path, (stamp, digest) in cache['files'].items():
+            if cache_stamp(path) != stamp:
+                # Touched files with same contents are still valid.
+                if cache_digest(path) != digest:
+                    return None
+                touched = True
+        if touched:
+            save_cache(cache['configs'], cache['files'])
+        return cache['configs']
+    except Exception:
+        return None
+
+
+def save_cache(configs, paths):
+    """Write configs cache, keyed by stamp and hash of source files."""
+    cache = {
+        'version': base.init_cache_version,
+        'files': {path: (cache_stamp(path), cache_digest(path))
+                  for path in paths},
+        'configs': configs
+        }
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Read only config folder, just go without cache.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-except Exception as e:
-    print(f'\n(init) Error getting configurations: {e}')
-    sys.exit()
 
+try:
 
-# Some processing of data for downstream easyer use
-# while retaining upstream ease of writing in config files.
+    configs = load_cache()
+    if configs is None:
+        configs, paths = read_configs()
+        save_cache(configs, paths)
+
+    config = configs['config']
+    sources = configs['sources']
+    state_init = configs['state_init']
+    eq = configs['eq']
+    camilladsp = configs['camilladsp']
+    speaker = configs['speaker']
+    drc = configs['drc']
+    loudspeaker_path = f'{loudspeakers_folder}/{config["loudspeaker"]}'
 
-# Audio ports
-# Turn string space separated enumerations into lists.
-config['audio_ports'] = [port.split() for port in config['audio_ports']]
+    # State changes all the time, so it is not cached.
+    state = get_configs(state_path)
+    # Apply changes journaled after last state file write.
+    statestore.replay_journal(state, state_journal_path)
 
-# source ports
-# turn string space separated enumerations into lists
-for source in sources:
-    sources[source]['source_ports'] = sources[source]['source_ports'].split()
+except Exception as e:
+    print(f'\n(init) Error getting configurations: {e}')
+    sys.exit()
@@ -0,0 +1,356 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Pluggable jack backend.
+
+Jack clients are opened through Client(), from the backend in use: the
+jack module itself, or FakeJack, an in memory jack graph for testing and
+benchmarking on machines without jack server.
+
+The fake backend is used if PREDIC_FAKE_JACK environment variable names
+a script file (see FakeJack.from_script()). Every process has its own
+fake graph. Code can also plug a backend with use().
+"""
+
+import collections
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+import yaml
+
+
+# Backend in use, set on first client unless plugged with use().
+backend = None
+
+
+def use(new_backend):
+    """Plug a backend, the jack module or a FakeJack instance."""
+    global backend
+    backend = new_backend
+
+
+def get_backend():
+    """Return backend in use, choosing it if not yet set."""
+    global backend
+    if backend is None:
+        script = os.environ.get('PREDIC_FAKE_JACK')
+        if script:
+            backend = FakeJack.from_script(script)
+        else:
+            import jack
+            backend = jack
+    return backend
+
+
+def is_fake():
+    """Tell if backend in use is a fake one."""
+    return isinstance(get_backend(), FakeJack)
+
+
+def Client(name, **kwargs):
+    """Open a jack client, with jack.Client() arguments."""
+    return get_backend().Client(name, **kwargs)
+
+
+# Fake jack.
+
+
+class FakeJackError(Exception):
+    """Failed fake jack operation, as jack.JackError."""
+
+
+# Port as seen by clients, a subset of jack.Port.
+FakePort = collections.namedtuple('FakePort', 'name is_output')
+
+
+def port_name(port):
+    """Return name of a port given by name or port object."""
+    return port if isinstance(port, str) else port.name
+
+
+class FakeClient:
+    """Fake jack client, with the jack.Client methods pre.di.c uses."""
+
+    def __init__(self, fake, name):
+        self.fake = fake
+        self.name = name
+        self.active = False
+        self.closed = False
+        # Callbacks by kind: 'registration', 'connect', 'shutdown'.
+        self.callbacks = {}
+
+    def set_port_registration_callback(self, callback, only_available=True):
+        self.callbacks['registration'] = callback
+
+    def set_port_connect_callback(self, callback, only_available=True):
+        self.callbacks['connect'] = callback
+
+    def set_shutdown_callback(self, callback):
+        self.callbacks['shutdown'] = callback
+
+    def activate(self):
+        self.active = True
+
+    def deactivate(self):
+        self.active = False
+
+    def close(self):
+        self.active = False
+        self.closed = True
+        self.fake.drop_client(self)
+
+    def get_ports(self, name_pattern='', is_audio=False, is_midi=False,
+                  is_input=False, is_output=False, **kwargs):
+        return self.fake.get_ports(name_pattern, is_input, is_output)
+
+    def get_all_connections(self, port):
+        return self.fake.get_all_connections(port_name(port))
+
+    def connect(self, source, destination):
+        self.fake.connect(port_name(source), port_name(destination))
+
+    def disconnect(self, source, destination):
+        self.fake.disconnect(port_name(source), port_name(destination))
+
+
+class FakeJack:
+    """
+    In memory jack graph, standing for the jack module.
+
+    Clients of the graph (players, camilladsp...) are added as groups of
+    ports, right away or after a delay, and can come and go periodically
+    (churn). Graph operations can be slowed down, and can fail at a given
+    rate. Every operation is counted in 'calls'.
+
+    Notifications are delivered to client callbacks in a separate thread,
+    as jack does.
+    """
+
+    JackError = FakeJackError
+
+    def __init__(self, seed=0):
+        # Guards graph.
+        self.lock = threading.Lock()
+        # Ports by name.
+        self.ports = {}
+        # Connections as (output port name, input port name) tuples.
+        self.connections = set()
+        # Open clients.
+        self.clients = []
+        # Failure probability by operation.
+        self.failures = {}
+        # Seconds taken by operation.
+        self.latency = {}
+        self.random = random.Random(seed)
+        # Count of calls by operation.
+        self.calls = collections.Counter()
+        self.timers = []
+        self.notifications = queue.Queue()
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+    @classmethod
+    def from_script(cls, path):
+        """
+        Create a fake graph from a YAML script file, e.g.:
+
+            seed: 0
+            failures: {connect: 0.05}       # failure rate by operation
+            latency: {connect: 0.001}       # seconds by operation
+            clients:
+              - name: system
+                outputs: [capture_1, capture_2]
+                inputs: [playback_1, playback_2]
+              - name: mpd_jack
+                outputs: [L, R]
+                delay: 2                    # seconds to appear
+                churn: {up: 10, down: 1}    # seconds up and down
+
+        Failing operations are 'open', 'connect' and 'disconnect'.
+        """
+        with open(path) as f:
+            script = yaml.safe_load(f) or {}
+        fake = cls(script.get('seed', 0))
+        fake.failures.update(script.get('failures') or {})
+        fake.latency.update(script.get('latency') or {})
+        for client in script.get('clients') or []:
+            ports = (client.get('outputs', []), client.get('inputs', []))
+            churn = client.get('churn')
+            if churn:
+                fake.churn(client['name'], *ports, churn['up'], churn['down'],
+                           client.get('delay', 0))
+            else:
+                fake.add_client(client['name'], *ports,
+                                client.get('delay', 0))
+        return fake
+
+    # Notifications.
+
+    def dispatch(self):
+        """Deliver notifications to client callbacks, forever."""
+        while True:
+            client, kind, args = self.notifications.get()
+            callback = client.callbacks.get(kind)
+            if callback is not None:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(f'\n(jackbackend) error in {kind} callback: {e}')
+
+    def notify(self, kind, *args):
+        """Queue a notification for active clients. Hold 'lock'."""
+        for client in self.clients:
+            if client.active:
+                self.notifications.put((client, kind, args))
+
+    # Operations.
+
+    def operation(self, name):
+        """Count, delay, and possibly fail an operation."""
+        delay = self.latency.get(name, 0)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.calls[name] += 1
+            failed = self.random.random() < self.failures.get(name, 0)
+            if failed:
+                self.calls[f'{name} failed'] += 1
+        if failed:
+            raise FakeJackError(f'{name} failed (injected)')
+
+    def Client(self, name, no_start_server=False, **kwargs):
+        """Open a client, as jack.Client()."""
+        self.operation('open')
+        client = FakeClient(self, name)
+        with self.lock:
+            self.clients.append(client)
+        return client
+
+    def drop_client(self, client):
+        """Forget a closed client."""
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def get_ports(self, name_pattern='', is_input=False, is_output=False):
+        """Return ports matching a regex and direction."""
+        self.operation('get_ports')
+        pattern = re.compile(name_pattern)
+        with self.lock:
+            return [port for port in self.ports.values()
+                    if pattern.search(port.name)
+                    and not (is_output and not port.is_output)
+                    and not (is_input and port.is_output)]
+
+    def get_all_connections(self, name):
+        """Return ports connected to a port."""
+        self.operation('get_all_connections')
+        with self.lock:
+            if name not in self.ports:
+                raise FakeJackError(f'port {name} not found')
+            return [self.ports[a if b == name else b]
+                    for a, b in self.connections if name in (a, b)]
+
+    def connect(self, out_port, in_port):
+        """Connect an output port to an input port."""
+        self.operation('connect')
+        with self.lock:
+            source = self.ports.get(out_port)
+            destination = self.ports.get(in_port)
+            if (source is None or destination is None
+                    or not source.is_output or destination.is_output):
+                raise FakeJackError(
+                    f'cannot connect {out_port} to {in_port}')
+            if (out_port, in_port) not in self.connections:
+                self.connections.add((out_port, in_port))
+                self.notify('connect', source, destination, True)
+
+    def disconnect(self, out_port, in_port):
+        """Disconnect an output port from an input port."""
+        self.operation('disconnect')
+        with self.lock:
+            if (out_port, in_port) not in self.connections:
+                raise FakeJackError(
+                    f'{out_port} is not connected to {in_port}')
+            self.connections.discard((out_port, in_port))
+            self.notify('connect', self.ports[out_port],
+                        self.ports[in_port], False)
+
+    # Graph scripting.
+
+    def schedule(self, delay, action, *args):
+        """Run an action after a delay, or right away."""
+        if delay <= 0:
+            action(*args)
+            return
+        timer = threading.Timer(delay, action, args)
+        timer.daemon = True
+        self.timers = [t for t in self.timers if t.is_alive()] + [timer]
+        timer.start()
+
+    def register(self, name, outputs, inputs):
+        """Register ports of a graph client."""
+        with self.lock:
+            self.calls['register'] += 1
+            for short_names, is_output in ((outputs, True), (inputs, False)):
+                for short_name in short_names:
+                    port = FakePort(f'{name}:{short_name}', is_output)
+                    if port.name not in self.ports:
+                        self.ports[port.name] = port
+                        self.notify('registration', port, True)
+
+    def unregister(self, name):
+        """Unregister ports of a graph client, and their connections."""
+        with self.lock:
+            self.calls['unregister'] += 1
+            for port in [port for port in self.ports.values()
+                         if port.name.startswith(f'{name}:')]:
+                for a, b in [c for c in self.connections if port.name in c]:
+                    self.connections.discard((a, b))
+                    self.notify('connect', self.ports[a], self.ports[b],
+                                False)
+                del self.ports[port.name]
+                self.notify('registration', port, False)
+
+    def add_client(self, name, outputs=(), inputs=(), delay=0):
+        """Add ports of a graph client, after a delay."""
+        self.schedule(delay, self.register, name, outputs, inputs)
+
+    def remove_client(self, name, delay=0):
+        """Remove ports of a graph client, after a delay."""
+        self.schedule(delay, self.unregister, name)
+
+    def churn(self, name, outputs, inputs, up, down, delay=0):
+        """Add a graph client that comes and goes periodically."""
+
+        def come():
+            self.register(name, outputs, inputs)
+            self.schedule(up, go)
+
+        def go():
+            self.unregister(name)
+            self.schedule(down, come)
+
+        self.schedule(delay, come)
+
+    def restart(self):
+        """
+        Simulate a jack server restart. Open clients get their shutdown
+        callback and are dropped, graph is kept.
+        """
+        with self.lock:
+            for client in self.clients:
+                self.notifications.put(
+                    (client, 'shutdown', (0, 'server restarted')))
+            self.clients = []
+
+    def stop(self):
+        """Cancel pending scripted changes."""
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
@@ -0,0 +1,197 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Long lived jack client with a live registry of ports and connections.
+
+The registry is kept up to date by jack port registration and connection
+callbacks, so queries don't need to walk the jack graph, and waiting for
+ports wakes up as soon as they appear.
+"""
+
+import threading
+import time
+
+import jackbackend
+
+
+def plan_connections(current, desired):
+    """
+    Plan graph operations to turn current connections into desired ones.
+
+    Connections are (output port name, input port name) tuples. Return a
+    list of ('disconnect' | 'connect', output, input) operations, with
+    all disconnections first, so no input port is ever fed by an output
+    that doesn't belong to the desired set.
+    """
+    current = set(current)
+    desired = set(desired)
+    return ([('disconnect', *c) for c in sorted(current - desired)]
+            + [('connect', *c) for c in sorted(desired - current)])
+
+
+class JackSession:
+    """Jack client keeping registry of port names and connections."""
+
+    def __init__(self, name):
+        self.name = name
+        self.client = None
+        # Port names.
+        self.ports = set()
+        # Connections as (output port name, input port name) tuples.
+        self.connections = set()
+        # Guards registry, and notifies its changes.
+        self.condition = threading.Condition()
+        # Registry must be rebuilt from the jack graph.
+        self.stale = True
+        self.open()
+
+    def open(self):
+        """Open jack client and set registry callbacks."""
+        client = jackbackend.Client(self.name, no_start_server=True)
+        # Callbacks for unavailable (unregistered) ports get None.
+        client.set_port_registration_callback(
+            self.on_registration, only_available=False)
+        client.set_port_connect_callback(
+            self.on_connect, only_available=False)
+        client.set_shutdown_callback(self.on_shutdown)
+        client.activate()
+        with self.condition:
+            self.client = client
+            self.stale = True
+
+    def close(self):
+        """Close jack client."""
+        with self.condition:
+            client, self.client = self.client, None
+            self.stale = True
+        if client is not None:
+            client.deactivate()
+            client.close()
+
+    # Callbacks run in the jack notification thread. They can't call
+    # the jack server, so unknown changes just mark registry as stale.
+
+    def on_registration(self, port, register):
+        """Update registry on port (un)registration."""
+        with self.condition:
+            if port is None:
+                self.stale = True
+            elif register:
+                self.ports.add(port.name)
+            else:
+                self.ports.discard(port.name)
+                self.connections = {
+                    c for c in self.connections if port.name not in c}
+            self.condition.notify_all()
+
+    def on_connect(self, a, b, connect):
+        """Update registry on ports (dis)connection."""
+        with self.condition:
+            if a is None or b is None:
+                self.stale = True
+            elif connect:
+                self.connections.add((a.name, b.name))
+            else:
+                self.connections.discard((a.name, b.name))
+            self.condition.notify_all()
+
+    def on_shutdown(self, status, reason):
+        """Forget jack client when jack server goes away."""
+        with self.condition:
+            self.client = None
+            self.stale = True
+            self.condition.notify_all()
+
+    # Registry.
+
+    def refresh(self):
+        """Rebuild registry from jack graph if stale. Hold 'condition'."""
+        if self.client is None:
+            # Jack server restarted, open a new client.
+            self.condition.release()
+            try:
+                self.open()
+            finally:
+                self.condition.acquire()
+        if self.stale:
+            self.stale = False
+            self.ports = {port.name for port in self.client.get_ports()}
+            self.connections = {
+                (port.name, in_port.name)
+                for port in self.client.get_ports(is_output=True)
+                for in_port in self.client.get_all_connections(port)
+                }
+
+    def get_ports(self):
+        """Return set of port names."""
+        with self.condition:
+            self.refresh()
+            return set(self.ports)
+
+    def get_connections(self):
+        """Return set of (output, input) port names connections."""
+        with self.condition:
+            self.refresh()
+            return set(self.connections)
+
+    def get_all_connections(self, port):
+        """Return names of ports connected to a port."""
+        with self.condition:
+            self.refresh()
+            return [a if b == port else b
+                    for a, b in self.connections if port in (a, b)]
+
+    def wait4ports(self, ports, tmax=5):
+        """Wait for jack ports to be up. Return False on timeout."""
+        ports = set(ports)
+        deadline = time.monotonic() + tmax
+        with self.condition:
+            while True:
+                self.refresh()
+                if ports <= self.ports:
+                    return True
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return False
+                self.condition.wait(timeout)
+
+    # Graph operations. Registry is updated right away, not waiting for
+    # callbacks, so that it reflects changes made by this client.
+
+    def connect(self, out_port, in_port):
+        """Connect two ports by name."""
+        with self.condition:
+            self.refresh()
+            client = self.client
+        client.connect(out_port, in_port)
+        with self.condition:
+            self.connections.add((out_port, in_port))
+
+    def disconnect(self, out_port, in_port):
+        """Disconnect two ports by name."""
+        with self.condition:
+            self.refresh()
+            client = self.client
+        client.disconnect(out_port, in_port)
+        with self.condition:
+            self.connections.discard((out_port, in_port))
+
+    def apply(self, plan):
+        """
+        Perform planned graph operations in order.
+
+        Return the list of operations performed. If one fails the
+        exception is raised, with the list in its 'report' attribute.
+        """
+        report = []
+        for operation, out_port, in_port in plan:
+            try:
+                {'connect': self.connect,
+                 'disconnect': self.disconnect}[operation](out_port, in_port)
+            except Exception as e:
+                e.report = report
+                raise
+            report.append((operation, out_port, in_port))
+        return report
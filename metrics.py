@@ -0,0 +1,161 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Timing histograms and counters of server work phases.
+
+Durations are recorded into fixed size histograms, with buckets growing
+by powers of 2 from 10 us, so recording is a bisection and two
+additions. Histograms are created on first use, by phase name.
+
+Updates are not locked: commands are serialized by control.lock, and a
+rare lost count in a statistic is harmless.
+"""
+
+import bisect
+import collections
+import functools
+import time
+
+
+# Bucket upper bounds in seconds, 10 us to about 20 s. Beyond is +Inf.
+bounds = tuple(10e-6 * 2**i for i in range(22))
+
+
+class Histogram:
+    """Fixed size histogram of durations."""
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Record a duration."""
+        self.counts[bisect.bisect_left(bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Return upper bound of the bucket holding a quantile."""
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+# Histograms by phase name.
+histograms = collections.defaultdict(Histogram)
+# Event counters by name.
+counters = collections.Counter()
+# Other counter dictionaries to report, e.g. camilladsp dispatch stats.
+counter_sources = []
+
+
+def observe(name, seconds):
+    """Record a phase duration."""
+    histograms[name].observe(seconds)
+
+
+def count(name, n=1):
+    """Add to an event counter."""
+    counters[name] += n
+
+
+class timer:
+    """Context manager recording the duration of its block."""
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, name):
+        self.histogram = histograms[name]
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def timed(name):
+    """Decorator recording durations of a function calls."""
+    def decorator(function):
+        histogram = histograms[name]
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def all_counters():
+    """Return dictionary of all counters."""
+    result = dict(counters)
+    for source in counter_sources:
+        result.update(source)
+    return result
+
+
+def reset():
+    """Clear histograms and counters, counter sources included."""
+    for histogram in histograms.values():
+        histogram.__init__()
+    counters.clear()
+    for source in counter_sources:
+        source.update(dict.fromkeys(source, 0))
+
+
+def report():
+    """Compose a human readable report string."""
+    lines = [f'{"phase":24s}{"count":>8s}{"mean":>10s}{"p50":>10s}'
+             f'{"p95":>10s}{"p99":>10s}{"max":>10s}  (ms)']
+    for name, histogram in sorted(histograms.items()):
+        if not histogram.count:
+            continue
+        lines.append(
+            f'{name:24s}{histogram.count:8d}'
+            f'{histogram.sum / histogram.count * 1e3:10.3f}'
+            + ''.join(f'{histogram.quantile(q) * 1e3:10.3f}'
+                      for q in (0.5, 0.95, 0.99))
+            + f'{histogram.max * 1e3:10.3f}')
+    lines.append('')
+    lines += [f'{name.replace("_", " "):24s}{value:10d}'
+              for name, value in sorted(all_counters().items())]
+    return '\n'.join(lines)
+
+
+def prometheus():
+    """Compose a Prometheus text format export."""
+    lines = ['# TYPE predic_phase_seconds histogram']
+    for name, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(bounds, histogram.counts):
+            cumulative += count
+            lines.append(f'predic_phase_seconds_bucket'
+                         f'{{phase="{name}",le="{bound:g}"}} {cumulative}')
+        lines += [
+            f'predic_phase_seconds_bucket{{phase="{name}",le="+Inf"}} '
+            f'{histogram.count}',
+            f'predic_phase_seconds_sum{{phase="{name}"}} {histogram.sum}',
+            f'predic_phase_seconds_count{{phase="{name}"}} '
+            f'{histogram.count}'
+            ]
+    for name, value in sorted(all_counters().items()):
+        metric = 'predic_' + name.replace(' ', '_') + '_total'
+        lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,164 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Preamp mixer for any number of channels.
+
+Channels are taken as stereo pairs, (0, 1), (2, 3)... and the preamp
+controls act on every pair. A last unpaired channel, as a center one,
+passes through, only affected by polarity.
+
+Mixer matrices for every combination of mixer settings are computed at
+start, so switching is a table lookup, and only the mapping entries that
+change are updated in the camilladsp mixer config.
+"""
+
+import itertools
+import math as m
+
+import numpy as np
+
+
+# Mixer settings and their options, in table key order.
+settings = {
+    'channels': ('lr', 'l', 'r'),
+    'channels_flip': ('off', 'on'),
+    'stereo': ('normal', 'mid', 'side'),
+    'polarity': ('off', 'on'),
+    'polarity_flip': ('off', 'on'),
+    'solo': ('lr', 'l', 'r')
+    }
+
+
+def stereo_matrix(channels, channels_flip, stereo, polarity, polarity_flip,
+                  solo):
+    """Return 2x2 [source, dest] mixer matrix for a stereo pair."""
+    mixer = np.identity(2)
+
+    if channels_flip == 'on':
+        mixer = np.array([[0, 1], [1, 0]])
+
+    match channels:
+        case 'l':       mixer = mixer @ np.array([[1, 1], [0, 0]])
+        case 'r':       mixer = mixer @ np.array([[0, 0], [1, 1]])
+
+    match stereo:
+        case 'mid':     mixer = mixer @ np.array([[0.5, 0.5], [0.5, 0.5]])
+        case 'side':    mixer = mixer @ np.array([[0.5, 0.5], [-0.5, -0.5]])
+
+    if polarity == 'on':
+        mixer = mixer @ np.array([[-1, 0], [0, -1]])
+
+    if polarity_flip == 'on':
+        mixer = mixer @ np.array([[1, 0], [0, -1]])
+
+    match solo:
+        case 'l':       mixer = mixer * np.array([[1, 0], [1, 0]])
+        case 'r':       mixer = mixer * np.array([[0, 1], [0, 1]])
+
+    return mixer
+
+
+def entry_values(gain):
+    """Return (gain dB, inverted, mute) mapping entry values for a gain."""
+    if gain:
+        return 20 * m.log10(abs(gain)), bool(gain < 0), False
+    return 0, False, True
+
+
+class MixerTable:
+    """Precomputed mixer matrices and mapping entry values."""
+
+    def __init__(self, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+        # Mapping entries as (dest, source) in camilladsp config order.
+        self.entries = [(dest, source) for dest in range(outputs)
+                        for source in range(inputs)]
+        # Matrices and entry values by settings key.
+        self.matrices = {}
+        self.values = {}
+        for key in itertools.product(*settings.values()):
+            matrix = self.matrix(key)
+            self.matrices[key] = matrix
+            self.values[key] = tuple(
+                entry_values(matrix[source, dest])
+                for dest, source in self.entries)
+        # Values actually in mapping, unknown until prepared.
+        self.applied = None
+
+    def matrix(self, key):
+        """Compute [source, dest] mixer matrix for a settings key."""
+        pair = stereo_matrix(*key)
+        mixer = np.zeros((self.inputs, self.outputs))
+        channels = min(self.inputs, self.outputs)
+        pairs = channels // 2
+        for first in range(0, 2 * pairs, 2):
+            mixer[first:first + 2, first:first + 2] = pair
+        if channels % 2:
+            # Unpaired channel.
+            polarity = dict(zip(settings, key))['polarity']
+            mixer[channels - 1, channels - 1] = (
+                -1 if polarity == 'on' else 1)
+        return mixer
+
+    def prepare(self, mixer_config):
+        """
+        Rewrite mixer config mapping with an entry for every source of
+        every destination, in table order, keeping actual values.
+        """
+        old_mapping = {
+            mapping['dest']: mapping
+            for mapping in mixer_config.get('mapping', [])
+            }
+        old = {
+            (dest, source['channel']): source
+            for dest, mapping in old_mapping.items()
+            for source in mapping['sources']
+            }
+        # Keep destination settings other than sources.
+        mixer_config['mapping'] = [
+            {**old_mapping.get(dest, {}), 'dest': dest, 'sources': []}
+            for dest in range(self.outputs)
+            ]
+        values = []
+        for dest, source in self.entries:
+            entry = old.get((dest, source), {})
+            gain = entry.get('gain', 0)
+            if entry.get('scale') == 'linear':
+                gain = 20 * m.log10(gain) if gain > 0 else 0
+            value = (gain, entry.get('inverted', False),
+                     entry.get('mute', (dest, source) not in old))
+            mixer_config['mapping'][dest]['sources'].append({
+                'channel': source,
+                'gain': value[0],
+                'inverted': value[1],
+                'mute': value[2]
+                })
+            values.append(value)
+        self.applied = tuple(values)
+
+    def forget(self):
+        """Forget applied values, after mixer config is replaced."""
+        self.applied = None
+
+    def apply(self, mixer_config, state):
+        """
+        Update mixer config mapping for mixer settings in state.
+
+        Only entries whose values change are written. Return the mixer
+        matrix.
+        """
+        key = tuple(state[setting] for setting in settings)
+        values = self.values[key]
+        if self.applied is None:
+            self.prepare(mixer_config)
+        mapping = mixer_config['mapping']
+        for index, (value, applied) in enumerate(zip(values, self.applied)):
+            if value != applied:
+                dest, source = self.entries[index]
+                entry = mapping[dest]['sources'][source]
+                entry['gain'], entry['inverted'], entry['mute'] = value
+        self.applied = values
+        return self.matrices[key]
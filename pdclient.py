@@ -0,0 +1,269 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Command line client for pre.di.c server.
+
+Usage:
+pdclient.py [-p port] command [args]    send a single command
+pdclient.py [-p port] -f file           send commands in file, one per
+                                        line, over a single connection
+                                        ('-' for stdin)
+pdclient.py [-p port]                   interactive mode if stdin is a
+                                        terminal, else same as '-f -'
+
+Exit status is 1 if any command is not acknowledged by the server.
+
+This module only needs the socket layer, so it starts fast. It doesn't
+read pre.di.c configs: port defaults to PREDIC_PORT environment
+variable, or 9999.
+"""
+
+import os
+import re
+import select
+import socket
+import sys
+import threading
+
+
+default_port = int(os.environ.get('PREDIC_PORT', 9999))
+
+
+class ServerConnection:
+    """
+    Persistent connection to the server.
+
+    Commands are newline terminated and can be pipelined. Every answer
+    ends with an 'OK' or 'ACK' line, and is returned as raw bytes,
+    without the final line feed, as pdlib.client_socket() does.
+    """
+
+    # Answer terminator line.
+    end_pattern = re.compile(rb'\n(OK|ACK)\n')
+
+    def __init__(self, port, server='localhost'):
+        self.address = (server, port)
+        # Keep threads from mixing their commands and answers.
+        self.lock = threading.Lock()
+        self.sock = None
+        self.buffer = b''
+        # Process owning the socket, to detect inherited connections.
+        self.pid = None
+
+    def connect(self):
+        """Open connection and switch server to persistent mode."""
+        self.close()
+        self.sock = socket.create_connection(self.address)
+        self.pid = os.getpid()
+        self.sock.sendall(b'persist\n')
+        self.read_answer()
+
+    def close(self):
+        """Close connection."""
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.buffer = b''
+
+    def is_alive(self):
+        """Check that connection is open and owned by this process."""
+        if self.sock is None or self.pid != os.getpid():
+            return False
+        # A readable socket with no data pending means closed by the server.
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if readable:
+            try:
+                return bool(self.sock.recv(1, socket.MSG_PEEK))
+            except OSError:
+                return False
+        return True
+
+    def read_answer(self):
+        """Read one answer from the server."""
+        while not (match := self.end_pattern.search(self.buffer)):
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError('connection closed by server')
+            self.buffer += chunk
+        answer = self.buffer[:match.end() - 1]
+        self.buffer = self.buffer[match.end():]
+        return answer
+
+    def send(self, *commands):
+        """Send commands pipelined and return the list of answers."""
+        for command in commands:
+            if '\n' in command or not command.strip():
+                raise ValueError(f'not a single command: {command!r}')
+        with self.lock:
+            if not self.is_alive():
+                self.connect()
+            self.sock.sendall(
+                ''.join(f'{command}\n' for command in commands).encode())
+            try:
+                return [self.read_answer() for command in commands]
+            except Exception:
+                # Framing is lost, start over next time.
+                self.close()
+                raise
+
+
+def acknowledged(answer):
+    """Tell if an answer doesn't end with an 'ACK' line."""
+    return not answer.endswith(b'\nACK')
+
+
+def refusal(command, one_shot=False):
+    """Return why a command can't be sent in a client mode, or None."""
+    name = (command.split() or [''])[0]
+    if name == 'persist':
+        # The server would wait for more commands, never closing.
+        return ("'persist' is not allowed, batch and interactive modes "
+                'keep the connection open already')
+    if name == 'subscribe' and not one_shot:
+        return "'subscribe' is only allowed in one shot mode"
+    return None
+
+
+def one_shot(command, port):
+    """
+    Send a single command, and print answer as it comes.
+
+    Answer is printed until the server closes the connection, so
+    'subscribe' streams events until interrupted.
+    """
+    if reason := refusal(command, one_shot=True):
+        print(f'\n(pdclient) {reason}')
+        return False
+    with socket.create_connection(('localhost', port)) as s:
+        s.sendall(f'{command}\n'.encode())
+        answer = b''
+        while chunk := s.recv(4096):
+            sys.stdout.write(chunk.decode())
+            sys.stdout.flush()
+            answer += chunk
+    print()
+    return acknowledged(answer.rstrip(b'\n'))
+
+
+def batch(lines, port):
+    """Send commands pipelined over one connection, and print answers."""
+    commands = []
+    for line in lines:
+        line = line.strip()
+        # Skip void lines and comments.
+        if not line or line.startswith('#'):
+            continue
+        if reason := refusal(line):
+            print(f'\n(pdclient) {reason}')
+            return False
+        commands.append(line)
+    if not commands:
+        return True
+
+    connection = ServerConnection(port)
+    try:
+        answers = connection.send(*commands)
+    finally:
+        connection.close()
+    for command, answer in zip(commands, answers):
+        print(f'> {command}\n{answer.decode().lstrip()}')
+    return all(acknowledged(answer) for answer in answers)
+
+
+def read_commands(connection):
+    """Return dictionary of command names and their argument choices."""
+    answer = connection.send('commands')[0]
+    if not acknowledged(answer):
+        # Older server, no completion.
+        return {}
+    table = {}
+    for line in answer.decode().splitlines()[:-1]:
+        if line:
+            name, *choices = line.split()
+            table[name] = choices
+    return table
+
+
+def interactive(port):
+    """Read, send and print commands until end of input."""
+    import readline
+
+    connection = ServerConnection(port)
+    table = read_commands(connection)
+
+    def complete(text, state):
+        """Complete command names, and their arguments."""
+        words = readline.get_line_buffer()[:readline.get_endidx()].split()
+        if len(words) > 1 or (words and not text):
+            candidates = table.get(words[0], [])
+        else:
+            candidates = table
+        matches = [word + ' ' for word in candidates if word.startswith(text)]
+        return matches[state] if state < len(matches) else None
+
+    readline.set_completer(complete)
+    readline.set_completer_delims(' ')
+    readline.parse_and_bind('tab: complete')
+
+    success = True
+    try:
+        while True:
+            try:
+                line = input('pre.di.c> ').strip()
+            except EOFError:
+                print()
+                break
+            except KeyboardInterrupt:
+                print()
+                continue
+            if not line:
+                continue
+            if line in {'quit', 'exit'}:
+                break
+            if reason := refusal(line):
+                print(f'\n(pdclient) {reason}\n')
+                continue
+            answer = connection.send(line)[0]
+            success = acknowledged(answer) and success
+            print(answer.decode().lstrip() + '\n')
+    finally:
+        connection.close()
+    return success
+
+
+def main(argv):
+    """Parse arguments and run in the requested mode."""
+    port = default_port
+    if argv[:1] == ['-p']:
+        port = int(argv[1])
+        argv = argv[2:]
+    if argv[:1] in (['-h'], ['--help']):
+        print(__doc__)
+        return True
+
+    try:
+        if argv[:1] == ['-f']:
+            if argv[1:] == ['-']:
+                return batch(sys.stdin, port)
+            with open(argv[1]) as f:
+                return batch(f, port)
+        if argv:
+            return one_shot(' '.join(argv), port)
+        if sys.stdin.isatty():
+            return interactive(port)
+        return batch(sys.stdin, port)
+    except BrokenPipeError:
+        # Output closed, as piped to head.
+        raise
+    except OSError as e:
+        print(f'\n(pdclient) connection error: {e}')
+        return False
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except (KeyboardInterrupt, BrokenPipeError):
+        sys.exit(1)
@@ -5,43 +5,82 @@
 """Miscellanea of utility functions for use in predic scripts."""
 
 
+import asyncio
+import functools
+import json
+import os
+import re
 import socket
+import stat
 import sys
 import time
 import subprocess as sp
 import math as m
 
-import jack
 import yaml
 import numpy as np
 
 import baseconfig as base
 import init
+import jackbackend
+import jacksession
+# Socket layer lives in the lightweight client module.
+from pdclient import ServerConnection
+
+from camilladsp import CamillaClient
+
+
+# Settings restored on start, in restoring order.
+# Source and mute are restored apart.
+# It is assumed that command name and setting name are the same.
+restore_settings = (
+    'balance',
+    'bass',
+    'channels',
+    'channels_flip',
+    'clamp',
+    'drc',
+    'drc_set',
+    'eq',
+    'eq_filter',
+    'level',
+    'loudness',
+    'loudness_ref',
+    'phase_eq',
+    'polarity',
+    'polarity_flip',
+    'solo',
+    'stereo',
+    'tones',
+    'treble'
+    )
 
 
 # Used on startaudio.py and stopaudio.py.
-def read_clients(phase):
+def read_clients(phase, named=False):
     """
     Read list of programs to start/stop from config/clients.yml file.
 
     phase: <'start'|'stop'> phase of client activation or deactivation
+    named: return a dictionary of programs by client name instead
     """
     clients_list_path = init.clients_path
 
     with open(clients_list_path) as clients_file:
-        clients_dict = yaml.safe_load(clients_file)
+        # Void file (all clients commented out) loads as None.
+        clients_dict = yaml.load(clients_file, Loader=init.yaml_loader) or {}
         # Init a list of client actions.
-        clients = [
-            clients_dict[i][phase]
+        clients = {
+            i: clients_dict[i][phase]
             for i in clients_dict if phase in clients_dict[i]
-            ]
-    return clients
+            }
+    return clients if named else list(clients.values())
 
 
 def read_yaml(filepath):
     """Return dictionary from yaml config file."""
     with open(filepath) as configfile:
-        config_dict = yaml.safe_load(configfile)
+        config_dict = yaml.load(configfile, Loader=init.yaml_loader)
 
     return config_dict
 
@@ -71,18 +110,90 @@ def client_socket(data, port, quiet=True):
             print('\n(lib) Connected')
         try:
             # If a parameter is passed it is send to server.
-            s.send(data.encode())
+            s.sendall(data.encode())
+            # Nothing else to send, let server know.
+            s.shutdown(socket.SHUT_WR)
             # Return raw bytes server answer.
-            return s.recv(2048)
+            # Server closes connection after answering, so read until then
+            # to get long answers (show, help, status) in full.
+            answer = b''
+            while chunk := s.recv(4096):
+                answer += chunk
+            return answer
         except Exception:
             print(f'\n(lib) unexpected error: {sys.exc_info()[0]}')
 
 
+# Open server connections in this process, by address.
+connections = {}
+
+
+def client_command(data, port, quiet=True):
+    """
+    Send a command to the server through a pooled persistent connection.
+
+    Return raw bytes answer, as client_socket() does.
+    """
+    # Avoid void command to reach server.
+    if data == '':
+        return b'ACK\n'
+
+    server = 'localhost'
+    connection = connections.setdefault(
+        (server, port), ServerConnection(port, server))
+
+    try:
+        if not quiet and not connection.is_alive():
+            print(f'\n(lib) Connecting to {server}, port {str(port)}...')
+        return connection.send(data)[0]
+    except socket.gaierror as e:
+        print(f'\n(lib) Address-related error connecting to server: {e}')
+        sys.exit(-1)
+    except OSError as e:
+        print(f'\n(lib) Connection error: {e}')
+        sys.exit(-1)
+
+
 def get_state():
     """Retrieve state dictionary from server to be used by clients."""
-    string = client_socket('status', init.config['control_port'])
+    answer = client_command('status json', init.config['control_port'])
+
+    # Drop status line.
+    return json.loads(answer.rpartition(b'\n')[0])
+
+
+def subscribe(keys=(), port=None, server='localhost'):
+    """
+    Yield state change events from server as dictionaries.
+
+    Events have 'seq', 'key', 'old' and 'new' fields. First come the
+    actual values of subscribed settings (all of them if 'keys' is void),
+    with 'old' set to None. If the connection is lost it is opened again,
+    and actual values are sent again.
+    """
+    if port is None:
+        port = init.config['control_port']
+    command = ' '.join(('subscribe', *keys)) + '\n'
 
-    return yaml.safe_load(string.decode().replace('\nOK', ''))
+    while True:
+        try:
+            with socket.create_connection((server, port)) as s:
+                s.sendall(command.encode())
+                stream = s.makefile('rb')
+                # Subscription answer ends with an OK or ACK line.
+                answer = b''
+                while (line := stream.readline()) not in {b'OK\n', b''}:
+                    if line == b'ACK\n':
+                        raise ValueError(
+                            f'subscription refused: {answer.decode().strip()}')
+                    answer += line
+                for line in stream:
+                    yield json.loads(line)
+        except OSError as e:
+            if init.config['verbose'] in {1, 2}:
+                print(f'\n(lib) subscription connection error: {e}')
+        # Server gone or restarting.
+        time.sleep(init.config['command_delay'])
 
 
 def wait4result(command, answer, tmax=5, interval=0.1):
@@ -119,35 +230,195 @@ def wait4result(command, answer, tmax=5, interval=0.1):
         return False
 
 
-def wait4source(source, tmax=5, interval=0.1):
+# Readiness probes.
+# A probe is a callable that checks once whether a service is ready,
+# returning True or False. Exceptions count as not ready.
+
+
+def probe_tcp(host, port, send=b'', expect=b'', timeout=1):
+    """Connect to a TCP service, send 'send' and look for 'expect'."""
+    with socket.create_connection((host, port), timeout=timeout) as s:
+        if send:
+            s.sendall(send)
+        answer = b''
+        while expect not in answer:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            answer += chunk
+        return expect in answer
+
+
+def probe_jack(port_pattern=''):
+    """Check jack server is up, with ports matching 'port_pattern'."""
+    client = jackbackend.Client('probe_client', no_start_server=True)
+    try:
+        return not port_pattern or bool(client.get_ports(port_pattern))
+    finally:
+        client.close()
+
+
+def probe_camilladsp(port, host='localhost', states=None):
+    """
+    Check camilladsp websocket answers.
+
+    'states' optionally restricts success to a set of processing state
+    names, e.g. {'RUNNING'}.
+    """
+    cdsp = CamillaClient(host, port)
+    cdsp.connect()
+    try:
+        state = cdsp.general.state()
+    finally:
+        cdsp.disconnect()
+    return states is None or state.name in states
+
+
+def probe_path(path, fifo=False):
+    """Check a file, or a FIFO if 'fifo', exists."""
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return False
+    return stat.S_ISFIFO(mode) if fifo else True
+
+
+class ProbeResult:
+    """Outcome of waiting for a probe. True if probe succeeded."""
+
+    def __init__(self, name, ok, elapsed, attempts):
+        self.name = name
+        self.ok = ok
+        self.elapsed = elapsed
+        self.attempts = attempts
+
+    def __bool__(self):
+        return self.ok
+
+    def __str__(self):
+        return (f"'{self.name}' {'ready' if self.ok else 'timed out'} "
+                f'after {self.elapsed:.3f}s ({self.attempts} attempts)')
+
+
+def probe_name(probe):
+    """Return a name for a probe, looking into partial objects."""
+    return getattr(probe, 'func', probe).__name__
+
+
+def run_probe(probe):
+    """Run a probe once."""
+    try:
+        return bool(probe())
+    except Exception as e:
+        if init.config['verbose'] in {2}:
+            print(f'\n(lib) probe {probe_name(probe)}: {e}')
+        return False
+
+
+def report_probe(result):
+    """Print probe result if verbose."""
+    if init.config['verbose'] in {1, 2}:
+        print(f'\n(lib) probe {result}')
+
+
+def wait4probe(probe, tmax=5, interval=0.1, max_interval=1, name=None):
+    """
+    Wait for a probe to succeed, or 'tmax' seconds to pass.
+
+    Retries back off exponentially from 'interval' to 'max_interval'.
+    Return a ProbeResult.
+    """
+    time_start = time.monotonic()
+    deadline = time_start + tmax
+    attempts = 0
+
+    while True:
+        attempts += 1
+        ok = run_probe(probe)
+        now = time.monotonic()
+        if ok or now >= deadline:
+            break
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * 2, max_interval)
+
+    result = ProbeResult(
+        name or probe_name(probe), ok, now - time_start, attempts)
+    report_probe(result)
+    return result
+
+
+async def await_probe(probe, tmax=5, interval=0.1, max_interval=1,
+                      name=None):
+    """Asyncio version of wait4probe(). Probes run in a worker thread."""
+    time_start = time.monotonic()
+    deadline = time_start + tmax
+    attempts = 0
+
+    while True:
+        attempts += 1
+        ok = await asyncio.to_thread(run_probe, probe)
+        now = time.monotonic()
+        if ok or now >= deadline:
+            break
+        await asyncio.sleep(min(interval, deadline - now))
+        interval = min(interval * 2, max_interval)
+
+    result = ProbeResult(
+        name or probe_name(probe), ok, now - time_start, attempts)
+    report_probe(result)
+    return result
+
+
+def server_probe(port=None):
+    """Return a probe for pre.di.c server."""
+    if port is None:
+        port = init.config['control_port']
+    return functools.partial(probe_tcp, 'localhost', port, b'ping\n', b'OK')
+
+
+def source_connections(source):
+    """Return set of connections from a source to predic audio ports."""
+    if source is None:
+        return set()
+
+    source_ports = init.sources[source]['source_ports']
+    source_ports_len = len(source_ports)
+    connections = set()
+    for ports_group in init.config['audio_ports']:
+        # Make no more than possible connections,
+        # i.e., minimum of input or output ports.
+        num_ports = min(len(ports_group), source_ports_len)
+        for i in range(num_ports):
+            # Audio sources.
+            connections.add((source_ports[i], ports_group[i]))
+    return connections
+
+
+def wait4source(source, tmax=5, interval=0.1, session=None):
     """Wait for source jack ports to be up."""
     source_ports = init.sources[source]['source_ports']
-    if wait4ports(source_ports, tmax, interval):
+    if wait4ports(source_ports, tmax, interval, session):
         return True
     else:
         return False
 
 
-def wait4ports(ports, tmax=5, interval=0.1):
-    """Wait for jack ports to be up."""
-    time_start = time.time()
-    jc = jack.Client('wait_client')
-
-    while (time.time() - time_start) < tmax:
-        # Names of up ports at this very moment as a generator.
-        up_ports = [port.name for port in jc.get_ports()]
-        # Compare sets and, if wanted ports are among up ports,
-        # then wanted ports are up and ready :-)
-        if set(ports).issubset(set(up_ports)):
-            # Go on.
-            jc.close()
-            return True
-        else:
-            time.sleep(interval)
-    # Time is exhausted and source ports are down :-(
-    # Leave function without any connection made.
-    jc.close()
-    return False
+def wait4ports(ports, tmax=5, interval=0.1, session=None):
+    """
+    Wait for jack ports to be up.
+
+    Waiting ends as soon as ports are registered. 'interval' is no longer
+    used, and is kept for compatibility. A jack session can be passed to
+    avoid opening a new jack client.
+    """
+    if session is not None:
+        return session.wait4ports(ports, tmax)
+
+    session = jacksession.JackSession('wait_client')
+    try:
+        return session.wait4ports(ports, tmax)
+    finally:
+        session.close()
 
 
 def gain_dB(x):
@@ -235,10 +506,29 @@ def show():
 
 help_str = '''
     help                                This help
-    status                              Display status
+    status [yaml|json]                  Display status
+    status version                      Display status version
+    status if-newer <version> [yaml|json]
+                                        Display version and status, or
+                                        nothing if version is the actual
     save                                Save status
     camillaconfig                       Save actual camilladsp config
     ping                                Request an answer from server
+    commands                            List commands and argument choices
+    subscribe [<setting> ...]           Stream state changes as JSON lines
+                                        (first line only)
+    cdsp_stats                          Show camilladsp dispatch counters
+    stats [reset]                       Show timing of work phases and
+                                        counters, or clear them
+    profile start [<n>|<s>s]            Profile next n commands, s seconds,
+                                        or until stop
+    profile stop                        Stop profiling, write stacks file
+                                        and show top functions
+    trace <off|on>                      Stop or start tracing commands
+    filters                             Check filter files, show their
+                                        length and latency
+    persist                             Keep connection open for pipelined
+                                        commands (first line only)
 
     show                                Show a human readable status
     clamp <off|on|toggle>               Set or toggle level clamp
@@ -264,7 +554,58 @@ help_str = '''
     balance <balance> [add]             Set balance (- left , + for right)
     level <level> [add]                 Set volume level
     gain <gain>                         Set digital gain
+    fade <level> <seconds> [linear|smooth|power]
+                                        Move level over time along a
+                                        curve, linear in dB by default
+    sleep <minutes>                     Fade out and mute after minutes
+    fade [stop]                         Show or stop fade or sleep timer
+
+    restore <settings>                  Apply settings as a single batch,
+                                        as JSON or YAML flow mapping
+    <command>; <command>; ...           Apply commands as a single batch
+    begin | commit | abort              Start, apply or discard a batch
+                                        (persistent connections only)
 
     'add' option makes previous number be an increment
     'camillaconfig' command saves actual config in loudspeaker folder
     '''
+
+
+def command_table():
+    """
+    Return dictionary of command names and their argument choices.
+
+    It is built from help string. Placeholders of known choices are
+    replaced by actual names.
+    """
+    placeholders = {
+        '<input>': list(init.sources),
+        '<drc_set>': list(init.drc),
+        '<eq_filter>': list(init.eq)
+        }
+    table = {}
+    for line in help_str.splitlines():
+        # Commands are indented by 4 spaces, descriptions continue deeper.
+        if not re.match(r' {4}[a-z]', line):
+            continue
+        # Command syntax goes before the two or more spaces gap.
+        syntax = re.split(r'\s{2,}', line.strip())[0].split()
+        if syntax[1:2] == ['|']:
+            # Alternative command names.
+            for name in syntax[::2]:
+                table.setdefault(name, [])
+            continue
+        choices = table.setdefault(syntax[0], [])
+        for arg in syntax[1:]:
+            if arg in placeholders:
+                new = placeholders[arg]
+            elif re.fullmatch(r'[\[<][a-z_]+(\|[a-z_]+)+[\]>]', arg):
+                # Literal alternatives.
+                new = arg[1:-1].split('|')
+            elif re.fullmatch(r'\[?[a-z_-]+\]?', arg):
+                # Literal word.
+                new = [arg.strip('[]')]
+            else:
+                continue
+            choices += [choice for choice in new if choice not in choices]
+    return table
@@ -0,0 +1,150 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Sampling profiler for the running server.
+
+While on, a thread samples the Python stacks of the main thread, running
+the event loop, and of asyncio worker threads, running commands, at a
+fixed interval. Nothing runs while off. Idle samples (event loop waiting
+for events, worker threads waiting for work) are not counted.
+
+Stacks are written as 'folded' lines, 'frame;frame;...;frame count', as
+read by flamegraph.pl, speedscope and the like.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+
+# Idle leaf frames as (file name, function name).
+idle_frames = {
+    ('selectors.py', 'select'),     # event loop waiting for events
+    ('thread.py', '_worker')        # worker thread waiting for work
+    }
+
+
+def frame_name(code):
+    """Return a readable name for a frame code object."""
+    return (f'{code.co_name} '
+            f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+
+
+class Profiler:
+    """Sampling profiler, for a number of commands or a time window."""
+
+    def __init__(self, folder, interval=0.001, top=20):
+        self.folder = folder
+        self.interval = interval
+        self.top = top
+        self.thread = None
+        self.stopping = threading.Event()
+        # Guards finishing, by command or by the sampling thread.
+        self.lock = threading.Lock()
+        # Commands left to profile, None if not counting.
+        self.commands_left = None
+        # Sampling end, as monotonic time, or None.
+        self.deadline = None
+        # Result of last profile as (path, summary).
+        self.result = None
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.time_start = 0
+
+    def start(self, commands=None, seconds=None):
+        """
+        Start sampling, until stopped, or after a number of commands or
+        seconds.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            raise Exception('profiler already running')
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.result = None
+        self.commands_left = commands
+        self.deadline = None if seconds is None else (
+            time.monotonic() + seconds)
+        self.stopping.clear()
+        self.time_start = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Sample stacks until stopped or deadline. Runs in own thread."""
+        while not self.stopping.wait(self.interval):
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                self.finish()
+                break
+            # Event loop and asyncio.to_thread() workers.
+            idents = {thread.ident for thread in threading.enumerate()
+                      if thread is threading.main_thread()
+                      or thread.name.startswith('asyncio')}
+            for ident, frame in sys._current_frames().items():
+                if ident not in idents:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename),
+                        code.co_name) in idle_frames:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def command_done(self):
+        """Count a profiled command, stopping after the last one."""
+        if self.commands_left is None:
+            return
+        self.commands_left -= 1
+        if self.commands_left <= 0:
+            self.stop()
+
+    def stop(self):
+        """Stop sampling, and return (path, summary) of the profile."""
+        if self.thread is None:
+            raise Exception('profiler not started')
+        self.stopping.set()
+        self.thread.join()
+        self.finish()
+        return self.result
+
+    def finish(self):
+        """Write stacks file and summary, once per profile."""
+        with self.lock:
+            if self.result is not None:
+                return
+            self.commands_left = None
+            os.makedirs(self.folder, exist_ok=True)
+            stamp = time.strftime('%Y%m%d-%H%M%S',
+                                  time.localtime(self.time_start))
+            path = f'{self.folder}/profile-{stamp}.folded'
+            with open(path, 'w') as f:
+                for stack, count in self.stacks.items():
+                    f.write(';'.join(map(frame_name, stack)) + f' {count}\n')
+            self.result = (path, self.summary())
+
+    def summary(self):
+        """Compose top functions by own and total samples."""
+        busy = sum(self.stacks.values()) or 1
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            # Recursive functions count once per stack.
+            for code in set(stack):
+                total[code] += count
+
+        lines = [f'{self.samples} samples every {self.interval * 1e3:g} ms, '
+                 f'{sum(self.stacks.values())} busy thread samples']
+        for title, counter in (('own', own), ('total', total)):
+            lines.append(f'\ntop functions by {title} samples:')
+            for code, count in counter.most_common(self.top):
+                lines.append(f'{count:8d}{count / busy:8.1%}  '
+                             f'{frame_name(code)}')
+        return '\n'.join(lines)
@@ -2,46 +2,227 @@
 # pre.di.c, a preamp and digital crossover
 # Copyright (C) Roberto Ripio
 
-"""Server to process commands."""
+"""
+Server to process commands.
+
+Two protocol modes are served on the same port:
+
+legacy:     one command per connection. The server answers and closes
+            the connection (nc friendly).
+persistent: the first line sent is 'persist'. Connection stays open and
+            carries any number of newline terminated commands, that can
+            be pipelined. Every answer, including the one for 'persist',
+            is terminated by a line with 'OK' or 'ACK'.
+
+Commands separated by ';' are processed as a single batch. In persistent
+mode commands between 'begin' and 'commit' are also batched, and 'abort'
+discards them.
+
+State has a version number, raised on every change and restarted with
+the server. Status answers are serialized once per version. Pollers can
+send 'status if-newer <version>', answered with nothing unless the state
+version is not that one any more.
+
+'subscribe [setting ...]' turns the connection into a stream of state
+changes. After an 'OK' line, one JSON object per line is sent for every
+change of the subscribed settings (all of them if none is given), with
+'seq', 'key', 'old' and 'new' fields. The stream starts with the actual
+values, with null 'old'. It ends when the client closes the connection.
+
+Durations of work phases (commands, lock waits, mute waits, camilladsp
+calls, jack connections, state writes...) are recorded in histograms,
+shown by 'stats'. If 'metrics_port' is set in config, they are also
+served in Prometheus text format over HTTP on that local port.
+
+'profile start' samples the stacks of server threads, for a number of
+commands, a time window or until 'profile stop'. Stacks are written to
+the profiles folder, and 'profile stop' answers with the top functions.
+Nothing is sampled while the profiler is off.
+
+Commands can be traced to the traces folder, with their client, timing,
+reply and state changes, if 'trace' is true in config or after 'trace
+on'. Traces are replayed by tools/replay_trace.py.
+
+If 'coalesce_window' is set in config, bursts of 'level', 'balance',
+'bass', 'treble' and 'loudness_ref' commands within that many seconds
+are folded into one (see coalesce.py).
+
+'fade' moves level to a target over some seconds along a curve, and
+'sleep' fades out and mutes after some minutes, while other commands
+are served (see fader.py).
+"""
 
 import asyncio
+import itertools
+import json
+import signal
+import time
 
 import yaml
 
+import baseconfig as base
+import cmdtrace
+import coalesce
 import control
+import fader
 import init
+import metrics
 import pdlib as pd
+import profiler
+import statefeed
+import statestore
 
 
-async def handle_commands(reader, writer):
-    """Async process to handle commands."""
-    rawdata = await reader.read(100)
-    data = rawdata.decode().rstrip('\r\n')
-    say_OK = True
-
-    def write_state():
-        """Write state to state file."""
-        with open(init.state_path, 'w') as f:
-            if init.state is not None:
-                yaml.dump(init.state, f, default_flow_style=False)
-            else:
-                raise Exception('corrupted null state file\n')
+# Write-behind state persistence.
+store = statestore.StateStore(
+    init.state, init.state_path, init.state_journal_path)
+# State changes stream. Its sequence number is the state version.
+feed = statefeed.StateFeed(init.state)
+
+# Status answers, serialized once per state version.
+status_renderers = {
+    'yaml': lambda: yaml.dump(init.state, Dumper=init.yaml_dumper,
+                              default_flow_style=False).encode(),
+    'json': lambda: json.dumps(init.state).encode(),
+    'show': lambda: pd.show().encode()
+    }
+# Cached answers as (version, answer) by format.
+status_cache = {}
+
+# Command names timed apart, others are timed as 'other'.
+timed_commands = set(pd.command_table())
+
+# On demand sampling profiler.
+profile = profiler.Profiler(
+    init.profiles_folder, base.profile_interval, base.profile_top)
+
+# Optional trace of commands, for replay.
+trace = cmdtrace.CommandTrace(
+    f'{init.traces_folder}/{base.trace_filename}', base.trace_max_bytes,
+    base.trace_backups, base.trace_reply_max, init.state)
+# Connection numbers, to tell clients apart in traces.
+connection_numbers = itertools.count(1)
+
+# Bursts of numeric commands fold into one, if a window is set.
+coalescer = coalesce.Coalescer(
+    control.proccess_commands, control.execute_command, control.lock,
+    init.config.get('coalesce_window', 0))
+
+
+def state_changed():
+    """Publish and journal state changes made out of client commands."""
+    feed.publish()
+    store.changed()
+
+
+# Level fades and sleep timer.
+fade = fader.Fader(state_changed, base.fade_interval)
+
 
-    def write_camillaconfig():
-        """Write camilladsp config to file in loudspeaker folder."""
-        camillaconfig = init.loudspeaker_path + '/actual_config.yaml'
-        with open(camillaconfig, 'w') as f:
-            yaml.dump(control.cdsp_config, f, default_flow_style=False)
+def write_camillaconfig():
+    """Write camilladsp config to file in loudspeaker folder."""
+    camillaconfig = init.loudspeaker_path + '/actual_config.yaml'
+    with open(camillaconfig, 'w') as f:
+        yaml.dump(control.cdsp_config, f, Dumper=init.yaml_dumper,
+                  default_flow_style=False)
+
+
+def cached_status(form):
+    """Return status serialized in a format, rendering it if outdated."""
+    version, answer = status_cache.get(form, (None, None))
+    if version != feed.seq:
+        version, answer = status_cache[form] = (
+            feed.seq, status_renderers[form]())
+    return answer
+
+
+def status_reply(args):
+    """Compose answer for 'status' command arguments."""
+    if args == ['version']:
+        return str(feed.seq).encode()
+
+    header = b''
+    if args[:1] == ['if-newer']:
+        if len(args) < 2 or not args[1].isdigit():
+            raise Exception("'if-newer' needs a version number")
+        if int(args[1]) == feed.seq:
+            # Nothing new.
+            return b''
+        header = f'{feed.seq}\n'.encode()
+        args = args[2:]
+
+    form = args[0] if args else 'yaml'
+    if len(args) > 1 or form not in {'yaml', 'json'}:
+        raise Exception(f"bad status arguments: {' '.join(args)}")
+    return header + cached_status(form)
+
+
+def profile_reply(args):
+    """Run 'profile' command arguments and compose answer."""
+    match args:
+        case ['start']:
+            profile.start()
+            return b'\nprofiling until stop'
+        case ['start', limit] if limit.isdigit():
+            profile.start(commands=int(limit))
+            return f'\nprofiling next {limit} commands'.encode()
+        case ['start', limit] if limit.endswith('s'):
+            profile.start(seconds=float(limit[:-1]))
+            return f'\nprofiling for {limit}'.encode()
+        case ['stop']:
+            path, summary = profile.stop()
+            return f'\nprofile written to {path}\n\n{summary}'.encode()
+    raise Exception(f"bad profile arguments: {' '.join(args)}")
+
+
+def fade_reply(args):
+    """Run 'fade' and 'sleep' command arguments and compose answer."""
+    match args:
+        case ['fade']:
+            return f'\n{fade.status()}'.encode()
+        case ['fade' | 'sleep', 'stop']:
+            return b'\nfade stopped' if fade.stop() else b'\nno fade running'
+        case ['fade', target, seconds, *curve] if len(curve) < 2:
+            fade.fade(float(target), float(seconds), *curve)
+            return f'\n{fade.status()}'.encode()
+        case ['sleep', minutes]:
+            fade.sleep(float(minutes))
+            return f'\n{fade.status()}'.encode()
+    raise Exception(f"bad {args[0]} arguments: {' '.join(args[1:])}")
+
+
+def peer_address(writer):
+    """Return 'address:port' of a connection client."""
+    peer = writer.get_extra_info('peername')
+    return f'{peer[0]}:{peer[1]}' if peer else ''
+
+
+async def run_command(data, connection=None, peer=''):
+    """
+    Process a single command line.
+
+    Commands not changing state are answered right away, even while
+    others are waiting for a muted switch to finish. 'connection' and
+    'peer' identify the client in the trace.
+
+    Return a tuple (reply, status). 'reply' is the answer body as bytes,
+    'status' is 'OK', 'ACK', or '' for answers that carry no status line
+    in legacy mode.
+    """
+    reply = b''
+    status = 'OK'
+    changes = {}
+    time_received = time.monotonic()
+    time_start = time.perf_counter()
 
     try:
-        if data == 'status':
-            # Echo state to client as YAML string.
-            writer.write(yaml.dump(init.state,
-                                   default_flow_style=False).encode())
+        if data.split()[:1] == ['status']:
+            # Echo state to client as YAML or JSON string.
+            reply += status_reply(data.split()[1:])
 
         elif data == 'save':
             # Write state to state file.
-            write_state()
+            await store.flush()
 
         elif data == 'camillaconfig':
             # Write camilladsp config to file.
@@ -51,6 +232,43 @@ async def handle_commands(reader, writer):
             # Just answers OK.
             pass
 
+        elif data == 'filters':
+            # Check filter files, and report their length and latency.
+            reply += b'\n' + (
+                await asyncio.to_thread(control.filters_report)).encode()
+
+        elif data == 'commands':
+            # Command names and argument choices, for client completion.
+            reply += b'\n' + '\n'.join(
+                ' '.join((name, *choices))
+                for name, choices in pd.command_table().items()
+                ).encode()
+
+        elif data == 'cdsp_stats':
+            # Report camilladsp dispatched and avoided calls.
+            reply += b'\n' + control.sync.report().encode()
+
+        elif data == 'stats':
+            # Report timing of work phases and counters.
+            reply += b'\n' + metrics.report().encode()
+
+        elif data == 'stats reset':
+            metrics.reset()
+
+        elif data.split()[:1] == ['profile']:
+            # Start or stop sampling profiler.
+            reply += await asyncio.to_thread(profile_reply, data.split()[1:])
+
+        elif data.split()[:1] in (['fade'], ['sleep']):
+            # Start, show or stop level trajectories.
+            reply += fade_reply(data.split())
+
+        elif data == 'trace on':
+            trace.open()
+
+        elif data == 'trace off':
+            trace.close()
+
         elif data == 'command_unmute':
             # Inhibit mute downstream.
             init.config['do_mute'] = False
@@ -61,47 +279,223 @@ async def handle_commands(reader, writer):
 
         elif data == 'show':
             # Print human readable status.
-            say_OK = False
-            writer.write(pd.show().encode())
+            status = ''
+            reply += cached_status('show')
 
         elif data == 'help':
             # Print command help.
-            say_OK = False
-            writer.write(pd.help_str.encode())
+            status = ''
+            reply += pd.help_str.encode()
+
+        elif data in {'begin', 'commit', 'abort'}:
+            raise Exception(f"'{data}' needs a persistent connection")
 
         else:
             # Command received in 'data',
             # then send command to control.py.
             if init.config['verbose'] in {1, 2}:
-                writer.write(b'\ncommand: ' + data.encode())
+                reply += b'\ncommand: ' + data.encode()
 
-            if not control.proccess_commands(data):
-                raise Exception(control.message)
+            request = control.Request()
+            if data.startswith('restore '):
+                # Settings as JSON or YAML flow mapping.
+                settings = yaml.load(data.removeprefix('restore '),
+                                     Loader=init.yaml_loader)
+                success = await control.proccess_restore(settings, request)
+            elif ';' in data:
+                # Batch of commands.
+                success = await control.proccess_batch(
+                    data.split(';'), request)
+            else:
+                success = await coalescer.submit(data, request)
+            # Even failed commands can change state before rolling back.
+            changes = feed.publish()
+            if not success:
+                raise Exception(request.message)
 
-            writer.write(b'\n' + control.message.encode())
-            # A try block avoids blocking of state file writing
-            # when the terminal that launched startaudio.py is closed.
-            try:
-                # Writes state file.
-                write_state()
-            except Exception as e:
-                writer.write(b'\nan error occurred when writing state file: '
-                             + str(e).encode())
-                writer.write(b'\nACK')
+            reply += b'\n' + request.message.encode()
+            # Schedule state journaling.
+            store.changed()
 
     except Exception as e:
-        writer.write(b'\n' + str(e).encode())
-        writer.write(b'\nACK')
+        reply += b'\n' + str(e).encode()
+        status = 'ACK'
+
+    if ';' in data:
+        name = 'batch'
     else:
-        if say_OK:
-            writer.write(b'\nOK')
-    finally:
-        try:
+        name = (data.split() or ['other'])[0]
+        if name not in timed_commands:
+            name = 'other'
+    latency = time.perf_counter() - time_start
+    metrics.observe(f'command {name}', latency)
+    if profile.commands_left is not None and name != 'profile':
+        profile.command_done()
+    if trace.file is not None and name != 'trace':
+        trace.record(time_received, connection, peer, data,
+                     status != 'ACK', latency, reply, changes)
+    return reply, status
+
+
+async def send_reply(writer, reply):
+    """Send reply to client, tolerating vanished clients."""
+    try:
+        with metrics.timer('reply'):
+            writer.write(reply)
             await writer.drain()
-        except ConnectionResetError:
-            writer.write(b'\nstill no connection...')
-            writer.write(b'\nACK')
-        control.message = ''
+    except ConnectionResetError:
+        if init.config['verbose'] in {2}:
+            print('\n(server) client vanished before reply')
+
+
+async def handle_subscription(reader, writer, keys):
+    """Send state change events until the client closes the connection."""
+    try:
+        subscription = feed.subscribe(keys)
+    except Exception as e:
+        await send_reply(writer, b'\n' + str(e).encode() + b'\nACK\n')
+        return
+    await send_reply(writer, b'\nOK\n')
+
+    # Anything read means closed connection, subscribers don't talk.
+    closed = asyncio.ensure_future(reader.read(100))
+    try:
+        while True:
+            event = asyncio.ensure_future(subscription.queue.get())
+            await asyncio.wait(
+                (event, closed), return_when=asyncio.FIRST_COMPLETED)
+            if not event.done():
+                event.cancel()
+                break
+            if event.result() is None:
+                # Dropped for lagging behind.
+                if init.config['verbose'] in {1, 2}:
+                    print('\n(server) dropped lagging subscriber')
+                break
+            writer.write(json.dumps(event.result()).encode() + b'\n')
+            await writer.drain()
+    except ConnectionResetError:
+        pass
+    finally:
+        closed.cancel()
+        feed.unsubscribe(subscription)
+
+
+async def handle_persistent(reader, writer, pending, connection):
+    """
+    Serve newline framed commands until the client closes the connection.
+
+    'pending' holds bytes already read after the 'persist' line.
+    """
+    peer = peer_address(writer)
+    await send_reply(writer, b'\nOK\n')
+    # Commands queued between 'begin' and 'commit'.
+    batch = None
+
+    while True:
+        if b'\n' in pending:
+            line, _, pending = pending.partition(b'\n')
+        else:
+            try:
+                line = await reader.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                # Line too long for the reader buffer. Framing is lost.
+                await send_reply(writer, b'\ncommand too long\nACK\n')
+                break
+            except ConnectionResetError:
+                break
+            if not line:
+                # Client closed connection.
+                break
+            line = pending + line
+            pending = b''
+        data = line.decode().rstrip('\r\n')
+        if not data:
+            # Void lines are not commands, and get no answer.
+            continue
+        if data.split()[:1] == ['subscribe'] and batch is None:
+            # Connection becomes a state changes stream.
+            await handle_subscription(reader, writer, data.split()[1:])
+            break
+        if data == 'begin' and batch is None:
+            batch = []
+            reply, status = b'\nbatch started', 'OK'
+        elif data == 'abort' and batch is not None:
+            batch = None
+            reply, status = b'\nbatch aborted', 'OK'
+        elif data == 'commit' and batch is not None:
+            reply, status = await run_command(
+                ';'.join(batch) + ';', connection, peer)
+            batch = None
+        elif batch is not None:
+            if data == 'begin' or ';' in data:
+                reply, status = b'\nnested batches not allowed', 'ACK'
+            elif (name := (data.split() or [''])[0]) not in (
+                    control.batch_commands):
+                # Refused now, not failing the whole batch on commit.
+                reply = (f"\ncommand '{name}' "
+                         'not allowed in a batch').encode()
+                status = 'ACK'
+            else:
+                batch.append(data)
+                reply, status = b'\nqueued', 'OK'
+        else:
+            reply, status = await run_command(data, connection, peer)
+        await send_reply(writer, reply + b'\n' + (status or 'OK').encode()
+                         + b'\n')
+
+
+async def handle_commands(reader, writer):
+    """Async process to handle commands."""
+    connection = next(connection_numbers)
+    try:
+        # First line, up to a line feed, or to end of input for legacy
+        # clients half closing instead.
+        rawdata = await asyncio.wait_for(
+            reader.readuntil(b'\n'), init.config['command_delay'])
+    except asyncio.IncompleteReadError as e:
+        rawdata = e.partial
+    except (asyncio.TimeoutError, asyncio.LimitOverrunError,
+            ConnectionResetError):
+        # Never run a command cut short.
+        rawdata = None
+    first, newline, pending = (rawdata or b'').partition(b'\n')
+
+    try:
+        first = first.decode().rstrip('\r')
+        if rawdata is None:
+            await send_reply(writer, b'\ncommand too long/incomplete\nACK')
+        elif first == 'persist' and newline:
+            await handle_persistent(reader, writer, pending, connection)
+        elif first.split()[:1] == ['subscribe']:
+            await handle_subscription(reader, writer, first.split()[1:])
+        else:
+            data = rawdata.decode().rstrip('\r\n')
+            reply, status = await run_command(
+                data, connection, peer_address(writer))
+            if status:
+                reply += b'\n' + status.encode()
+            await send_reply(writer, reply)
+    finally:
+        writer.close()
+
+
+async def handle_metrics(reader, writer):
+    """Answer an HTTP request with metrics in Prometheus text format."""
+    try:
+        # Request and headers are not needed.
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                               init.config['command_delay'])
+        body = metrics.prometheus().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     + f'Content-Length: {len(body)}\r\n\r\n'.encode()
+                     + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError, ConnectionResetError):
+        pass
+    finally:
         writer.close()
 
 
@@ -115,7 +509,30 @@ async def main():
     addr = server.sockets[0].getsockname()
     if init.config['verbose'] in {1, 2}:
         print(f'\n(server) listening on address {addr}')
-    await server.serve_forever()
+
+    if init.config.get('trace'):
+        trace.open()
+
+    # Optional Prometheus metrics endpoint, local only.
+    if init.config.get('metrics_port'):
+        await asyncio.start_server(
+            handle_metrics, '127.0.0.1', init.config['metrics_port'])
+        if init.config['verbose'] in {1, 2}:
+            print('\n(server) metrics on port '
+                  f'{init.config["metrics_port"]}')
+
+    # Stop serving on termination signals, and save state on exit.
+    serving = asyncio.ensure_future(server.serve_forever())
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, serving.cancel)
+    try:
+        await serving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await store.flush()
+        trace.close()
 
 
 asyncio.run(main())
@@ -10,15 +10,25 @@ Starts pre.di.c audio system.
     core: jack, brutefir, server
     players: everything else (players and clients)
     all: all of the above
+
+Startup runs as a graph of stages. Every stage starts as soon as the
+stages it requires are done, so independent stages (clients) run in
+parallel. A timing breakdown of stages is printed at the end.
 """
 
 import sys
 import os
 import time
 import re
+import asyncio
+import collections
+import copy
+import functools
+import json
 import subprocess as sp
 
 import init
+import jackbackend
 import stopaudio
 import pdlib as pd
 
@@ -37,13 +47,17 @@ def stop_all():
 def init_jack():
     """Load jack server."""
     try:
+        if jackbackend.is_fake():
+            print('\n(startaudio) fake jack in use, not starting jack')
+            return
         print('\n(startaudio) starting jack\n')
         fs = init.speaker['devices']['samplerate']
         sp.Popen(f'{init.config["jack_command"]} -r {fs}'.split())
         # waiting for jackd:
         tmax = init.config['command_delay'] * 5
         interval = init.config['command_delay'] * 0.1
-        if pd.wait4result('jack_lsp', 'system', tmax, interval):
+        if pd.wait4probe(functools.partial(pd.probe_jack, 'system'),
+                         tmax, interval, name='jack'):
             print('\n(startaudio) jack started :-)')
         else:
             raise Exception('no ports available')
@@ -53,6 +67,25 @@ def init_jack():
         stop_all()
 
 
+def camilladsp_config():
+    """Return full camilladsp config."""
+    # Get general part of camilladsp config.
+    # A copy, so that retries don't merge speaker config twice.
+    cdsp_config = copy.deepcopy(init.camilladsp)
+
+    # Get loudspeaker specific parts of camilladsp config.
+
+    # Merge loudspeaker specific settings in camilladsp config.
+    cdsp_config['title'] = init.speaker['title']
+    cdsp_config['description'] = init.speaker['description']
+    cdsp_config['devices'].update(init.speaker['devices'])
+    cdsp_config['filters'].update(init.speaker['filters'])
+    cdsp_config['mixers'].update(init.speaker['mixers'])
+    cdsp_config['pipeline'].extend(init.speaker['pipeline'])
+
+    return cdsp_config
+
+
 def init_camilladsp():
     """Load camilladsp."""
     try:
@@ -63,30 +96,22 @@ def init_camilladsp():
         sp.Popen((f'{init.config["camilladsp_command"]} -m -w ' +
                   f'-p {init.config["websocket_port"]}').split())
 
-        # Wait a bit.
-        time.sleep(init.config['command_delay'] * 1)
+        # Wait for camilladsp websocket.
+        tmax = init.config['command_delay'] * 5
+        interval = init.config['command_delay'] * 0.1
+        if not pd.wait4probe(
+                functools.partial(pd.probe_camilladsp,
+                                  init.config['websocket_port']),
+                tmax, interval, name='camilladsp'):
+            raise Exception('websocket not available')
 
         # Connect to camilladsp.
         cdsp = CamillaClient("localhost", init.config['websocket_port'])
         cdsp.connect()
 
-        # Get general part of camilladsp config.
-
-        cdsp_config = init.camilladsp
-
-        # Get loudspeaker specific parts of camilladsp config.
-
-        # Merge loudspeaker specific settings in camilladsp config.
-        cdsp_config['title'] = init.speaker['title']
-        cdsp_config['description'] = init.speaker['description']
-        cdsp_config['devices'].update(init.speaker['devices'])
-        cdsp_config['filters'].update(init.speaker['filters'])
-        cdsp_config['mixers'].update(init.speaker['mixers'])
-        cdsp_config['pipeline'].extend(init.speaker['pipeline'])
-
         # Send full config to camilladsp.
         # Probably we should check for jack ports here...
-        cdsp.config.set_active(cdsp_config)
+        cdsp.config.set_active(camilladsp_config())
         cdsp.disconnect()
 
     except Exception as e:
@@ -105,9 +130,8 @@ def init_server():
         # Waiting for server.
         tmax = init.config['command_delay'] * 5
         interval = init.config['command_delay'] * 0.1
-        if pd.wait4result(
-                'echo ping| nc localhost 9999 2>/dev/null',
-                'OK', tmax, interval):
+        if pd.wait4probe(pd.server_probe(port), tmax, interval,
+                         name='server'):
             print('\n(startaudio) server started :-)')
         else:
             print('\n(startaudio) server not accesible Bye :-/')
@@ -136,29 +160,23 @@ def init_state_settings(state):
     Source associated phase_EQ will prevail if use_source_phase_EQ is set
     because init_source function is executed after this one.
     """
-    for setting in (
-            'balance',
-            'bass',
-            'channels',
-            'channels_flip',
-            'clamp',
-            'drc',
-            'drc_set',
-            'eq',
-            'eq_filter',
-            'level',
-            'loudness',
-            'loudness_ref',
-            'phase_eq',
-            'polarity',
-            'polarity_flip',
-            'solo',
-            'stereo',
-            'tones',
-            'treble'
-            ):
-        print(f'{setting} {state[setting]}')
-        pd.client_socket(f'{setting} {state[setting]}', port)
+    settings = {setting: state[setting] for setting in pd.restore_settings}
+    for setting, value in settings.items():
+        print(f'{setting} {value}')
+
+    # All settings at once, with a single camilladsp config dispatch.
+    time_start = time.monotonic()
+    answer = pd.client_command(f'restore {json.dumps(settings)}', port)
+    elapsed = time.monotonic() - time_start
+    if answer.endswith(b'\nOK'):
+        print(f'\n(startaudio) settings restored in {elapsed:.3f}s')
+    else:
+        # Restore what is possible setting by setting.
+        print(f'\n(startaudio) settings restore failed: '
+              f'{answer.decode().strip()}\n'
+              '(startaudio) restoring settings one by one')
+        for setting, value in settings.items():
+            pd.client_command(f'{setting} {value}', port)
 
 
 def init_source(state):
@@ -170,97 +188,178 @@ def init_source(state):
     interval = init.config['command_delay'] * 0.5
     if pd.wait4source(source, tmax, interval):
         # Source ports up and ready :-)
-        # Switch on source and leave function.
-        if init.sources[source]['wait_on_start']:
-            # Some clients (namely mpd) seems to need some extra time after
-            # ports detection for whatever reason.
+        # Some clients (namely mpd) need some extra time after ports
+        # detection, until their service is up.
+        wait = init.sources[source]['wait_on_start']
+        if isinstance(wait, str):
+            host, _, service_port = wait.rpartition(':')
+            pd.wait4probe(
+                functools.partial(pd.probe_tcp, host, int(service_port)),
+                tmax, interval * 0.2, name=f'{source} service')
+        elif wait:
+            # Nothing to probe, fixed wait as fallback.
             time.sleep(init.config['command_delay'] * 2)
 
     else:
         print(f"\n(startaudio) could not connect '{source}' ports")
 
     # Disconnect sources from eventual bad behaving clients.
-    pd.client_socket('sources off', port, quiet=True)
+    pd.client_command('sources off', port, quiet=True)
     # Actual source connection.
-    pd.client_socket('sources on', port, quiet=True)
+    pd.client_command('sources on', port, quiet=True)
+
+
+def start_camilladsp():
+    """Load camilladsp, retrying until its jack ports show up."""
+    # Hack to care for unconsistent port name creation upstream.
+    # Get camilladsp port names:
+    # Join all music output ports in a list:
+    ports = sum(init.config["audio_ports"], [])
+    # Filter camillaDSP ports:
+    ports = [x for x in ports if re.match("cpal_client_in.*", x)]
+    count = 0
+    tmax = init.config['command_delay'] * 2
+    interval = init.config['command_delay'] * 0.5
+    while count < 5:
+        init_camilladsp()
+        if pd.wait4ports(ports, tmax, interval):
+            break
+        else:
+            sp.Popen('pkill -fe camilladsp'.split())
+            count += 1
 
 
-def main(run_level):
-    """Start loading function."""
+def restore_settings(state):
+    """Restore audio settings, but source and mute."""
+    # Activate command_unmute mode downstream.
+    pd.client_command('command_unmute', port, quiet=True)
+
+    # Restoring previous state.
+    # Exceptionally we add a line feed at the end
+    # since settings restoring messages don't.
+    print('\n(startaudio): restoring previous settings:\n')
+    init_state_settings(state)
+
+    # Write source to state file for use of clients if config ask for it.
+    if state['sources'] == 'on':
+        # Just refresh state file.
+        init.state['source'] = state['source']
+        pd.client_command('save', port, quiet=True)
+
+
+def launch_client(client):
+    """Launch an external client."""
+    try:
+        p = sp.Popen(client.split(), stdout=sp.DEVNULL)
+        print(f'pid {p.pid:4}: {client}')
+    except Exception as e:
+        print(f"\n(startaudio) problem launching client '{client}':", e)
+
+
+def restore_source(state):
+    """Restore source if config mandates so."""
+    if state['sources'] == 'on':
+        init_source(state)
+
+
+def restore_mute(state):
+    """Restore mute and save state."""
+    pd.client_command(f'mute {state["mute"]}', port)
+    print(f'mute {state["mute"]}')
+
+    # Cancel command_unmute mode downstream.
+    # Restoring config value.
+    if init.config['do_mute']:
+        pd.client_command('command_mute', port, quiet=True)
+
+    # Save changes to file.
+    pd.client_command('save', port, quiet=True)
+
+
+# A startup stage: name, function to run, and names of required stages.
+Stage = collections.namedtuple('Stage', 'name action requires')
+
+
+def startup_stages(run_level):
+    """Return startup stages graph for a run level."""
+    stages = []
+
     # jack, brutefir, camilladsp, server
     if run_level in {'core', 'all'}:
-        init_jack()
-        
-        # camillaDSP:
-        # Hack to care for unconsistent port name creation upstream.
-        # Get camilladsp port names:
-        # Join all music output ports in a list:
-        ports = sum(init.config["audio_ports"], [])
-        # Filter camillaDSP ports:
-        ports = [x for x in ports if re.match("cpal_client_in.*", x)]
-        count = 0
-        tmax = init.config['command_delay'] * 2
-        interval = init.config['command_delay'] * 0.5
-        while count < 5:
-            init_camilladsp()
-            if pd.wait4ports(ports, tmax, interval):
-                break
-            else:
-                sp.Popen('pkill -fe camilladsp'.split())
-                count += 1
-
-
-        init_server()
+        stages += [
+            Stage('jack', init_jack, ()),
+            Stage('camilladsp', start_camilladsp, ('jack',)),
+            Stage('server', init_server, ('camilladsp',))
+            ]
 
     # Inboard players.
     if run_level in {'clients', 'all'}:
         # Getting operating state. Do it before launching clients
         # so they get the correct setting from state file if needed.
         state = set_initial_state()
+        clients = pd.read_clients('start', named=True)
+        client_stages = [
+            Stage(f'client {name}', functools.partial(launch_client, client),
+                  ('settings',))
+            for name, client in clients.items()
+            ]
+        stages += [
+            Stage('settings', functools.partial(restore_settings, state),
+                  ('server',)),
+            *client_stages,
+            # Source ports come from clients.
+            Stage('source', functools.partial(restore_source, state),
+                  ('settings', *(stage.name for stage in client_stages))),
+            Stage('mute', functools.partial(restore_mute, state),
+                  ('source',))
+            ]
+
+    return stages
+
+
+async def run_stages(stages):
+    """
+    Run every stage as soon as the stages it requires are done.
+
+    Requirements not among stages are taken as done. Return dictionary of
+    (start, duration) seconds of every stage, relative to first start.
+    """
+    time_start = time.monotonic()
+    timings = {}
+    tasks = {}
+
+    async def run_stage(stage):
+        for required in stage.requires:
+            if required in tasks:
+                await tasks[required]
+        stage_start = time.monotonic()
+        await asyncio.to_thread(stage.action)
+        timings[stage.name] = (stage_start - time_start,
+                               time.monotonic() - stage_start)
+
+    for stage in stages:
+        tasks[stage.name] = asyncio.ensure_future(run_stage(stage))
+    await asyncio.gather(*tasks.values())
+    return timings
+
+
+def print_timings(timings):
+    """Print stages timing breakdown."""
+    print('\n(startaudio) startup timing:\n')
+    print(f'    {"stage":24s}{"start":>10s}{"duration":>10s}')
+    for name, (start, duration) in sorted(
+            timings.items(), key=lambda item: item[1][0]):
+        print(f'    {name:24s}{start:10.3f}{duration:10.3f}')
+    total = max(start + duration for start, duration in timings.values())
+    print(f'    {"total":24s}{"":10s}{total:10.3f}')
+
 
-        # Activate command_unmute mode downstream.
-        pd.client_socket('command_unmute', port, quiet=True)
-
-        # Restoring previous state.
-        # Exceptionally we add a line feed at the end
-        # since settings restoring messages don't.
-        print('\n(startaudio): restoring previous settings:\n')
-        init_state_settings(state)
-
-        # Write source to state file for use of clients if config ask for it.
-        if state['sources'] == 'on':
-            # Just refresh state file.
-            init.state['source'] = state['source']
-            pd.client_socket('save', port, quiet=True)
-
-        # Launch external clients.
-        # Exceptionally we add a line feed at the end
-        # since client load messages don't.
-        print('\n(startaudio): starting clients...\n')
-        for client in pd.read_clients('start'):
-            try:
-                p = sp.Popen(client.split(), stdout=sp.DEVNULL)
-                print(f'pid {p.pid:4}: {client}')
-            except Exception as e:
-                print(f"\n(startaudio) problem launching client '{client}':",
-                      e)
-
-        # Restoring sources if config mandates so.
-        if state['sources'] == 'on':
-            init_source(state)
-
-        # Restore mute state.
-        pd.client_socket(f'mute {state["mute"]}', port)
-        print(f'mute {state["mute"]}')
-
-        # Cancel command_unmute mode downstream.
-        # Restoring config value.
-        if init.config['do_mute']:
-            pd.client_socket('command_mute', port, quiet=True)
-
-        # Save changes to file.
-        pd.client_socket('save', port, quiet=True)
+def main(run_level):
+    """Start loading function."""
+    timings = asyncio.run(run_stages(startup_stages(run_level)))
+    if run_level in {'clients', 'all'}:
         print('\n(startaudio): pre.di.c started :-)')
+    print_timings(timings)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Stream of state changes to subscribed clients.
+
+After every command the state is compared with the last published one,
+and each changed setting becomes an event with a sequence number. Events
+are queued to the subscribers interested in that setting.
+"""
+
+import asyncio
+import copy
+
+
+# Events queued per subscriber. A subscriber lagging further behind is
+# dropped, and must subscribe again to resync.
+queue_size = 256
+
+
+class Subscription:
+    """Events queue for a subscriber, filtered by setting names."""
+
+    def __init__(self, keys):
+        # Void means every setting.
+        self.keys = set(keys)
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = False
+
+    def wants(self, key):
+        """Tell if the subscriber is interested in a setting."""
+        return not self.keys or key in self.keys
+
+
+class StateFeed:
+    """Publish state changes as (seq, key, old, new) events."""
+
+    def __init__(self, state):
+        self.state = state
+        # State as last published.
+        self.published = copy.deepcopy(state)
+        # Sequence number of the last event.
+        self.seq = 0
+        self.subscriptions = set()
+
+    def subscribe(self, keys=()):
+        """
+        Return a new subscription.
+
+        Its queue is primed with the actual value of every subscribed
+        setting, as events with no old value and the actual sequence
+        number, so the subscriber starts in sync.
+        """
+        unknown = set(keys) - set(self.state)
+        if unknown:
+            raise Exception(f'unknown settings: {" ".join(sorted(unknown))}')
+        subscription = Subscription(keys)
+        for key, value in self.published.items():
+            if subscription.wants(key):
+                subscription.queue.put_nowait(
+                    {'seq': self.seq, 'key': key, 'old': None, 'new': value})
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Forget a subscription."""
+        self.subscriptions.discard(subscription)
+
+    def publish(self):
+        """
+        Queue events for state changes since last publication.
+
+        Return dictionary of changed settings and their new values.
+        """
+        changes = {}
+        for key, value in self.state.items():
+            old = self.published.get(key)
+            if key in self.published and old == value:
+                continue
+            self.seq += 1
+            event = {'seq': self.seq, 'key': key, 'old': old, 'new': value}
+            self.published[key] = copy.deepcopy(value)
+            changes[key] = self.published[key]
+            for subscription in list(self.subscriptions):
+                if not subscription.wants(key):
+                    continue
+                try:
+                    subscription.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    subscription.dropped = True
+                    self.unsubscribe(subscription)
+                    # Wake up its sender, to close the connection.
+                    subscription.queue.get_nowait()
+                    subscription.queue.put_nowait(None)
+        return changes
@@ -0,0 +1,146 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Write-behind persistence of state.
+
+State changes are debounced and appended as deltas to a journal file,
+one JSON object per line. The journal is periodically compacted back
+into the state file, written atomically (temp file and rename).
+
+Files are written in a worker thread, from a snapshot of state taken in
+the event loop, one write at a time.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import yaml
+
+import baseconfig as base
+# Only used at run time: init imports this module while loading.
+import init
+import metrics
+
+
+def read_journal(journal_path):
+    """Return list of state deltas in journal file, if any."""
+    deltas = []
+    try:
+        with open(journal_path) as journal:
+            for line in journal:
+                try:
+                    deltas.append(json.loads(line))
+                except ValueError:
+                    # Incomplete last line after a crash.
+                    break
+    except FileNotFoundError:
+        pass
+    return deltas
+
+
+def replay_journal(state, journal_path):
+    """Apply journaled deltas to state dictionary loaded from file."""
+    for delta in read_journal(journal_path):
+        state.update(delta)
+    return state
+
+
+def write_atomic(path, data):
+    """Write a dictionary as YAML, replacing file atomically."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        yaml.dump(data, f, Dumper=init.yaml_dumper,
+                  default_flow_style=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class StateStore:
+    """Journaled, debounced persistence of a state dictionary."""
+
+    def __init__(self, state, state_path, journal_path):
+        self.state = state
+        self.state_path = state_path
+        self.journal_path = journal_path
+        # State as it is on disk, state file plus journal.
+        self.persisted = replay_journal(dict(state), journal_path)
+        self.entries = len(read_journal(journal_path))
+        self.last_compaction = time.monotonic()
+        # Debounce timer handle.
+        self.timer = None
+        # Keeps writes from overlapping.
+        self.lock = asyncio.Lock()
+        # Running write task.
+        self.task = None
+
+    def changed(self):
+        """Schedule journaling of state, debouncing bursts of changes."""
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(base.state_debounce, self.on_timer)
+
+    def on_timer(self):
+        """Start writing pending changes."""
+        self.timer = None
+        self.task = asyncio.create_task(self.write())
+
+    async def write(self):
+        """Journal pending changes, compacting if due."""
+        async with self.lock:
+            try:
+                await asyncio.to_thread(self.write_files, dict(self.state))
+            except Exception as e:
+                print(f'\n(statestore) error writing state: {e}')
+
+    def write_files(self, state):
+        """Journal a state snapshot, compacting if due. Runs in a thread."""
+        self.write_journal(state)
+        if (self.entries >= base.state_compact_entries
+                or (self.entries and time.monotonic()
+                    - self.last_compaction
+                    > base.state_compact_interval)):
+            self.compact(state)
+
+    @metrics.timed('state journal')
+    def write_journal(self, state):
+        """Append state changes since last write to journal."""
+        delta = {
+            key: value for key, value in state.items()
+            if key not in self.persisted or self.persisted[key] != value
+            }
+        if not delta:
+            return
+        with open(self.journal_path, 'a') as journal:
+            journal.write(json.dumps(delta) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.persisted.update(delta)
+        self.entries += 1
+        metrics.count('state_journal_writes')
+
+    @metrics.timed('state compact')
+    def compact(self, state):
+        """Write state to state file and empty journal."""
+        write_atomic(self.state_path, state)
+        self.persisted = dict(state)
+        # State file is up to date, journal is no longer needed.
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.entries = 0
+        self.last_compaction = time.monotonic()
+        metrics.count('state_compactions')
+
+    async def flush(self):
+        """Write state to state file right now."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.state is None:
+            raise Exception('corrupted null state file\n')
+        async with self.lock:
+            await asyncio.to_thread(self.compact, dict(self.state))
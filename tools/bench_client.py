@@ -0,0 +1,62 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Benchmarks sending a command to pre.di.c server from a new process.
+
+Usage: bench_client.py [runs [command]]     (default 20 ping)
+
+Compares wall time, startup included, of the ways scripts send commands:
+pdclient.py, pdlib.client_socket(), and nc (if installed) as the control
+script in samples/bin does. Server must be running.
+"""
+
+import os
+import shutil
+import statistics
+import subprocess as sp
+import sys
+import time
+
+
+# pre.di.c main folder.
+main_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_folder)
+
+import pdclient
+
+
+def run_time(args, stdin=None):
+    """Return seconds taken by a command run in a new process."""
+    time_start = time.perf_counter()
+    sp.run(args, cwd=main_folder, input=stdin, stdout=sp.DEVNULL,
+           check=True)
+    return time.perf_counter() - time_start
+
+
+def main(runs, command):
+    """Run benchmark."""
+    port = pdclient.default_port
+    ways = {
+        'pdclient': ([sys.executable, 'pdclient.py', '-p', str(port),
+                      *command.split()], None),
+        'pdlib': ([sys.executable, '-c',
+                   f'import pdlib; pdlib.client_socket({command!r}, {port})'],
+                  None)
+        }
+    if shutil.which('nc'):
+        ways['nc'] = (['nc', '-q', '1', '127.0.0.1', str(port)],
+                      f'{command}\n'.encode())
+
+    print(f"\n(bench_client) '{command}', {runs} runs\n")
+    for name, (args, stdin) in ways.items():
+        times = [run_time(args, stdin) for _ in range(runs)]
+        print(f'{name:10s}'
+              f'min {min(times) * 1e3:8.2f} ms    '
+              f'median {statistics.median(times) * 1e3:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 20,
+         ' '.join(sys.argv[2:]) or 'ping')
@@ -0,0 +1,396 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+End to end latency benchmark of server commands.
+
+Usage: bench_e2e.py [options] [command ...]
+
+command                 commands to measure (default level bass source
+                        drc_set stereo)
+-n, --requests <n>      requests per command and concurrency (default 200)
+-c, --concurrency <n,..>
+                        concurrent client connections (default 1,4,16)
+-V, --variants <v,..>   config variants (default 2c-short,2c-long,
+                        5c-short,5c-long)
+--taps <n>              length of long FIR filters (default 65536)
+--reload-latency <s>    camilladsp stand-in config reload delay
+                        (default 0)
+--mute                  keep muting during commands, as in sample config,
+                        so timing includes volume ramp waits
+-o, --output <file>     results file (default bench_e2e.json)
+--compare <file>        compare results with a previous results file
+
+For every config variant, a throwaway copy of pre.di.c is made in a
+temporary folder from the sample config, with 2 or 5 input channels and
+the sample FIR filters, short, or zero padded to long. The actual server
+is run there against the camilladsp stand-in and a fake jack graph (see
+tools/README.md), on free ports. No audio system is needed, and nothing
+outside the temporary folder is touched.
+
+Every command is sent alternating two arguments, so that every request
+changes state, over persistent connections, timing from socket write to
+reply. With concurrent clients, some requests may still find state
+already set (e.g. 'source already selected'), and are counted as errors.
+Muting during commands is disabled unless asked for, as its waits
+would hide processing time. Results are written as JSON, with the
+pre.di.c commit measured, for comparison between versions.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import yaml
+
+
+# pre.di.c main folder.
+main_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_folder)
+
+import pdclient
+
+
+samples_folder = f'{main_folder}/samples/pre.di.c'
+
+# Commands and the two arguments they alternate.
+workload = {
+    'level': ('-30', '-31'),
+    'bass': ('1', '0'),
+    'source': ('tape', 'bench'),
+    'drc_set': ('1', '2'),
+    'stereo': ('mid', 'normal'),
+    'mute': ('on', 'off'),
+    'loudness': ('on', 'off'),
+    'treble': ('1', '0'),
+    'balance': ('1', '0'),
+    'phase_eq': ('on', 'off'),
+    'solo': ('l', 'lr')
+    }
+
+# Extra source, switched to and from the sample one.
+bench_source = {
+    'gain': 0,
+    'source_ports': 'bench_player:out_1 bench_player:out_2',
+    'phase_eq': 'off',
+    'wait_on_start': False
+    }
+
+# Sends camilladsp config, run in the throwaway copy.
+set_config_script = '''
+import startaudio
+from camilladsp import CamillaClient
+cdsp = CamillaClient('localhost', startaudio.init.config['websocket_port'])
+cdsp.connect()
+cdsp.config.set_active(startaudio.camilladsp_config())
+cdsp.disconnect()
+'''
+
+
+def free_port():
+    """Return a free TCP port."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(check, tmax, name):
+    """Wait for a check to succeed, or raise TimeoutError."""
+    deadline = time.monotonic() + tmax
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f'{name} not available')
+
+
+def percentile(times, p):
+    """Return a percentile of sorted times."""
+    return times[min(len(times) - 1, int(len(times) * p / 100))]
+
+
+class Setup:
+    """Throwaway pre.di.c copy running a config variant."""
+
+    def __init__(self, variant, taps, reload_latency, mute):
+        channels, firs = variant.split('-')
+        self.channels = int(channels.rstrip('c'))
+        self.taps = taps if firs == 'long' else None
+        self.reload_latency = reload_latency
+        self.mute = mute
+        self.folder = tempfile.mkdtemp(prefix='predic_bench_')
+        self.processes = []
+        self.control_port = free_port()
+        self.websocket_port = free_port()
+
+    def make_tree(self):
+        """Copy modules and sample config, adapted to the variant."""
+        for name in os.listdir(main_folder):
+            if name.endswith('.py'):
+                shutil.copy(f'{main_folder}/{name}', self.folder)
+        shutil.copytree(f'{main_folder}/tools', f'{self.folder}/tools')
+        shutil.copytree(f'{samples_folder}/config', f'{self.folder}/config')
+        shutil.copytree(f'{samples_folder}/loudspeakers',
+                        f'{self.folder}/loudspeakers')
+        config_folder = f'{self.folder}/config'
+        shutil.copy(f'{config_folder}/camilladsp-{self.channels}c.yml',
+                    f'{config_folder}/camilladsp.yml')
+
+        audio_ports = [f'cpal_client_in:in_{i}' for i in range(self.channels)]
+        with open(f'{config_folder}/config.yml') as f:
+            config = yaml.safe_load(f)
+        config.update({
+            'verbose': 0,
+            'control_address': '127.0.0.1',
+            'control_port': self.control_port,
+            'websocket_port': self.websocket_port,
+            'audio_ports': [' '.join(audio_ports)],
+            'do_mute': self.mute
+            })
+        with open(f'{config_folder}/config.yml', 'w') as f:
+            yaml.safe_dump(config, f)
+
+        with open(f'{config_folder}/sources.yml') as f:
+            sources = yaml.safe_load(f)
+        sources['bench'] = bench_source
+        with open(f'{config_folder}/sources.yml', 'w') as f:
+            yaml.safe_dump(sources, f)
+
+        # Fake jack graph with the ports of sources and camilladsp.
+        script = {'clients': [
+            {'name': 'system',
+             'outputs': ['capture_1', 'capture_2'],
+             'inputs': ['playback_1', 'playback_2']},
+            {'name': 'bench_player', 'outputs': ['out_1', 'out_2']},
+            {'name': 'cpal_client_in',
+             'inputs': [port.split(':')[1] for port in audio_ports]}
+            ]}
+        with open(f'{self.folder}/fake_jack.yml', 'w') as f:
+            yaml.safe_dump(script, f)
+
+        if self.taps:
+            # Zero pad sample filters, so they stay valid.
+            speaker_folder = (f'{self.folder}/loudspeakers/'
+                              f'{config["loudspeaker"]}')
+            for name in os.listdir(speaker_folder):
+                if name.endswith('.pcm'):
+                    path = f'{speaker_folder}/{name}'
+                    fir = np.fromfile(path, dtype='<f4')
+                    padded = np.zeros(max(self.taps, len(fir)), dtype='<f4')
+                    padded[:len(fir)] = fir
+                    padded.tofile(path)
+
+    def spawn(self, args, env=None):
+        """Start a process in the throwaway copy, logging its output."""
+        log = open(f'{self.folder}/{os.path.basename(args[1])}.log', 'w')
+        process = sp.Popen(args, cwd=self.folder, stdout=log, stderr=log,
+                           env=env)
+        self.processes.append((process, log))
+        return process
+
+    def start(self):
+        """Start camilladsp stand-in and server."""
+        self.make_tree()
+        self.spawn([sys.executable, 'tools/camilladsp_standin.py',
+                    '-p', str(self.websocket_port),
+                    '--reload-latency', str(self.reload_latency)])
+        wait_for(lambda: socket.create_connection(
+            ('127.0.0.1', self.websocket_port)).close() or True,
+                 10, 'camilladsp stand-in')
+        sp.run([sys.executable, '-c', set_config_script], cwd=self.folder,
+               stdout=sp.DEVNULL, check=True)
+        env = dict(os.environ,
+                   PREDIC_FAKE_JACK=f'{self.folder}/fake_jack.yml')
+        server = self.spawn([sys.executable, 'server.py'], env)
+
+        def server_up():
+            if server.poll() is not None:
+                raise RuntimeError('server exited, see server.py.log')
+            return pdclient.acknowledged(
+                pdclient.ServerConnection(self.control_port).send('ping')[0])
+
+        wait_for(server_up, 30, 'server')
+
+    def stop(self, keep=False):
+        """Stop processes and remove throwaway copy."""
+        for process, log in self.processes:
+            process.terminate()
+            try:
+                process.wait(5)
+            except sp.TimeoutExpired:
+                process.kill()
+            log.close()
+        if not keep:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def measure(port, command, requests, concurrency):
+    """Send requests from concurrent connections. Return result dict."""
+    first, second = workload[command]
+    connections = [pdclient.ServerConnection(port)
+                   for _ in range(concurrency)]
+    for connection in connections:
+        connection.connect()
+    times = []
+    errors = []
+    barrier = threading.Barrier(concurrency)
+    # Alternate arguments across clients, so that concurrent requests
+    # mostly change state too.
+    counter = itertools.count()
+
+    def client(connection, count):
+        barrier.wait()
+        for _ in range(count):
+            line = f'{command} {first if next(counter) % 2 else second}'
+            time_start = time.perf_counter()
+            answer = connection.send(line)[0]
+            times.append(time.perf_counter() - time_start)
+            if not pdclient.acknowledged(answer):
+                errors.append(answer)
+
+    counts = [requests // concurrency + (i < requests % concurrency)
+              for i in range(concurrency)]
+    threads = [threading.Thread(target=client, args=args)
+               for args in zip(connections, counts)]
+    time_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - time_start
+    for connection in connections:
+        connection.close()
+
+    times.sort()
+    return {
+        'command': command,
+        'concurrency': concurrency,
+        'requests': len(times),
+        'errors': len(errors),
+        'p50_ms': percentile(times, 50) * 1e3,
+        'p95_ms': percentile(times, 95) * 1e3,
+        'p99_ms': percentile(times, 99) * 1e3,
+        'mean_ms': statistics.mean(times) * 1e3,
+        'max_ms': times[-1] * 1e3,
+        'throughput': len(times) / elapsed,
+        'first_error': errors[0].decode() if errors else None
+        }
+
+
+def commit():
+    """Return pre.di.c git commit, if known."""
+    try:
+        return sp.run(['git', 'describe', '--always', '--dirty'],
+                      cwd=main_folder, capture_output=True, text=True,
+                      check=True).stdout.strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    """Print changes against previous results."""
+    with open(path) as f:
+        previous = json.load(f)
+    old = {(r['variant'], r['command'], r['concurrency']): r
+           for r in previous['results']}
+    print(f"\n(bench_e2e) compared to {previous.get('commit')}:\n")
+    for r in results:
+        o = old.get((r['variant'], r['command'], r['concurrency']))
+        if o is None:
+            continue
+        print(f"{r['variant']:10s}{r['command']:10s}{r['concurrency']:4d}"
+              f"    p50 {r['p50_ms'] / o['p50_ms'] - 1:+8.1%}"
+              f"    p99 {r['p99_ms'] / o['p99_ms'] - 1:+8.1%}"
+              f"    throughput {r['throughput'] / o['throughput'] - 1:+8.1%}")
+
+
+def main(args):
+    """Run benchmark."""
+    concurrencies = [int(c) for c in args.concurrency.split(',')]
+    commands = args.commands or ['level', 'bass', 'source', 'drc_set',
+                                 'stereo']
+    for command in commands:
+        if command not in workload:
+            print(f'(bench_e2e) unknown command {command}, '
+                  f'choose from: {" ".join(workload)}')
+            return False
+
+    results = []
+    for variant in args.variants.split(','):
+        setup = Setup(variant, args.taps, args.reload_latency, args.mute)
+        print(f'\n(bench_e2e) {variant}\n')
+        try:
+            setup.start()
+            for command in commands:
+                for concurrency in concurrencies:
+                    result = {'variant': variant,
+                              **measure(setup.control_port, command,
+                                        args.requests, concurrency)}
+                    results.append(result)
+                    print(f"{command:10s}{concurrency:4d} clients"
+                          f"    p50 {result['p50_ms']:8.3f} ms"
+                          f"    p95 {result['p95_ms']:8.3f} ms"
+                          f"    p99 {result['p99_ms']:8.3f} ms"
+                          f"    {result['throughput']:8.1f} req/s"
+                          f"    {result['errors']} errors")
+        except Exception as e:
+            print(f'(bench_e2e) {variant} failed: {e}, '
+                  f'see logs in {setup.folder}')
+            setup.stop(keep=True)
+            return False
+        setup.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'requests': args.requests,
+            'taps': args.taps,
+            'reload_latency': args.reload_latency,
+            'mute': args.mute,
+            'results': results
+            }, f, indent=2)
+    print(f'\n(bench_e2e) results written to {args.output}')
+    if args.compare:
+        compare(results, args.compare)
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='bench_e2e.py', usage=__doc__.split('\n\n')[1].strip(),
+        add_help=False)
+    parser.add_argument('commands', nargs='*')
+    parser.add_argument('-n', '--requests', type=int, default=200)
+    parser.add_argument('-c', '--concurrency', default='1,4,16')
+    parser.add_argument('-V', '--variants',
+                        default='2c-short,2c-long,5c-short,5c-long')
+    parser.add_argument('--taps', type=int, default=65536)
+    parser.add_argument('--reload-latency', type=float, default=0)
+    parser.add_argument('--mute', action='store_true')
+    parser.add_argument('-o', '--output', default='bench_e2e.json')
+    parser.add_argument('--compare')
+    parser.add_argument('-h', '--help', action='store_true')
+    args = parser.parse_args()
+    if args.help:
+        print(__doc__)
+        sys.exit()
+    sys.exit(0 if main(args) else 1)
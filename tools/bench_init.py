@@ -0,0 +1,70 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Benchmarks import time of init.py, with and without config cache.
+
+Usage: bench_init.py [runs]     (default 10)
+
+Every run imports init in a new python process. Cold runs remove the
+config cache first, so configs are parsed from YAML files. Warm runs
+find the cache written by the previous run.
+"""
+
+import os
+import statistics
+import subprocess as sp
+import sys
+
+
+# pre.di.c main folder.
+main_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_folder)
+
+import baseconfig as base
+
+
+cache_path = (f'{main_folder}/{base.config_folder}/'
+              f'{base.init_cache_filename}')
+
+# Time import only, not interpreter start.
+probe = ('import time; t = time.perf_counter(); import init; '
+         'print(time.perf_counter() - t)')
+
+
+def import_time():
+    """Return seconds taken to import init in a new process."""
+    output = sp.check_output(
+        [sys.executable, '-c', probe], cwd=main_folder, text=True)
+    return float(output.split()[-1])
+
+
+def remove_cache():
+    """Remove config cache, if any."""
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+
+def report(name, times):
+    """Print timing statistics in milliseconds."""
+    print(f'{name:10s}'
+          f'min {min(times) * 1e3:8.2f} ms    '
+          f'median {statistics.median(times) * 1e3:8.2f} ms')
+
+
+def main(runs):
+    """Run benchmark."""
+    cold = []
+    for _ in range(runs):
+        remove_cache()
+        cold.append(import_time())
+    # Last cold run left a fresh cache.
+    warm = [import_time() for _ in range(runs)]
+    print(f'\n(bench_init) import init, {runs} runs\n')
+    report('cold', cold)
+    report('warm', warm)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if sys.argv[1:] else 10)
@@ -0,0 +1,112 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Benchmarks source switching on a fake jack graph.
+
+Usage: bench_source.py [-s script] [switches]     (default 100)
+
+Sources in sources.yml are switched in turn, followed by no source, as
+the server does: wait for source ports, then plan and apply connection
+changes to audio ports. Switch latency and graph operations are printed.
+
+The fake graph has the ports of sources and audio ports in config, all
+up from start, unless a fake jack script is given (see jackbackend.py)
+for port delays, failures and churn. No jack server is needed.
+"""
+
+import itertools
+import os
+import statistics
+import sys
+import time
+
+
+# pre.di.c main folder.
+main_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_folder)
+
+import init
+import jackbackend
+import jacksession
+import pdlib as pd
+
+
+def config_graph():
+    """Return a fake graph with source and audio ports in config."""
+    fake = jackbackend.FakeJack()
+    ports = {}
+    for source in init.sources.values():
+        for port in source['source_ports']:
+            client, name = port.split(':', 1)
+            ports.setdefault(client, ([], []))[0].append(name)
+    for port in sum(init.config['audio_ports'], []):
+        client, name = port.split(':', 1)
+        ports.setdefault(client, ([], []))[1].append(name)
+    for client, (outputs, inputs) in ports.items():
+        fake.add_client(client, outputs, inputs)
+    return fake
+
+
+def switch(session, source, tmax):
+    """Switch to a source. Return list of graph operations performed."""
+    if source is not None:
+        if not session.wait4ports(init.sources[source]['source_ports'],
+                                  tmax):
+            raise TimeoutError('source ports are down')
+    audio_ports = set(sum(init.config['audio_ports'], []))
+    current = {connection for connection in session.get_connections()
+               if connection[1] in audio_ports}
+    plan = jacksession.plan_connections(
+        current, pd.source_connections(source))
+    return session.apply(plan)
+
+
+def main(switches, script):
+    """Run benchmark."""
+    if script:
+        fake = jackbackend.FakeJack.from_script(script)
+    else:
+        fake = config_graph()
+    jackbackend.use(fake)
+    session = jacksession.JackSession('bench_source')
+    tmax = init.config['command_delay'] * 0.1
+
+    times = []
+    operations = []
+    errors = 0
+    sources = itertools.cycle([*init.sources, None])
+    for source in itertools.islice(sources, switches):
+        time_start = time.perf_counter()
+        try:
+            report = switch(session, source, tmax)
+        except Exception as e:
+            report = getattr(e, 'report', [])
+            errors += 1
+        times.append(time.perf_counter() - time_start)
+        operations.append(len(report))
+    session.close()
+    fake.stop()
+
+    times.sort()
+    print(f'\n(bench_source) {switches} switches, {errors} failed\n')
+    print(f'latency     min {times[0] * 1e3:8.3f} ms    '
+          f'median {statistics.median(times) * 1e3:8.3f} ms    '
+          f'p95 {times[int(len(times) * 0.95)] * 1e3:8.3f} ms    '
+          f'max {times[-1] * 1e3:8.3f} ms')
+    print(f'operations  {statistics.mean(operations):.2f} per switch\n')
+    for operation, count in sorted(fake.calls.items()):
+        print(f'{operation:30s}{count:10d}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    script = None
+    if args[:1] in (['-h'], ['--help']):
+        print(__doc__)
+        sys.exit()
+    if args[:1] == ['-s']:
+        script = args[1]
+        args = args[2:]
+    main(int(args[0]) if args else 100, script)
@@ -0,0 +1,353 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Stand-in for camilladsp, serving its websocket control protocol only.
+
+Usage: camilladsp_standin.py [options]
+
+-p, --port <port>           websocket port (default 1234)
+-a, --address <address>     listening address (default 127.0.0.1)
+--reload-latency <s>        delay of config changes (default 0)
+--fail <command>:<rate>     fail a command with a probability 0..1,
+                            e.g. 'SetConfigJson:0.1'. Can be repeated.
+--seed <n>                  seed of failure injection (default 0)
+--record <file>             append every call as a JSON line
+
+camilladsp options (-m, -w, -s, -l, -o, --logfile...) are accepted and
+ignored, so it can replace camilladsp in 'camilladsp_command' of
+config.yml, e.g.:
+
+camilladsp_command: /usr/bin/python3 /home/predic/pre.di.c/tools/camilladsp_standin.py --reload-latency 0.05
+
+Config, volume, mute, faders, state and signal level commands used by
+pre.di.c are served. Audio is not processed: signal levels follow main
+volume and mute. On exit a count of calls by command is printed.
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import copy
+import hashlib
+import json
+import random
+import signal
+import struct
+import sys
+import time
+
+import yaml
+
+
+# RFC 6455 handshake magic.
+websocket_guid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Frame opcodes.
+op_continuation = 0x0
+op_text = 0x1
+op_binary = 0x2
+op_close = 0x8
+op_ping = 0x9
+op_pong = 0xA
+
+# Commands changing config, delayed by reload latency.
+reload_commands = {'SetConfigJson', 'SetConfig', 'PatchConfig', 'Reload'}
+
+# Number of faders, 0 is main.
+faders = 5
+
+
+# Websocket framing.
+
+async def handshake(reader, writer):
+    """Answer websocket opening handshake. Return False if not one."""
+    request = await reader.readuntil(b'\r\n\r\n')
+    headers = {}
+    for line in request.decode('latin-1').split('\r\n')[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    key = headers.get('sec-websocket-key')
+    if key is None:
+        writer.write(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+        return False
+    accept = base64.b64encode(
+        hashlib.sha1((key + websocket_guid).encode()).digest()).decode()
+    writer.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                  'Upgrade: websocket\r\n'
+                  'Connection: Upgrade\r\n'
+                  f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+    await writer.drain()
+    return True
+
+
+async def read_frame(reader):
+    """Read a frame. Return a tuple (fin, opcode, payload)."""
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        # Unmask as a whole integer, much faster than byte by byte.
+        key = int.from_bytes((mask * (length // 4 + 1))[:length], 'big')
+        payload = (int.from_bytes(payload, 'big') ^ key).to_bytes(
+            length, 'big')
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+async def read_message(reader, writer):
+    """
+    Read a data message, joining fragments and answering pings.
+
+    Return a tuple (opcode, payload), opcode is op_close at the end.
+    """
+    message = b''
+    message_opcode = None
+    while True:
+        fin, opcode, payload = await read_frame(reader)
+        if opcode == op_ping:
+            write_frame(writer, op_pong, payload)
+            continue
+        if opcode == op_pong:
+            continue
+        if opcode == op_close:
+            return op_close, payload
+        if opcode != op_continuation:
+            message_opcode = opcode
+        message += payload
+        if fin:
+            return message_opcode, message
+
+
+def write_frame(writer, opcode, payload):
+    """Write an unmasked, unfragmented frame, as servers do."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 2**16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    writer.write(header + payload)
+
+
+# camilladsp behaviour.
+
+class StandIn:
+    """camilladsp state and command handlers."""
+
+    def __init__(self, reload_latency=0, failures=None, seed=0,
+                 record=None):
+        self.reload_latency = reload_latency
+        # Failure probability by command.
+        self.failures = failures or {}
+        self.random = random.Random(seed)
+        self.record = record
+        self.calls = collections.Counter()
+        self.config = None
+        self.state = 'Inactive'
+        self.volumes = [0.0] * faders
+        self.mutes = [False] * faders
+
+    def log(self, command, arg):
+        """Count and optionally record a call."""
+        self.calls[command] += 1
+        if self.record is not None:
+            self.record.write(json.dumps(
+                {'time': time.time(), 'command': command, 'arg': arg})
+                + '\n')
+            self.record.flush()
+
+    def channels(self, direction):
+        """Return channels of capture or playback device."""
+        try:
+            return self.config['devices'][direction]['channels']
+        except (TypeError, KeyError):
+            return 0
+
+    def levels(self):
+        """Fake signal levels, following main volume and mute."""
+        level = -1000.0 if self.mutes[0] else -20.0 + self.volumes[0]
+        return ([-20.0] * self.channels('capture'),
+                [level] * self.channels('playback'))
+
+    def set_config(self, config):
+        """Make a config active."""
+        if not isinstance(config, dict) or 'devices' not in config:
+            raise ValueError('invalid config')
+        self.config = config
+        self.state = 'Running'
+
+    def patch(self, config, patch):
+        """Merge a patch into a config, recursively."""
+        for key, value in patch.items():
+            if isinstance(value, dict) and isinstance(config.get(key), dict):
+                self.patch(config[key], value)
+            else:
+                config[key] = value
+
+    def run(self, command, arg):
+        """Run a command. Return its value, or raise ValueError."""
+        capture, playback = self.levels()
+        match command:
+            case 'GetVersion':
+                return '2.0.0'
+            case 'GetState':
+                return self.state
+            case 'GetStopReason':
+                return 'None'
+            case 'GetConfigJson':
+                return json.dumps(self.config)
+            case 'GetConfig':
+                return yaml.dump(self.config)
+            case 'SetConfigJson':
+                self.set_config(json.loads(arg))
+            case 'SetConfig':
+                self.set_config(yaml.safe_load(arg))
+            case 'PatchConfig':
+                if self.config is None:
+                    raise ValueError('no active config')
+                config = copy.deepcopy(self.config)
+                self.patch(config, arg)
+                self.set_config(config)
+            case 'Reload':
+                if self.config is None:
+                    raise ValueError('no active config')
+            case 'GetVolume':
+                return self.volumes[0]
+            case 'SetVolume':
+                self.volumes[0] = float(arg)
+            case 'GetMute':
+                return self.mutes[0]
+            case 'SetMute':
+                self.mutes[0] = bool(arg)
+            case 'GetFaders':
+                return [{'volume': volume, 'mute': mute}
+                        for volume, mute in zip(self.volumes, self.mutes)]
+            case 'GetFaderVolume':
+                return [arg, self.volumes[arg]]
+            case 'SetFaderVolume':
+                self.volumes[arg[0]] = float(arg[1])
+            case 'GetFaderMute':
+                return [arg, self.mutes[arg]]
+            case 'SetFaderMute':
+                self.mutes[arg[0]] = bool(arg[1])
+            case 'GetSignalLevels':
+                return {'capture_rms': capture, 'capture_peak': capture,
+                        'playback_rms': playback, 'playback_peak': playback}
+            case 'GetCaptureSignalRms' | 'GetCaptureSignalPeak':
+                return capture
+            case 'GetPlaybackSignalRms' | 'GetPlaybackSignalPeak':
+                return playback
+            case 'GetCaptureRate':
+                return (self.config or {}).get('devices', {}).get(
+                    'samplerate', 0)
+            case 'GetProcessingLoad':
+                return 0.0
+            case 'GetBufferLevel' | 'GetClippedSamples':
+                return 0
+            case 'Stop':
+                self.state = 'Inactive'
+            case _:
+                raise ValueError(f'unknown command {command}')
+        return None
+
+    async def answer(self, message):
+        """Return reply to a JSON command message."""
+        try:
+            query = json.loads(message)
+        except ValueError:
+            return {'Invalid': {'error': 'invalid json'}}
+        if isinstance(query, dict) and len(query) == 1:
+            command, arg = next(iter(query.items()))
+        elif isinstance(query, str):
+            command, arg = query, None
+        else:
+            return {'Invalid': {'error': 'invalid command'}}
+
+        self.log(command, arg)
+        if command in reload_commands and self.reload_latency:
+            await asyncio.sleep(self.reload_latency)
+        if self.random.random() < self.failures.get(command, 0):
+            return {command: {'result': 'Error',
+                              'value': 'injected failure'}}
+        try:
+            value = self.run(command, arg)
+        except (ValueError, TypeError, IndexError, KeyError) as e:
+            return {command: {'result': 'Error', 'value': str(e)}}
+        reply = {'result': 'Ok'}
+        if value is not None:
+            reply['value'] = value
+        return {command: reply}
+
+    async def serve(self, reader, writer):
+        """Serve a websocket connection."""
+        try:
+            if not await handshake(reader, writer):
+                return
+            while True:
+                opcode, message = await read_message(reader, writer)
+                if opcode == op_close:
+                    write_frame(writer, op_close, message[:2])
+                    await writer.drain()
+                    break
+                reply = await self.answer(message.decode())
+                write_frame(writer, op_text, json.dumps(reply).encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def main(args):
+    """Serve until terminated, then print calls count."""
+    failures = {}
+    for rule in args.fail:
+        command, rate = rule.rsplit(':', 1)
+        failures[command] = float(rate)
+    record = open(args.record, 'a') if args.record else None
+    standin = StandIn(args.reload_latency, failures, args.seed, record)
+
+    server = await asyncio.start_server(
+        standin.serve, args.address, args.port)
+    serving = asyncio.ensure_future(server.serve_forever())
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, serving.cancel)
+    try:
+        await serving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if record is not None:
+            record.close()
+        print('\n(camilladsp_standin) calls:', file=sys.stderr)
+        for command, count in sorted(standin.calls.items()):
+            print(f'{command:30s}{count:10d}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='camilladsp_standin.py', usage=__doc__.split('\n\n')[1],
+        add_help=False)
+    parser.add_argument('-p', '--port', type=int, default=1234)
+    parser.add_argument('-a', '--address', default='127.0.0.1')
+    parser.add_argument('--reload-latency', type=float, default=0)
+    parser.add_argument('--fail', action='append', default=[])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record')
+    parser.add_argument('-h', '--help', action='store_true')
+    # Accept and ignore camilladsp options.
+    args, _ = parser.parse_known_args()
+    if args.help:
+        print(__doc__)
+    else:
+        asyncio.run(main(args))
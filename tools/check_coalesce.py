@@ -0,0 +1,155 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Checks folding of numeric command bursts past setting limits.
+
+Usage: check_coalesce.py [clients]     (default 10)
+
+A throwaway server with 'coalesce_window' set is run as bench_e2e.py
+does, against the camilladsp stand-in and a fake jack graph. Bursts of
+concurrent 'add' commands, going beyond the range of each tone setting
+and then back, are sent from as many clients. After every burst, state
+has to be the one of the commands run one by one, with clamps, clamped
+commands answered with a clamp warning and the others with OK, and the
+camilladsp config has to agree with state.
+"""
+
+import json
+import os
+import sys
+import threading
+
+import yaml
+from camilladsp import CamillaClient
+
+# pre.di.c main folder.
+main_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_folder)
+sys.path.insert(0, f'{main_folder}/tools')
+
+import baseconfig as base
+import bench_e2e
+import pdclient
+
+
+# Folding window (s), long enough for a burst to fold into one command.
+window = 0.05
+
+# Settings checked, with their limit and camilladsp filter gains,
+# as functions of the setting value.
+checks = {
+    'bass': (base.tone_variation,
+             lambda value: {'f.bass': value}),
+    'treble': (base.tone_variation,
+               lambda value: {'f.treble': value}),
+    'balance': (base.balance_variation,
+                lambda value: {'f.balance.L': -value, 'f.balance.R': value})
+    }
+
+
+class Setup(bench_e2e.Setup):
+    """Throwaway pre.di.c copy folding numeric commands."""
+
+    def make_tree(self):
+        super().make_tree()
+        path = f'{self.folder}/config/config.yml'
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        config['coalesce_window'] = window
+        with open(path, 'w') as f:
+            yaml.safe_dump(config, f)
+
+
+def burst(port, command, clients):
+    """Send a command from concurrent connections. Return answers."""
+    answers = []
+    barrier = threading.Barrier(clients)
+
+    def client():
+        connection = pdclient.ServerConnection(port)
+        connection.connect()
+        barrier.wait()
+        answers.append(connection.send(command)[0].decode())
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return answers
+
+
+def check(setup, setting, step, clients):
+    """Run a burst past a limit. Return list of failures."""
+    limit, gains = checks[setting]
+    connection = pdclient.ServerConnection(setup.control_port)
+    status = json.loads(
+        connection.send('status json')[0].decode().rpartition('\n')[0])
+    connection.close()
+
+    # Expected outcome of the commands run one by one.
+    value = status[setting]
+    expected_clamped = 0
+    for _ in range(clients):
+        value += step
+        if abs(value) > limit:
+            value = limit if value > 0 else -limit
+            expected_clamped += 1
+
+    answers = burst(setup.control_port, f'{setting} {step} add', clients)
+    failures = []
+    clamped = [answer for answer in answers if answer.endswith('\nACK')]
+    if len(clamped) != expected_clamped or not all(
+            'value clamped' in answer for answer in clamped):
+        failures.append(f'{len(clamped)} of {clients} clamped, '
+                        f'{expected_clamped} expected: {answers}')
+
+    connection = pdclient.ServerConnection(setup.control_port)
+    status = json.loads(
+        connection.send('status json')[0].decode().rpartition('\n')[0])
+    connection.close()
+    if status[setting] != value:
+        failures.append(f'state {status[setting]}, {value} expected')
+
+    cdsp = CamillaClient('localhost', setup.websocket_port)
+    cdsp.connect()
+    filters = cdsp.config.active()['filters']
+    cdsp.disconnect()
+    for name, gain in gains(value).items():
+        actual = filters[name]['parameters']['gain']
+        if actual != gain:
+            failures.append(f'camilladsp {name} gain {actual}, '
+                            f'{gain} expected')
+    return failures
+
+
+def main(clients):
+    """Run checks. Return success."""
+    setup = Setup('2c-short', None, 0, False)
+    failed = False
+    try:
+        setup.start()
+        for setting in checks:
+            for step in (1, -1, -1):
+                failures = check(setup, setting, step * 2, clients)
+                print(f'(check_coalesce) {clients} x {setting} '
+                      f'{step * 2} add: {"FAIL" if failures else "ok"}')
+                for failure in failures:
+                    print(f'    {failure}')
+                failed |= bool(failures)
+    finally:
+        setup.stop(keep=failed)
+    if failed:
+        print(f'(check_coalesce) see logs in {setup.folder}')
+    return not failed
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] in (['-h'], ['--help']):
+        print(__doc__)
+        sys.exit()
+    sys.exit(0 if main(int(args[0]) if args else 10) else 1)
@@ -0,0 +1,277 @@
+# This file is part of pre.di.c
+# pre.di.c, a preamp and digital crossover
+# Copyright (C) Roberto Ripio
+
+"""
+Replays command traces against a server, with their recorded timing.
+
+Usage: replay_trace.py [options] <trace file> ...
+
+-p, --port <port>       server port (default pdclient port)
+-x, --speed <x>         replay speed, 2 for twice as fast, 0 for flat
+                        out (default 1)
+--no-reset              don't set the traced initial state first
+
+Traces are written by the server when tracing is on (see cmdtrace.py).
+Give rotated files oldest first, e.g. trace.jsonl.2 trace.jsonl.1
+trace.jsonl. Traced periods (tracing turned on, server restarts) are
+replayed back to back.
+
+The server state is first set to the one at trace start, then every
+recorded connection is replayed over its own persistent connection, in
+order, at the recorded times scaled by speed. Flat out, every connection
+sends its commands as fast as answers come. Run it against a throwaway
+server on the camilladsp stand-in and a fake jack graph (see
+tools/README.md and bench_e2e.py), not against the one playing music.
+
+Reported are replay latency against recorded latency by command, from
+socket write to answer, commands whose success differs from the trace,
+lag behind schedule, and settings whose final value differs from the
+one expected from the trace. Concurrent commands racing for a setting
+may succeed or fail other than traced (e.g. 'source already selected').
+"""
+
+import argparse
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+
+# pre.di.c main folder.
+main_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, main_folder)
+
+import pdclient
+
+
+# Settings set apart from 'restore', as the server does on start.
+unrestored = ('sources', 'source', 'mute')
+# Commands not replayed.
+skipped = {'trace', 'profile'}
+# Connections replaying at once, at most.
+max_connections = 32
+
+
+def command_name(command):
+    """Return name to report a command by."""
+    return 'batch' if ';' in command else (command.split() or ['other'])[0]
+
+
+def read_traces(paths):
+    """
+    Return (initial state, records) from trace files.
+
+    Records get a 'due' time in seconds from replay start, and a
+    'client' key telling their connection apart across traced periods.
+    """
+    state = None
+    records = []
+    period = 0
+    offset = 0.0
+    start = None
+    for path in paths:
+        with open(path) as f:
+            for number, line in enumerate(f):
+                entry = json.loads(line)
+                if 'state' in entry:
+                    if state is None:
+                        state = entry['state']
+                    # Files after the first start by a rotation header,
+                    # others start a traced period.
+                    if number or start is None:
+                        period += 1
+                        offset = records[-1]['due'] if records else 0.0
+                        start = entry['t']
+                    continue
+                if command_name(entry['cmd']) in skipped:
+                    continue
+                entry['due'] = offset + entry['t'] - start
+                entry['client'] = (period, entry['conn'])
+                records.append(entry)
+    if state is None:
+        raise ValueError('no trace header found')
+    return state, records
+
+
+def answer_body(answer):
+    """Return answer text without the status line."""
+    return answer.decode().rpartition('\n')[0].strip()
+
+
+def reset_state(connection, state):
+    """Set server state to a traced one. Return list of failures."""
+    commands = [f'{setting} {state[setting]}' for setting in unrestored[:2]
+                if setting in state]
+    settings = {key: value for key, value in state.items()
+                if key not in unrestored}
+    commands.append('restore ' + json.dumps(settings))
+    if 'mute' in state:
+        commands.append(f"mute {state['mute']}")
+    failures = []
+    for command in commands:
+        answer = connection.send(command)[0]
+        # Already selected sources are fine.
+        if not pdclient.acknowledged(answer) and (
+                'already' not in answer.decode()):
+            failures.append(f'{command}: {answer_body(answer)}')
+    return failures
+
+
+def replay(port, records, speed):
+    """Replay records. Return list of (record, latency, lag, ok)."""
+    by_connection = collections.defaultdict(list)
+    for record in records:
+        by_connection[record['client']].append(record)
+    results = []
+    slots = threading.BoundedSemaphore(max_connections)
+    time_start = time.perf_counter()
+
+    def client(connection_records):
+        connection = pdclient.ServerConnection(port)
+        try:
+            for record in connection_records:
+                lag = 0.0
+                if speed:
+                    due = time_start + record['due'] / speed
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    lag = time.perf_counter() - due
+                time_sent = time.perf_counter()
+                try:
+                    answer = connection.send(record['cmd'])[0]
+                    ok = pdclient.acknowledged(answer)
+                except (OSError, ValueError) as e:
+                    print(f"(replay_trace) {record['cmd']!r} failed: {e}")
+                    ok = False
+                results.append(
+                    (record, time.perf_counter() - time_sent, lag, ok))
+        finally:
+            connection.close()
+            slots.release()
+
+    # Connections start when their first command is due.
+    threads = []
+    for connection_records in by_connection.values():
+        if speed:
+            delay = (time_start + connection_records[0]['due'] / speed
+                     - time.perf_counter())
+            if delay > 0:
+                time.sleep(delay)
+        slots.acquire()
+        thread = threading.Thread(target=client, args=(connection_records,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - time_start
+
+
+def percentile(values, p):
+    """Return a percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def print_latencies(results):
+    """Print replay and recorded latency percentiles by command."""
+    groups = collections.defaultdict(list)
+    for result in results:
+        groups[command_name(result[0]['cmd'])].append(result)
+    groups['all'] = results
+    print(f'{"command":14s}{"count":>7s}   '
+          + ''.join(f'{q:>9s}' for q in ('p50', 'p95', 'p99', 'max'))
+          + '   replay / recorded (ms)')
+    for name, group in groups.items():
+        replayed = sorted(latency for _, latency, _, _ in group)
+        recorded = sorted(record['lat'] for record, _, _, _ in group)
+        for title, values in ((name, replayed), ('', recorded)):
+            print(f'{title:14s}{len(values) if title else "":>7}   '
+                  + ''.join(f'{percentile(values, p) * 1e3:9.3f}'
+                            for p in (50, 95, 99, 100)))
+
+
+def expected_state(state, records):
+    """Return state after applying traced changes, in trace order."""
+    expected = dict(state)
+    for record in records:
+        expected.update(record.get('set', {}))
+    return expected
+
+
+def state_differences(expected, actual):
+    """Return list of (setting, expected, actual) that differ."""
+    differences = []
+    for key, value in expected.items():
+        got = actual.get(key)
+        if isinstance(value, float) and isinstance(got, (int, float)):
+            if abs(value - got) < 1e-6:
+                continue
+        elif value == got:
+            continue
+        differences.append((key, value, got))
+    return differences
+
+
+def main(args):
+    """Replay traces and report."""
+    state, records = read_traces(args.traces)
+    if not records:
+        print('(replay_trace) no commands in traces')
+        return False
+    connection = pdclient.ServerConnection(args.port)
+    try:
+        if not args.no_reset:
+            for failure in reset_state(connection, state):
+                print(f'(replay_trace) reset: {failure}')
+        connection.close()
+
+        speed = 'flat out' if not args.speed else f'{args.speed:g}x'
+        print(f'\n(replay_trace) {len(records)} commands, '
+              f'{len({record["client"] for record in records})} connections, '
+              f'{records[-1]["due"]:.1f} s traced, at {speed}\n')
+        results, elapsed = replay(args.port, records, args.speed)
+
+        print_latencies(results)
+        lags = sorted(lag for _, _, lag, _ in results)
+        print(f'\nelapsed {elapsed:.3f} s, {len(results) / elapsed:.1f} '
+              f'commands/s')
+        if args.speed:
+            print(f'lag behind schedule: p50 {percentile(lags, 50) * 1e3:.3f}'
+                  f' ms, max {lags[-1] * 1e3:.3f} ms')
+
+        mismatches = [(record, ok) for record, _, _, ok in results
+                      if ok != record['ok']]
+        print(f'\n{len(mismatches)} commands with a different outcome')
+        for record, ok in mismatches[:20]:
+            print(f"    {record['cmd']!r} traced {'OK' if record['ok'] else 'ACK'}"
+                  f", replayed {'OK' if ok else 'ACK'}")
+
+        actual = json.loads(answer_body(connection.send('status json')[0]))
+    finally:
+        connection.close()
+
+    differences = state_differences(expected_state(state, records), actual)
+    print(f'{len(differences)} settings differ from the trace')
+    for key, value, got in differences:
+        print(f'    {key}: expected {value}, got {got}')
+    return not mismatches and not differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='replay_trace.py', usage=__doc__.split('\n\n')[1].strip(),
+        add_help=False)
+    parser.add_argument('traces', nargs='*')
+    parser.add_argument('-p', '--port', type=int,
+                        default=pdclient.default_port)
+    parser.add_argument('-x', '--speed', type=float, default=1.0)
+    parser.add_argument('--no-reset', action='store_true')
+    parser.add_argument('-h', '--help', action='store_true')
+    args = parser.parse_args()
+    if args.help or not args.traces:
+        print(__doc__)
+        sys.exit()
+    sys.exit(0 if main(args) else 1)